@@ -3,15 +3,20 @@ import json
 import re
 import ast
 import operator
+import time
 import logging
+import threading
 from datetime import datetime, timezone, timedelta
-from openai import OpenAI
-from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional
-import requests
+from typing import List, Dict, Any, Optional, Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from startup import load_env
+from image_buffer import image_available, discard_image
+import resilience
+from resilience import endpoint_of, retry_status
 
 # 加载 .env 文件中的环境变量
-load_dotenv()
+load_env()
 
 
 # ============================================================================
@@ -19,26 +24,65 @@ load_dotenv()
 # ============================================================================
 
 class _ComfyUIContext:
-    """ComfyUI 工具的运行时上下文，用于传递飞书客户端和 chat_id"""
+    """
+    ComfyUI 工具的运行时上下文，用于传递飞书客户端和 chat_id
+    客户端、处理器、调度器为全局共享；chat_id / sender_id 按线程隔离（多个会话可并发处理），
+    待编辑图片按 chat_id 保存。
+    """
     def __init__(self):
         self.feishu_client = None
-        self.chat_id = None
         self.comfyui_client = None
         self.image_processor = None
-        self.pending_image_path = None  # 待编辑的图片路径
-        self.sender_id = None  # 消息发送者的 open_id
+        self.scheduler = None  # batch_scheduler.MicroBatchScheduler，可选
+        self.resolver = None  # endpoint_resolver.EndpointResolver，可选
+        self._local = threading.local()
+        self._pending_images = {}  # chat_id -> 待编辑的图片（路径或 ImageBuffer）
+        self._lock = threading.Lock()
+
+    @property
+    def chat_id(self):
+        return getattr(self._local, "chat_id", None)
+
+    @chat_id.setter
+    def chat_id(self, value):
+        self._local.chat_id = value
+
+    @property
+    def sender_id(self):
+        """消息发送者的 open_id"""
+        return getattr(self._local, "sender_id", None)
+
+    @sender_id.setter
+    def sender_id(self, value):
+        self._local.sender_id = value
+
+    @property
+    def pending_image_path(self):
+        """当前会话待编辑的图片（文件路径或 ImageBuffer）"""
+        with self._lock:
+            return self._pending_images.get(self.chat_id)
+
+    @pending_image_path.setter
+    def pending_image_path(self, value):
+        with self._lock:
+            if value is None:
+                self._pending_images.pop(self.chat_id, None)
+            else:
+                self._pending_images[self.chat_id] = value
 
-    def set(self, feishu_client=None, chat_id=None, comfyui_client=None, image_processor=None, sender_id=None):
+    def set(self, feishu_client=None, chat_id=None, comfyui_client=None, image_processor=None,
+            sender_id=None, scheduler=None):
         self.feishu_client = feishu_client
         self.chat_id = chat_id
         self.comfyui_client = comfyui_client
         self.image_processor = image_processor
         self.sender_id = sender_id
+        self.scheduler = scheduler
 
     def clear(self):
         self.feishu_client = None
-        self.chat_id = None
         self.pending_image_path = None
+        self.chat_id = None
         self.sender_id = None
 
 comfyui_context = _ComfyUIContext()
@@ -60,6 +104,7 @@ REACT_PROMPT_TEMPLATE = """
 - 计算类问题，调用计算器后应立即给出结果
 - 不要在获得搜索结果后继续搜索相同或相似的问题
 - 文生图（TextToImage）成功后，必须立即使用 Finish 结束，不要重复生成图片
+- 用户需要多张图片时，使用一次 BatchTextToImage，不要多次调用 TextToImage
 
 请严格按照以下格式进行回应:
 
@@ -91,14 +136,36 @@ class HelloAgentsLLM:
         if not all([self.model, apiKey, baseUrl]):
             raise ValueError("模型ID、API密钥和服务地址必须被提供或在.env文件中定义。")
 
-        self.client = OpenAI(api_key=apiKey, base_url=baseUrl, timeout=timeout)
-
-    def think(self, messages: List[Dict[str, str]], temperature: float = 0) -> str:
+        # 重试由 resilience 统一处理（退避、熔断、重试预算），关闭 SDK 自带的重试
+        self._client_kwargs = {"api_key": apiKey, "base_url": baseUrl, "timeout": timeout, "max_retries": 0}
+        self._endpoint = endpoint_of(baseUrl)
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """OpenAI 客户端，首次使用时才导入 openai 并创建（缩短启动耗时）"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    self._client = OpenAI(**self._client_kwargs)
+        return self._client
+
+    def think(self, messages: List[Dict[str, str]], temperature: float = 0,
+              on_token: Optional[Callable[[str], None]] = None) -> str:
         """
         调用大语言模型进行思考，并返回其响应。
+        on_token 不为空时，每收到一段流式输出就以该段文本调用一次。
         """
-        logger.info(f"🧠 正在调用 {self.model} 模型...")
-        try:
+        logger.info("🧠 正在调用 %s 模型...", self.model)
+        started = time.time()
+        first_token_at = None
+        collected_content = []
+
+        def stream():
+            nonlocal first_token_at
+            collected_content.clear()
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
@@ -106,18 +173,35 @@ class HelloAgentsLLM:
                 stream=True,
             )
             
-            # 处理流式响应
-            logger.info("✅ 大语言模型响应成功:")
-            collected_content = []
-            for chunk in response:
-                content = chunk.choices[0].delta.content or ""
-                print(content, end="", flush=True)  # 流式输出直接打印
-                collected_content.append(content)
-            print()  # 在流式输出结束后换行
-            return "".join(collected_content)
+            # 处理流式响应（不再逐块打印，完整输出仅在 DEBUG 级别记录一次）
+            try:
+                for chunk in response:
+                    if not chunk.choices:
+                        continue
+                    content = chunk.choices[0].delta.content or ""
+                    if not content:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.time()
+                    collected_content.append(content)
+                    if on_token:
+                        on_token(content)
+            except Exception as e:
+                if collected_content:
+                    # 已输出部分内容（可能已写入流式卡片），重试会重复输出，不再重试
+                    raise RuntimeError(f"流式输出中断: {e}") from e
+                raise
+
+        try:
+            resilience.call(stream, "llm", self._endpoint)
+            result = "".join(collected_content)
+            logger.info("✅ 大语言模型响应成功 (%d 字符, 首字 %.2fs, 共 %.2fs)", len(result),
+                        (first_token_at or time.time()) - started, time.time() - started)
+            logger.debug("LLM 输出: %s", result)
+            return result
 
         except Exception as e:
-            logger.error(f"❌ 调用LLM API时发生错误: {e}")
+            logger.error("❌ 调用LLM API时发生错误: %s", e)
             return None
 
 class ToolExecutor:
@@ -133,9 +217,9 @@ class ToolExecutor:
         向工具箱中注册一个新工具。
         """
         if name in self.tools:
-            logger.warning(f"工具 '{name}' 已存在，将被覆盖。")
+            logger.warning("工具 '%s' 已存在，将被覆盖。", name)
         self.tools[name] = {"description": description, "func": func}
-        logger.info(f"工具 '{name}' 已注册。")
+        logger.info("工具 '%s' 已注册。", name)
 
     def getTool(self, name: str) -> callable:
         """
@@ -269,6 +353,52 @@ class ErrorRecoveryManager:
         return (self.consecutive_failures >= self.max_consecutive_failures and
                 current_step >= max_steps - 1)
 
+# 流式回复中各工具对应的步骤提示
+TOOL_STEP_TEXT = {
+    "Search": "🔍 正在搜索…",
+    "Calculator": "🧮 正在计算…",
+    "GetCurrentTime": "🕒 正在获取当前时间…",
+    "TextToImage": "🎨 正在生成图片…",
+    "BatchTextToImage": "🎨 正在批量生成图片…",
+    "CheckComfyUI": "🔌 正在检查绘图服务…",
+    "EditImage": "🖌️ 正在编辑图片…",
+    "RemoveBackground": "✂️ 正在去除背景…",
+    "CreateDoc": "📝 正在创建文档…",
+    "WriteDoc": "📝 正在写入文档…",
+}
+
+
+class _FinishStream:
+    """
+    从 LLM 的流式输出中截取 Finish[...] 内的最终答案。
+    Action: Finish[ 出现之后的文本逐段转发给 on_token；
+    末尾的 "]" 可能是 Finish 的结束括号，暂不转发，等后续文本到达后再确认。
+    """
+
+    _START = re.compile(r"Action:\s*Finish\[")
+    _TAIL = re.compile(r"\]\s*$")
+
+    def __init__(self, on_token: Callable[[str], None]):
+        self.on_token = on_token
+        self._text = ""
+        self._start = None
+        self._emitted = 0
+
+    def feed(self, chunk: str):
+        self._text += chunk
+        if self._start is None:
+            match = self._START.search(self._text)
+            if not match:
+                return
+            self._start = match.end()
+        answer = self._text[self._start:]
+        tail = self._TAIL.search(answer)
+        safe = tail.start() if tail else len(answer)
+        if safe > self._emitted:
+            self.on_token(answer[self._emitted:safe])
+            self._emitted = safe
+
+
 class ReActAgent:
     def __init__(self, llm_client: HelloAgentsLLM, tool_executor: ToolExecutor,
                  max_steps: int = 5, max_consecutive_failures: int = 3):
@@ -279,9 +409,15 @@ class ReActAgent:
         # 错误恢复管理器
         self.error_manager = ErrorRecoveryManager(max_consecutive_failures=max_consecutive_failures)
 
-    def run(self, question: str):
+    def run(self, question: str, on_step: Optional[Callable[[str], None]] = None,
+            on_token: Optional[Callable[[str], None]] = None):
         """
         运行ReAct智能体来回答一个问题。
+
+        Args:
+            question: 用户问题
+            on_step: 每一步开始思考、调用工具前以提示文本调用（流式回复显示当前步骤）
+            on_token: 最终答案（Finish[...] 内的文本）随 LLM 流式输出逐段回调
         """
         self.history = []  # 每次运行时重置历史记录
         self.error_manager.reset()  # 重置错误状态
@@ -289,7 +425,7 @@ class ReActAgent:
 
         while current_step < self.max_steps:
             current_step += 1
-            logger.info(f"--- 第 {current_step} 步 ---")
+            logger.info("--- 第 %d 步 ---", current_step)
 
             # 1. 格式化提示词
             tools_desc = self.tool_executor.getAvailableTools()
@@ -315,8 +451,11 @@ class ReActAgent:
                 )
 
             # 2. 调用LLM进行思考
+            if on_step:
+                on_step("🤔 正在思考…" if current_step == 1 else f"🤔 正在思考…（第 {current_step} 步）")
             messages = [{"role": "user", "content": full_prompt}]
-            response_text = self.llm_client.think(messages=messages)
+            stream = _FinishStream(on_token) if on_token else None
+            response_text = self.llm_client.think(messages=messages, on_token=stream.feed if stream else None)
 
             if not response_text:
                 logger.error("错误:LLM未能返回有效响应。")
@@ -326,7 +465,7 @@ class ReActAgent:
             thought, action = self._parse_output(response_text)
 
             if thought:
-                logger.info(f"🤔 思考: {thought}")
+                logger.info("🤔 思考: %.200s", thought)
 
             if not action:
                 logger.warning("警告:未能解析出有效的Action，流程终止。")
@@ -342,11 +481,11 @@ class ReActAgent:
                 finish_match = re.match(r"Finish\[(.*)\]", action, re.DOTALL)
                 if finish_match:
                     final_answer = finish_match.group(1)
-                    logger.info(f"🎉 最终答案: {final_answer}")
+                    logger.info("🎉 最终答案: %.200s", final_answer)
                     self.error_manager.record_success()  # 成功，reset失败计数
                     return final_answer
                 else:
-                    logger.warning(f"⚠️  警告:无法解析Finish指令: {action}")
+                    logger.warning("⚠️  警告:无法解析Finish指令: %.200s", action)
                     return f"无法解析的Finish指令: {action}"
 
             tool_name, tool_input = self._parse_action(action)
@@ -354,7 +493,7 @@ class ReActAgent:
                 observation = f"错误:无法解析Action格式 '{action}'。请使用格式: 工具名[输入内容]，无参数时格式为: 工具名[]"
                 self.history.append(f"Action: {action}")
                 self.history.append(f"Observation: {observation}")
-                logger.info(f"👀 观察: {observation}")
+                logger.info("👀 观察: %.200s", observation)
 
                 # 记录解析失败
                 self.error_manager.record_failure(
@@ -363,13 +502,15 @@ class ReActAgent:
                 )
                 continue
 
-            logger.info(f"🎬 行动: {tool_name}[{tool_input}]")
+            logger.info("🎬 行动: %s[%.200s]", tool_name, tool_input)
+            if on_step:
+                on_step(TOOL_STEP_TEXT.get(tool_name, f"🛠️ 正在调用 {tool_name}…"))
 
             # 5. 执行工具并处理错误
             tool_function = self.tool_executor.getTool(tool_name)
             if not tool_function:
                 observation = f"错误:未找到名为 '{tool_name}' 的工具。可用工具: {', '.join(self.tool_executor.listToolNames())}"
-                logger.info(f"👀 观察: {observation}")
+                logger.info("👀 观察: %s", observation)
 
                 # 记录工具不存在错误
                 self.error_manager.record_failure(
@@ -380,7 +521,8 @@ class ReActAgent:
             else:
                 try:
                     observation = tool_function(tool_input)
-                    logger.info(f"👀 观察: {observation}")
+                    logger.info("👀 观察: %.200s", observation)
+                    logger.debug("完整观察: %s", observation)
 
                     # 检查工具返回的错误信息
                     if observation and observation.startswith("错误:"):
@@ -395,7 +537,7 @@ class ReActAgent:
 
                 except Exception as e:
                     observation = f"工具执行异常: {str(e)}"
-                    logger.info(f"👀 观察: {observation}")
+                    logger.info("👀 观察: %s", observation)
                     self.error_manager.record_failure(
                         ErrorRecoveryManager.ERROR_SAME_TOOL_WRONG,
                         tool_name=tool_name,
@@ -409,25 +551,25 @@ class ReActAgent:
             # 检查是否触发强制 Finish 机制
             if (self.error_manager.consecutive_failures >= self.error_manager.max_consecutive_failures):
                 logger.warning("\n" + "="*50)
-                logger.warning(f"⚠️ 检测到连续 {self.error_manager.consecutive_failures} 次工具调用失败")
+                logger.warning("⚠️ 检测到连续 %s 次工具调用失败", self.error_manager.consecutive_failures)
                 logger.warning("系统将根据历史观察记录生成答案...")
                 logger.warning("="*50)
 
                 # 从历史记录中提取最后的有效观察结果
                 final_answer = self._extract_answer_from_history()
                 if final_answer:
-                    logger.info(f"🎉 系统自动Finish: {final_answer}")
+                    logger.info("🎉 系统自动Finish: %.200s", final_answer)
                     return final_answer
                 else:
                     # 没有有效信息，返回无法回答
-                    logger.warning(f"🎉 系统自动Finish: 由于工具多次失败，无法获取有效答案")
+                    logger.warning("🎉 系统自动Finish: 由于工具多次失败，无法获取有效答案")
                     return "由于工具多次失败，无法获取有效答案，请人工介入处理。"
 
         logger.warning("已达到最大步数，流程终止。")
         # 尝试从历史记录中提取答案，而不是直接返回 None
         final_answer = self._extract_answer_from_history()
         if final_answer:
-            logger.info(f"🎉 达到最大步数，从历史中提取答案: {final_answer[:100]}")
+            logger.info("🎉 达到最大步数，从历史中提取答案: %.100s", final_answer)
             return final_answer
         return None
 
@@ -483,7 +625,8 @@ def search(query: str) -> str:
     一个基于博查API的实战网页搜索引擎工具。
     它会智能地解析搜索结果，优先返回直接答案或知识图谱信息。
     """
-    logger.info(f"🔍 正在执行 [博查API] 网页搜索: {query}")
+    logger.info("🔍 正在执行 [博查API] 网页搜索: %s", query)
+    import requests
     try:
         # 从环境变量获取博查API配置
         api_endpoint = os.getenv("BOC_SEARCH_API_URL", "https://api.bochaai.com/v1/web-search")
@@ -504,13 +647,11 @@ def search(query: str) -> str:
             "count": 10
         }
         
-        logger.info(f"🌐 连接博查API: {api_endpoint}")
-        response = requests.post(
-            api_endpoint,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        logger.debug("🌐 连接博查API: %s", api_endpoint)
+        # 搜索请求只读，失败时可安全重试
+        response = resilience.call(
+            lambda: requests.post(api_endpoint, headers=headers, json=payload, timeout=30),
+            "search", endpoint_of(api_endpoint), retry_result=retry_status)
         
         if response.status_code != 200:
             return f"博查API请求失败，状态码: {response.status_code}, 响应: {response.text[:200]}"
@@ -581,6 +722,8 @@ def search(query: str) -> str:
         
         return f"对不起，没有找到关于 '{query}' 的信息。"
 
+    except resilience.CircuitOpenError:
+        return "搜索服务暂时不可用（连续请求失败，稍后自动恢复），请根据已有知识回答。"
     except requests.exceptions.RequestException as e:
         return f"网络请求错误: {str(e)}"
     except json.JSONDecodeError as e:
@@ -675,7 +818,7 @@ def calculate(expression: str) -> str:
     - 输入: "(123 + 456) * 789 / 12"
     - 输出: "计算结果: 37957.5"
     """
-    logger.info(f"🧮 正在执行数学计算: {expression}")
+    logger.info("🧮 正在执行数学计算: %s", expression)
     try:
         result = SafeCalculator.calculate(expression)
         # 格式化输出
@@ -703,7 +846,7 @@ def get_current_time(timezone_offset: str = "") -> str:
     Returns:
         当前日期和时间的格式化字符串
     """
-    logger.info(f"🕐 正在获取当前时间, 时区偏移: {timezone_offset or '+8(默认)'}")
+    logger.info("🕐 正在获取当前时间, 时区偏移: %s", timezone_offset or '+8(默认)')
     try:
         # 解析时区偏移
         if timezone_offset:
@@ -732,6 +875,97 @@ def get_current_time(timezone_offset: str = "") -> str:
 # ComfyUI 图像生成工具
 # ============================================================================
 
+_STAGE_TEXT = {
+    "queued": "⏳ 排队中",
+    "running": "🎨 生成中",
+    "finished": "📤 生成完成，正在发送图片...",
+    "failed": "❌ 执行出错",
+}
+
+
+_CANCELLED_RESULT = "任务已被用户取消。请使用Finish[好的，已取消。]直接结束，不要重试。"
+
+
+def _request_cancelled() -> bool:
+    """当前消息的 ComfyUI 任务是否已被用户取消（见 Comfyui.JobRegistry）"""
+    from Comfyui import active_jobs
+    return active_jobs.is_cancelled()
+
+
+def _wait_scheduled(future, workflow_name: str):
+    """
+    等待微批调度器的结果，返回 (输出图片, 超时时的错误提示或 None)
+    等待上限与 ImageProcessor 的等待超时一致：每次提交 300 秒、合并批次每多一张加 60 秒，按迭代次数累计，
+    另留 60 秒收集窗口与排队余量。超时后撤下本请求在调度器中等待的部分与已提交的 ComfyUI 任务。
+    """
+    from concurrent.futures import TimeoutError as FutureTimeout
+    from bot_logging import get_request_id
+    from Comfyui import active_jobs, config, workflow_iterations
+    ctx = comfyui_context
+    iterations = workflow_iterations(config.workflow_configs.get(workflow_name, {}))
+    timeout = (300 + 60 * (ctx.scheduler.max_batch - 1)) * iterations + 60
+    try:
+        return future.result(timeout=timeout), None
+    except FutureTimeout:
+        request_id = get_request_id()
+        logger.warning("ComfyUI 任务等待超时（%d 秒），撤下请求 %s", timeout, request_id)
+        ctx.scheduler.cancel(request_id)
+        active_jobs.cancel(request_id)
+        return None, (f"错误: ComfyUI 任务等待超时（超过 {timeout} 秒），已撤下该任务。"
+                      "请使用Finish[抱歉，图片生成超时，请稍后再试。]直接结束，不要再重试。")
+
+
+def _start_progress_card(title: str):
+    """
+    在当前聊天发送一张进度卡片，返回 (card, on_progress)。
+    ComfyUI 执行期间 on_progress 会把进度事件写入同一张卡片（已节流），
+    没有飞书上下文或卡片发送失败时返回 (None, None)。
+    """
+    ctx = comfyui_context
+    if not ctx.feishu_client or not ctx.chat_id:
+        return None, None
+    from feishu_client import ProgressCard, format_duration
+
+    card = ProgressCard(ctx.feishu_client, ctx.chat_id, title)
+    if not card.start():
+        return None, None
+
+    def on_progress(event):
+        status = _STAGE_TEXT.get(event.stage, event.stage)
+        if event.stage == "queued" and event.queue_remaining:
+            status += f"（服务器队列中共 {event.queue_remaining} 个任务）"
+        elif event.stage == "running" and event.max:
+            status += f"（采样 {event.value}/{event.max} 步）"
+        lines = [status, f"已用时 {format_duration(event.elapsed)} · 预计剩余 {format_duration(event.eta_seconds)}"]
+        card.update(event.percent, lines, stage=event.stage)
+
+    return card, on_progress
+
+
+def _iteration_streamer(workflow_name: str):
+    """
+    工作流迭代多次（remove_iterations > 1）且配置了 stream_iterations 时，返回把中间结果发送到当前聊天的
+    on_iteration 回调，否则返回 None。回调可能在调度器线程中执行，飞书客户端与 chat_id 在此处取出。
+    """
+    ctx = comfyui_context
+    if not ctx.feishu_client or not ctx.chat_id:
+        return None
+    from Comfyui import config, workflow_iterations
+    cfg = config.workflow_configs.get(workflow_name, {})
+    if not cfg.get("stream_iterations") or workflow_iterations(cfg) <= 1:
+        return None
+    feishu_client, chat_id = ctx.feishu_client, ctx.chat_id
+
+    def on_iteration(result):
+        if not image_available(result.output):
+            return
+        caption = f"第 {result.index}/{result.total} 次处理结果（{result.seconds:.1f} 秒）"
+        if not feishu_client.send_image_with_caption(chat_id, result.output, caption):
+            logger.warning("中间结果发送失败: %s", caption)
+
+    return on_iteration
+
+
 def comfyui_text_to_image(prompt: str) -> str:
     """
     ComfyUI 文生图工具。根据文字描述生成图片，并将图片发送到当前聊天。
@@ -742,7 +976,7 @@ def comfyui_text_to_image(prompt: str) -> str:
     Returns:
         操作结果描述
     """
-    logger.info(f"🎨 正在执行文生图: {prompt[:50]}...")
+    logger.info("🎨 正在执行文生图: %.50s...", prompt)
 
     ctx = comfyui_context
     if not ctx.image_processor:
@@ -753,13 +987,26 @@ def comfyui_text_to_image(prompt: str) -> str:
         if not ctx.comfyui_client or not ctx.comfyui_client.check_server(max_attempts=1, check_delay=0):
             return "错误: ComfyUI 服务器未运行，无法生成图片。请使用Finish[抱歉，ComfyUI服务器当前未运行，无法生成图片。请稍后再试。]直接结束，不要再重试。"
 
-        # 执行文生图
-        output_file = ctx.image_processor.process_text_to_image(prompt)
-
-        if not output_file or not os.path.exists(output_file):
+        # 执行文生图，进度写入同一张卡片
+        card, on_progress = _start_progress_card(f"🎨 文生图: {prompt[:30]}")
+        timeout_error = None
+        if ctx.scheduler:
+            from Comfyui import TEXT_TO_IMAGE_WORKFLOW
+            output_file, timeout_error = _wait_scheduled(
+                ctx.scheduler.submit_text_to_image(prompt, on_progress=on_progress), TEXT_TO_IMAGE_WORKFLOW)
+        else:
+            output_file = ctx.image_processor.process_text_to_image(prompt, on_progress=on_progress)
+        if card:
+            card.finish(image_available(output_file))
+        if timeout_error:
+            return timeout_error
+
+        if not image_available(output_file) and _request_cancelled():
+            return _CANCELLED_RESULT
+        if not image_available(output_file):
             return "错误: 文生图失败，未生成图片。请检查 ComfyUI 服务器状态或尝试换一个提示词。"
 
-        logger.info(f"✅ 文生图成功，输出文件: {output_file}")
+        logger.info("✅ 文生图成功，输出文件: %s", output_file)
 
         # 发送图片到飞书
         if ctx.feishu_client and ctx.chat_id:
@@ -772,18 +1019,85 @@ def comfyui_text_to_image(prompt: str) -> str:
                 else:
                     return f"文生图成功，但图片发送失败。图片路径: {output_file}"
             except Exception as e:
-                logger.error(f"发送图片到飞书失败: {e}")
+                logger.error("发送图片到飞书失败: %s", e)
                 return f"文生图成功，但图片发送失败: {str(e)}。图片路径: {output_file}"
         else:
             return f"文生图成功！图片路径: {output_file}"
 
     except Exception as e:
-        logger.error(f"文生图异常: {e}")
+        logger.error("文生图异常: %s", e)
         import traceback
         logger.error(traceback.format_exc())
         return f"文生图错误: {str(e)}"
 
 
+def _parse_batch_request(request: str):
+    """
+    解析批量文生图输入：
+    - "4|一只可爱的猫咪"：同一提示词生成 4 张
+    - "一只猫|一只狗|一只兔子"：每个提示词各生成 1 张
+    返回 (提示词列表, 每个提示词的张数)
+    """
+    parts = [p.strip() for p in request.split("|") if p.strip()]
+    if len(parts) >= 2 and parts[0].isdigit():
+        return ["|".join(parts[1:])], max(1, int(parts[0]))
+    return parts, 1
+
+
+def comfyui_text_to_image_batch(request: str) -> str:
+    """
+    ComfyUI 批量文生图工具。一次提交生成多张图片，并合并为一条消息发送到当前聊天。
+
+    Args:
+        request: "数量|提示词"（同一提示词多张）或 "提示词1|提示词2|..."（多个不同提示词）
+
+    Returns:
+        操作结果描述
+    """
+    from Comfyui import MAX_BATCH_IMAGES
+
+    prompts, per_prompt = _parse_batch_request(request)
+    logger.info("🎨 正在执行批量文生图: %d 个提示词 x %d 张", len(prompts), per_prompt)
+
+    ctx = comfyui_context
+    if not ctx.image_processor:
+        return "错误: ComfyUI 图像处理器未初始化，无法执行文生图。"
+    if not prompts:
+        return "错误: 提示词为空。输入格式为 数量|提示词 或 提示词1|提示词2。"
+    total = len(prompts) * per_prompt
+    if total > MAX_BATCH_IMAGES:
+        return f"错误: 一次最多生成 {MAX_BATCH_IMAGES} 张图片，请减少数量后重试。"
+
+    try:
+        if not ctx.comfyui_client or not ctx.comfyui_client.check_server(max_attempts=1, check_delay=0):
+            return "错误: ComfyUI 服务器未运行，无法生成图片。请使用Finish[抱歉，ComfyUI服务器当前未运行，无法生成图片。请稍后再试。]直接结束，不要再重试。"
+
+        card, on_progress = _start_progress_card(f"🎨 批量文生图: {total} 张")
+        output_files = ctx.image_processor.process_text_to_image_batch(
+            prompts, images_per_prompt=per_prompt, on_progress=on_progress
+        )
+        if card:
+            card.finish(bool(output_files))
+
+        if not output_files and _request_cancelled():
+            return _CANCELLED_RESULT
+        if not output_files:
+            return "错误: 批量文生图失败，未生成图片。请检查 ComfyUI 服务器状态或尝试换一个提示词。"
+
+        logger.info("✅ 批量文生图成功，共 %d 张", len(output_files))
+
+        if ctx.feishu_client and ctx.chat_id:
+            title = f"🎨 文生图 ({len(output_files)} 张): {prompts[0][:30]}"
+            if ctx.feishu_client.send_images_post(ctx.chat_id, output_files, title):
+                return f"批量文生图成功！已将 {len(output_files)} 张图片发送到聊天。\n请立即使用Finish结束，不要再次生成图片。"
+            return f"批量文生图成功，但部分图片发送失败。图片路径: {', '.join(map(str, output_files))}"
+        return f"批量文生图成功！图片路径: {', '.join(map(str, output_files))}"
+
+    except Exception as e:
+        logger.exception("批量文生图异常: %s", e)
+        return f"文生图错误: {str(e)}"
+
+
 def comfyui_check_server(dummy: str = "") -> str:
     """
     检查 ComfyUI 服务器是否正在运行。无需输入参数。
@@ -801,44 +1115,19 @@ def comfyui_check_server(dummy: str = "") -> str:
         return "ComfyUI 客户端未初始化。"
 
     try:
-        # 先检查当前地址
-        if ctx.comfyui_client.check_server(max_attempts=2, check_delay=2):
+        if ctx.resolver:
+            # 重新探测全部候选端点（配置地址、ngrok 隧道、默认公网地址），由解析器统一切换
+            active = ctx.resolver.refresh()
+            if active:
+                return f"ComfyUI 服务器正在运行中（{active}），可以执行图像生成任务。"
+        elif ctx.comfyui_client.check_server(max_attempts=2, check_delay=2):
             return "ComfyUI 服务器正在运行中，可以执行图像生成任务。"
 
-        # 内网不通，尝试通过 ngrok 公网地址连接
-        logger.info("当前地址不可达，尝试通过 ngrok 公网地址连接...")
-        public_url = _get_ngrok_url()
-        if public_url and public_url != ctx.comfyui_client.api_url:
-            ctx.comfyui_client.api_url = public_url
-            logger.info(f"切换到公网地址: {public_url}")
-            if ctx.comfyui_client.check_server(max_attempts=2, check_delay=2):
-                return f"ComfyUI 服务器正在运行中（公网地址），可以执行图像生成任务。"
-
         return "ComfyUI 服务器未运行。无法生成图片，请使用Finish[抱歉，ComfyUI服务器当前未运行，无法生成图片。请稍后再试。]直接结束，不要再重试CheckComfyUI。"
     except Exception as e:
         return f"检查 ComfyUI 服务器状态时出错: {str(e)}"
 
 
-# 默认 ngrok 公网地址（当本地 API 不可用时使用）
-_DEFAULT_NGROK_URL = "https://candi-sporogonial-eliz.ngrok-free.dev"
-
-
-def _get_ngrok_url() -> str:
-    """通过 ngrok 本地 API 获取公网地址，失败时返回默认地址"""
-    try:
-        import urllib.request
-        import json as _json
-        with urllib.request.urlopen("http://127.0.0.1:4040/api/tunnels", timeout=3) as resp:
-            data = _json.loads(resp.read().decode())
-            for tunnel in data.get("tunnels", []):
-                url = tunnel.get("public_url", "")
-                if url.startswith("https://"):
-                    return url
-    except Exception:
-        pass
-    return _DEFAULT_NGROK_URL
-
-
 def comfyui_edit_image(prompt: str) -> str:
     """
     ComfyUI 图像编辑工具。根据提示词对用户发送的图片进行编辑，并将结果发送到当前聊天。
@@ -849,13 +1138,13 @@ def comfyui_edit_image(prompt: str) -> str:
     Returns:
         操作结果描述
     """
-    logger.info(f"🖌️ 正在执行图像编辑: {prompt[:50]}...")
+    logger.info("🖌️ 正在执行图像编辑: %.50s...", prompt)
 
     ctx = comfyui_context
     if not ctx.image_processor:
         return "错误: ComfyUI 图像处理器未初始化，无法执行图像编辑。"
 
-    if not ctx.pending_image_path or not os.path.exists(ctx.pending_image_path):
+    if not image_available(ctx.pending_image_path):
         return "错误: 没有待编辑的图片。请先发送一张图片再进行编辑。"
 
     try:
@@ -863,17 +1152,33 @@ def comfyui_edit_image(prompt: str) -> str:
         if not ctx.comfyui_client or not ctx.comfyui_client.check_server(max_attempts=1, check_delay=0):
             return "错误: ComfyUI 服务器未运行，无法生成图片。请使用Finish[抱歉，ComfyUI服务器当前未运行，无法生成图片。请稍后再试。]直接结束，不要再重试。"
 
-        # 使用 Qwen_edit 工作流进行图像编辑
-        output_file = ctx.image_processor.process_image_with_prompt(
-            ctx.pending_image_path,
-            "Qwen_edit",
-            prompt
-        )
-
-        if not output_file or not os.path.exists(output_file):
+        # 使用 Qwen_edit 工作流进行图像编辑，进度写入同一张卡片
+        card, on_progress = _start_progress_card(f"🖌️ 图像编辑: {prompt[:30]}")
+        timeout_error = None
+        if ctx.scheduler:
+            output_file, timeout_error = _wait_scheduled(ctx.scheduler.submit_image(
+                ctx.pending_image_path, "Qwen_edit", prompt, on_progress=on_progress,
+                on_iteration=_iteration_streamer("Qwen_edit")
+            ), "Qwen_edit")
+        else:
+            output_file = ctx.image_processor.process_image_with_prompt(
+                ctx.pending_image_path,
+                "Qwen_edit",
+                prompt,
+                on_progress=on_progress,
+                on_iteration=_iteration_streamer("Qwen_edit")
+            )
+        if card:
+            card.finish(image_available(output_file))
+        if timeout_error:
+            return timeout_error
+
+        if not image_available(output_file) and _request_cancelled():
+            return _CANCELLED_RESULT
+        if not image_available(output_file):
             return "错误: 图像编辑失败，未生成图片。请检查 ComfyUI 服务器状态或尝试换一个提示词。"
 
-        logger.info(f"✅ 图像编辑成功，输出文件: {output_file}")
+        logger.info("✅ 图像编辑成功，输出文件: %s", output_file)
 
         # 发送图片到飞书
         if ctx.feishu_client and ctx.chat_id:
@@ -886,22 +1191,19 @@ def comfyui_edit_image(prompt: str) -> str:
                     # 清理待编辑图片状态
                     old_image_path = ctx.pending_image_path
                     ctx.pending_image_path = None
-                    # 尝试删除临时图片
-                    try:
-                        os.remove(old_image_path)
-                    except Exception:
-                        pass
+                    # 释放临时图片
+                    discard_image(old_image_path)
                     return "__EDIT_IMAGE_SUCCESS__"
                 else:
                     return f"图像编辑成功，但图片发送失败。图片路径: {output_file}"
             except Exception as e:
-                logger.error(f"发送编辑图片到飞书失败: {e}")
+                logger.error("发送编辑图片到飞书失败: %s", e)
                 return f"图像编辑成功，但图片发送失败: {str(e)}。图片路径: {output_file}"
         else:
             return f"图像编辑成功！图片路径: {output_file}"
 
     except Exception as e:
-        logger.error(f"图像编辑异常: {e}")
+        logger.error("图像编辑异常: %s", e)
         import traceback
         logger.error(traceback.format_exc())
         return f"图像编辑错误: {str(e)}"
@@ -918,13 +1220,13 @@ def comfyui_remove_background(prompt: str) -> str:
     Returns:
         操作结果描述
     """
-    logger.info(f"🖼️ 正在执行背景去除...")
+    logger.info("🖼️ 正在执行背景去除...")
 
     ctx = comfyui_context
     if not ctx.image_processor:
         return "错误: ComfyUI 图像处理器未初始化，无法执行背景去除。"
 
-    if not ctx.pending_image_path or not os.path.exists(ctx.pending_image_path):
+    if not image_available(ctx.pending_image_path):
         return "错误: 没有待处理的图片。请先发送一张图片再进行背景去除。"
 
     try:
@@ -932,16 +1234,32 @@ def comfyui_remove_background(prompt: str) -> str:
         if not ctx.comfyui_client or not ctx.comfyui_client.check_server(max_attempts=1, check_delay=0):
             return "错误: ComfyUI 服务器未运行，无法处理图片。请使用Finish[抱歉，ComfyUI服务器当前未运行，无法处理图片。请稍后再试。]直接结束，不要再重试。"
 
-        # 使用 BackgroundRemove 工作流（无需 prompt）
-        output_file = ctx.image_processor.process_image(
-            ctx.pending_image_path,
-            "BackgroundRemove"
-        )
-
-        if not output_file or not os.path.exists(output_file):
+        # 使用 BackgroundRemove 工作流（无需 prompt），进度写入同一张卡片
+        card, on_progress = _start_progress_card("🖼️ 背景去除")
+        timeout_error = None
+        if ctx.scheduler:
+            output_file, timeout_error = _wait_scheduled(ctx.scheduler.submit_image(
+                ctx.pending_image_path, "BackgroundRemove", on_progress=on_progress,
+                on_iteration=_iteration_streamer("BackgroundRemove")
+            ), "BackgroundRemove")
+        else:
+            output_file = ctx.image_processor.process_image(
+                ctx.pending_image_path,
+                "BackgroundRemove",
+                on_progress=on_progress,
+                on_iteration=_iteration_streamer("BackgroundRemove")
+            )
+        if card:
+            card.finish(image_available(output_file))
+        if timeout_error:
+            return timeout_error
+
+        if not image_available(output_file) and _request_cancelled():
+            return _CANCELLED_RESULT
+        if not image_available(output_file):
             return "错误: 背景去除失败，未生成图片。请检查 ComfyUI 服务器状态。"
 
-        logger.info(f"✅ 背景去除成功，输出文件: {output_file}")
+        logger.info("✅ 背景去除成功，输出文件: %s", output_file)
 
         # 发送图片到飞书
         if ctx.feishu_client and ctx.chat_id:
@@ -953,21 +1271,18 @@ def comfyui_remove_background(prompt: str) -> str:
                     # 清理待编辑图片状态
                     old_image_path = ctx.pending_image_path
                     ctx.pending_image_path = None
-                    try:
-                        os.remove(old_image_path)
-                    except Exception:
-                        pass
+                    discard_image(old_image_path)
                     return "__EDIT_IMAGE_SUCCESS__"
                 else:
                     return f"背景去除成功，但图片发送失败。图片路径: {output_file}"
             except Exception as e:
-                logger.error(f"发送背景去除图片到飞书失败: {e}")
+                logger.error("发送背景去除图片到飞书失败: %s", e)
                 return f"背景去除成功，但图片发送失败: {str(e)}。图片路径: {output_file}"
         else:
             return f"背景去除成功！图片路径: {output_file}"
 
     except Exception as e:
-        logger.error(f"背景去除异常: {e}")
+        logger.error("背景去除异常: %s", e)
         import traceback
         logger.error(traceback.format_exc())
         return f"背景去除错误: {str(e)}"
@@ -991,7 +1306,7 @@ def feishu_create_doc(input_str: str) -> str:
 
     if not title:
         return "错误: 文档标题不能为空。"
-    logger.info(f"📝 正在创建飞书云文档: {title}")
+    logger.info("📝 正在创建飞书云文档: %s", title)
 
     ctx = comfyui_context
     if not ctx.feishu_client:
@@ -1005,27 +1320,6 @@ def feishu_create_doc(input_str: str) -> str:
         if not client:
             return "错误: 飞书SDK客户端未初始化。"
 
-        # 构建文档内容块
-        content_blocks = []
-        if content:
-            # 将内容按段落分割，每段作为一个文本块
-            paragraphs = content.split('\n')
-            for para in paragraphs:
-                text = para.strip()
-                if text:
-                    content_blocks.append({
-                        "block_type": 2,  # 文本块
-                        "text": {
-                            "elements": [{
-                                "text_run": {
-                                    "content": text,
-                                    "text_element_style": {}
-                                }
-                            }],
-                            "style": {}
-                        }
-                    })
-
         # 创建文档请求
         req_body = CreateDocumentRequestBody.builder() \
             .title(title) \
@@ -1035,31 +1329,25 @@ def feishu_create_doc(input_str: str) -> str:
             .request_body(req_body) \
             .build()
 
-        response = client.docx.v1.document.create(request)
+        response = client.docx.v1.document.create(request, ctx.feishu_client._request_option())
 
         if response.code != 0:
-            logger.error(f"创建文档失败: code={response.code}, msg={response.msg}")
+            logger.error("创建文档失败: code=%s, msg=%s", response.code, response.msg)
             # 回退到使用 REST API 方式
             return _feishu_create_doc_rest(title, content)
 
         doc_id = response.data.document.document_id
         doc_url = f"https://bytedance.larkoffice.com/docx/{doc_id}"
 
-        logger.info(f"✅ 文档创建成功: {doc_url}")
-
-        # 如果有内容，追加到文档中（使用 REST API，避免 SDK 版本兼容问题）
-        if content_blocks:
-            token = ctx.feishu_client._get_tenant_access_token()
-            if token:
-                _append_doc_blocks_rest(token, ctx.feishu_client.api_base, doc_id, content)
+        logger.info("✅ 文档创建成功: %s", doc_url)
 
-        # 转移文档所有者给用户
-        _transfer_doc_owner(ctx, doc_id)
+        # 正文写入（REST API，避免 SDK 版本兼容问题）与所有者转移在后台并行完成
+        _start_post_create(ctx, doc_id, doc_url, content)
 
-        return f"文档创建成功！标题: {title}\n链接: {doc_url}\n请立即使用Finish结束。"
+        return f"文档创建成功！标题: {title}\n链接: {doc_url}\n正文与权限设置正在后台完成。请立即使用Finish结束。"
 
     except Exception as e:
-        logger.error(f"创建飞书文档异常: {e}")
+        logger.error("创建飞书文档异常: %s", e)
         import traceback
         logger.error(traceback.format_exc())
         # 回退到 REST API 方式
@@ -1096,119 +1384,153 @@ def _feishu_create_doc_rest(title: str, content: str = "") -> str:
             return "错误: 创建文档成功但未获取到文档ID。"
 
         doc_url = f"https://bytedance.larkoffice.com/docx/{doc_id}"
-        logger.info(f"✅ 文档创建成功(REST): {doc_url}")
+        logger.info("✅ 文档创建成功(REST): %s", doc_url)
 
-        # 如果有内容，追加到文档
-        if content:
-            _append_doc_blocks_rest(token, api_base, doc_id, content)
+        # 正文写入与所有者转移在后台并行完成（复用本次的访问令牌）
+        _start_post_create(ctx, doc_id, doc_url, content, token=token)
 
-        # 转移文档所有者给用户
-        _transfer_doc_owner(ctx, doc_id)
-
-        return f"文档创建成功！标题: {title}\n链接: {doc_url}\n请立即使用Finish结束。"
+        return f"文档创建成功！标题: {title}\n链接: {doc_url}\n正文与权限设置正在后台完成。请立即使用Finish结束。"
 
     except Exception as e:
-        logger.error(f"REST API创建文档异常: {e}")
+        logger.error("REST API创建文档异常: %s", e)
         return f"创建文档错误: {str(e)}"
 
 
-def _append_doc_blocks_rest(token: str, api_base: str, doc_id: str, content: str):
-    """使用 REST API 向文档追加内容"""
-    try:
-        import requests
-        url = f"{api_base}/docx/v1/documents/{doc_id}/blocks/{doc_id}/children"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-
-        children = []
-        for para in content.split('\n'):
-            text = para.strip()
-            if text:
-                children.append({
-                    "block_type": 2,
-                    "text": {
-                        "elements": [{
-                            "text_run": {
-                                "content": text,
-                                "text_element_style": {}
-                            }
-                        }],
-                        "style": {}
-                    }
-                })
-
-        if children:
-            body = {"children": children}
-            resp = requests.post(url, headers=headers, json=body, timeout=15)
-            result = resp.json()
-            if result.get("code") != 0:
-                logger.warning(f"REST追加文档内容失败: {result.get('msg')}")
-    except Exception as e:
-        logger.warning(f"REST追加文档内容异常: {e}")
+# 文档创建后的后续步骤（写入正文、转移所有者）在此线程池中执行
+_doc_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="doc-post")
 
 
-def _transfer_doc_owner(ctx, doc_id: str):
-    """将文档所有者从机器人转移给消息发送者"""
-    if not ctx.sender_id:
+def _start_post_create(ctx, doc_id: str, doc_url: str, content: str, token: str = None):
+    """
+    在后台执行文档创建后的步骤：create → (写入正文 ∥ 添加协作者 → 转移所有者)
+    两个分支共用一个访问令牌，各自使用独立的 HTTP 会话（requests.Session 不保证线程安全）；
+    全部结束后记录耗时，有步骤失败时在当前聊天中提示用户。
+    """
+    import requests
+    from bot_logging import get_request_id, request_context
+
+    feishu_client = ctx.feishu_client
+    chat_id, sender_id = ctx.chat_id, ctx.sender_id
+    request_id = get_request_id()
+    token = token or feishu_client._get_tenant_access_token()
+
+    steps = {}
+    if content:
+        steps["写入正文"] = lambda session: _write_doc_content(feishu_client, doc_id, content, token, session).error
+    if sender_id:
+        steps["转移所有者"] = lambda session: _transfer_doc_owner(feishu_client.api_base, token, doc_id, sender_id,
+                                                             session)
+    else:
         logger.info("无法转移文档所有者: 未获取到发送者ID")
+    if not steps:
         return
 
-    try:
-        token = ctx.feishu_client._get_tenant_access_token()
-        if not token:
-            logger.warning("转移文档所有者失败: 无法获取访问令牌")
-            return
+    started = time.time()
+    lock = threading.Lock()
+    outcome = {}  # 步骤名 -> (错误信息, 耗时)
 
-        import requests
-        from urllib.parse import quote
-        api_base = ctx.feishu_client.api_base
+    def run(name, step):
+        with request_context(request_id):
+            step_started = time.time()
+            try:
+                if token:
+                    with requests.Session() as session:
+                        error = step(session)
+                else:
+                    error = "无法获取飞书访问令牌"
+            except Exception as e:
+                logger.exception("文档后续步骤「%s」异常", name)
+                error = str(e)
+            with lock:
+                outcome[name] = (error, time.time() - step_started)
+                if len(outcome) < len(steps):
+                    return
+            _finish_post_create(feishu_client, chat_id, doc_url, outcome, time.time() - started)
+
+    for name, step in steps.items():
+        _doc_executor.submit(run, name, step)
+
+
+def _finish_post_create(feishu_client, chat_id: str, doc_url: str, outcome: Dict, elapsed: float):
+    timings = ", ".join(f"{name} {seconds:.2f}s" for name, (_, seconds) in outcome.items())
+    logger.info("文档后续步骤完成: %s，共 %.2fs（串行约 %.2fs）", timings, elapsed,
+                sum(seconds for _, seconds in outcome.values()))
+    errors = [f"{name}失败（{error}）" for name, (error, _) in outcome.items() if error]
+    if errors and chat_id:
+        feishu_client.post_text(chat_id, f"⚠️ 文档已创建，但{'；'.join(errors)}。\n链接: {doc_url}")
+
+
+def _write_doc_content(feishu_client, doc_id: str, content: str, token: str = None, session=None):
+    """把 Markdown 正文分批追加到文档末尾，返回 doc_writer.WriteResult"""
+    from doc_writer import DocWriter
+    token_provider = (lambda: token) if token else feishu_client._get_tenant_access_token
+    writer = DocWriter(token_provider, feishu_client.api_base, session=session)
+    try:
+        result = writer.append(doc_id, content)
+    finally:
+        writer.close()
+    if result.ok:
+        logger.info("文档 %s 已写入 %d 个块（%d 批，重试 %d 次，%.2fs）",
+                    doc_id, result.blocks, result.requests, result.retries, result.seconds)
+    else:
+        logger.warning("文档 %s 写入失败: %s（已写入 %d 个块）", doc_id, result.error, result.blocks)
+    return result
+
+
+def _transfer_doc_owner(api_base: str, token: str, doc_id: str, sender_id: str, session=None) -> Optional[str]:
+    """将文档所有者从机器人转移给消息发送者，成功返回 None，失败返回错误信息"""
+    import requests
+    from urllib.parse import quote
+    http = session or requests
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
 
-        # 先将用户添加为文档协作者（full_access权限），因为转移所有者要求目标用户是协作者
-        add_member_url = f"{api_base}/drive/v1/permissions/{doc_id}/members?type=docx"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        add_body = {
-            "member_type": "openid",
-            "member_id": ctx.sender_id,
-            "perm": "full_access"
-        }
+    # 先将用户添加为文档协作者（full_access权限），因为转移所有者要求目标用户是协作者
+    add_member_url = f"{api_base}/drive/v1/permissions/{doc_id}/members?type=docx"
+    add_body = {
+        "member_type": "openid",
+        "member_id": sender_id,
+        "perm": "full_access"
+    }
 
-        resp = requests.post(add_member_url, headers=headers, json=add_body, timeout=15)
+    try:
+        resp = http.post(add_member_url, headers=headers, json=add_body, timeout=15)
         try:
             result = resp.json()
         except Exception:
-            logger.warning(f"添加文档协作者返回非JSON: {resp.text[:200]}")
-            return
+            logger.warning("添加文档协作者返回非JSON: %.200s", resp.text)
+            return "添加协作者返回异常"
         if result.get("code") != 0:
-            logger.warning(f"添加文档协作者失败: code={result.get('code')}, msg={result.get('msg')}")
-            return
+            logger.warning("添加文档协作者失败: code=%s, msg=%s", result.get('code'), result.get('msg'))
+            return f"添加协作者失败: {result.get('msg')}"
 
-        logger.info(f"已将用户 {ctx.sender_id} 添加为文档协作者")
+        logger.info("已将用户 %s 添加为文档协作者", sender_id)
 
         # 转移所有者
-        encoded_sender_id = quote(ctx.sender_id, safe='')
+        encoded_sender_id = quote(sender_id, safe='')
         transfer_url = f"{api_base}/drive/v1/permissions/{doc_id}/members/{encoded_sender_id}/transfer_owner?type=docx"
         transfer_body = {
             "member_type": "openid"
         }
 
-        resp = requests.post(transfer_url, headers=headers, json=transfer_body, timeout=15)
+        resp = http.post(transfer_url, headers=headers, json=transfer_body, timeout=15)
         try:
             result = resp.json()
         except Exception:
-            logger.warning(f"转移文档所有者返回非JSON: {resp.text[:200]}")
-            return
+            logger.warning("转移文档所有者返回非JSON: %.200s", resp.text)
+            return "转移所有者返回异常"
         if result.get("code") != 0:
-            logger.warning(f"转移文档所有者失败: code={result.get('code')}, msg={result.get('msg')}")
-        else:
-            logger.info(f"✅ 文档所有者已转移给用户 {ctx.sender_id}")
+            logger.warning("转移文档所有者失败: code=%s, msg=%s", result.get('code'), result.get('msg'))
+            return f"转移所有者失败: {result.get('msg')}"
+
+        logger.info("✅ 文档所有者已转移给用户 %s", sender_id)
+        return None
 
     except Exception as e:
-        logger.warning(f"转移文档所有者异常: {e}")
+        logger.warning("转移文档所有者异常: %s", e)
+        return str(e)
 
 
 def feishu_write_doc(input_str: str) -> str:
@@ -1237,7 +1559,7 @@ def feishu_write_doc(input_str: str) -> str:
     # 从链接中提取文档ID
     doc_id = _extract_doc_id(doc_ref)
 
-    logger.info(f"📝 正在向文档 {doc_id} 写入内容: {content[:50]}...")
+    logger.info("📝 正在向文档 %s 写入内容: %.50s...", doc_id, content)
 
     ctx = comfyui_context
     if not ctx.feishu_client:
@@ -1248,37 +1570,20 @@ def feishu_write_doc(input_str: str) -> str:
 
 
 def _feishu_write_doc_rest(doc_id: str, content: str) -> str:
-    """使用 REST API 向文档写入内容（回退方案）"""
+    """使用 REST API 向文档写入内容"""
     ctx = comfyui_context
     try:
-        token = ctx.feishu_client._get_tenant_access_token()
-        if not token:
-            return "错误: 无法获取飞书访问令牌。"
+        result = _write_doc_content(ctx.feishu_client, doc_id, content)
+        if not result.ok:
+            written = f"（已写入前 {result.blocks} 个内容块）" if result.blocks else ""
+            return f"错误: 写入文档失败 - {result.error}{written}"
 
-        api_base = ctx.feishu_client.api_base
-        import requests
-
-        url = f"{api_base}/docx/v1/documents/{doc_id}/blocks/{doc_id}/children"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-
-        blocks = _build_text_blocks(content)
-        body = {"children": blocks}
-
-        resp = requests.post(url, headers=headers, json=body, timeout=15)
-        result = resp.json()
-
-        if result.get("code") != 0:
-            return f"错误: 写入文档失败 - {result.get('msg', '未知错误')}"
-
-        logger.info(f"✅ 内容已写入文档(REST): {doc_id}")
+        logger.info("✅ 内容已写入文档(REST): %s", doc_id)
 
         return f"内容写入成功！已将内容追加到文档 {doc_id} 中。请立即使用Finish结束。"
 
     except Exception as e:
-        logger.error(f"REST API写入文档异常: {e}")
+        logger.error("REST API写入文档异常: %s", e)
         return f"写入文档错误: {str(e)}"
 
 
@@ -1290,26 +1595,6 @@ def _extract_doc_id(doc_ref: str) -> str:
     return doc_ref
 
 
-def _build_text_blocks(content: str) -> list:
-    """将文本内容构建为飞书文档内容块列表"""
-    blocks = []
-    for para in content.split('\n'):
-        text = para.strip()
-        if text:
-            blocks.append({
-                "block_type": 2,  # 文本块
-                "text": {
-                    "elements": [{
-                        "text_run": {
-                            "content": text,
-                            "text_element_style": {}
-                        }
-                    }],
-                    "style": {}
-                }
-            })
-    return blocks
-
 # --- 工具初始化与使用示例 ---
 if __name__ == '__main__':
     # 1. 初始化工具执行器
@@ -2,25 +2,40 @@
 ComfyUI 客户端模块
 提供 ComfyUI 服务器连接、工作流执行、图像处理等功能
 """
+import re
+import copy
 import json
+import hashlib
 import time
 import os
 import sys
 import shutil
+import uuid
 import random
+import threading
 import subprocess
-from typing import Optional, Dict, List, Tuple
-from dataclasses import dataclass, field
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Optional, Dict, List, Tuple, Callable
+from dataclasses import dataclass, field, replace
+
+from bot_logging import get_request_id
+from image_buffer import ImageBuffer, disk_io, open_source, source_digest, source_name
+import resilience
+from resilience import POLICIES, CircuitOpenError, endpoint_of, is_not_sent, retry_status
 
 # ============================================================================
 # 配置管理
 # ============================================================================
 
 class ComfyUIConfig:
-    """ComfyUI 配置类"""
+    """
+    ComfyUI 配置类
+    读取 config_store 中的当前快照（ConfigSnapshot），各属性均为加载时计算好的值；
+    config.json5 修改后由 ConfigStore 热更新，通过 store.subscribe() 接收变更通知
+    """
     
     _instance = None
-    _config = None
     
     def __new__(cls):
         if cls._instance is None:
@@ -30,133 +45,186 @@ class ComfyUIConfig:
     
     def _load_config(self):
         """从 config.json5 加载配置"""
-        from dotenv import load_dotenv
-        load_dotenv()
-        
-        # 尝试加载 config.json5
-        config_path = os.path.join(os.path.dirname(__file__), "config.json5")
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # 移除注释
-                lines = []
-                for line in content.split('\n'):
-                    if '//' in line and not line.strip().startswith('"'):
-                        line = line.split('//')[0]
-                    lines.append(line)
-                content = '\n'.join(lines)
-                
-                self._config = json.loads(content)
-            except Exception as e:
-                print(f"[ComfyUI] 加载配置文件失败: {e}")
-                self._config = {}
-        else:
-            self._config = {}
+        from startup import load_env
+        from config_store import ConfigStore
+        load_env()
+        self.store = ConfigStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json5"))
+        self._folders_ready = None
+    
+    @property
+    def snapshot(self):
+        """当前配置快照（同一次处理中多次读取时可先取快照，保证前后一致）"""
+        return self.store.snapshot
     
     def get(self, key: str, default=None):
-        """获取配置值"""
-        return self._config.get(key, default) if self._config else default
+        """获取配置值（只读）"""
+        return self.store.snapshot.get(key, default)
     
     @property
     def api_url(self) -> str:
         """获取 ComfyUI API URL"""
-        comfyui_config = self._config.get("comfyUI", {}) if self._config else {}
-        # 支持直接配置完整 URL（如 ngrok 地址 https://xxxx.ngrok-free.app）
-        url = comfyui_config.get('url', '')
-        if url:
-            return url.rstrip('/')
-        host = comfyui_config.get('host', '127.0.0.1')
-        port = comfyui_config.get('port', '8188')
-        return f"http://{host}:{port}"
+        return self.store.snapshot.api_url
 
     @property
     def proxy_settings(self) -> dict:
         """获取代理设置，用于 requests 调用"""
-        proxy_config = self._config.get("proxy", {}) if self._config else {}
-        if not proxy_config.get("use_proxy", False):
-            return {"http": None, "https": None}
-        http_proxy = proxy_config.get("http", "")
-        https_proxy = proxy_config.get("https", "")
-        return {"http": http_proxy, "https": https_proxy} if http_proxy or https_proxy else {"http": None, "https": None}
+        return dict(self.store.snapshot.proxy_settings)
     
     @property
     def folder(self) -> str:
         """获取 ComfyUI 文件夹路径"""
-        comfyui_config = self._config.get("comfyUI", {}) if self._config else {}
-        return comfyui_config.get('folder', 'ComfyUI')
+        return self.store.snapshot.folder
     
     @property
     def python_exe(self) -> str:
         """获取 Python 可执行文件路径"""
-        comfyui_config = self._config.get("comfyUI", {}) if self._config else {}
-        folder = comfyui_config.get('folder', 'ComfyUI')
-        if os.name == 'nt':
-            return os.path.join(folder, 'python', 'python.exe')
-        return os.path.join(folder, 'python', 'python')
+        return self.store.snapshot.python_exe
     
     @property
     def main_py(self) -> str:
         """获取 main.py 路径"""
-        comfyui_config = self._config.get("comfyUI", {}) if self._config else {}
-        folder = comfyui_config.get('folder', 'ComfyUI')
-        return os.path.join(folder, 'main.py')
+        return self.store.snapshot.main_py
     
     @property
     def input_folder(self) -> str:
         """获取输入文件夹。远程模式使用本地缓存目录"""
-        api = self.api_url
-        is_remote = not (api.startswith("http://127.0.0.1") or api.startswith("http://localhost"))
-        if is_remote:
-            return os.path.join(os.path.dirname(os.path.abspath(__file__)), "comfyui_cache", "input")
-        return os.path.join(self.folder, "input")
+        return self.store.snapshot.input_folder
     
     @property
     def output_folder(self) -> str:
         """获取输出文件夹。远程模式使用本地缓存目录"""
-        api = self.api_url
-        is_remote = not (api.startswith("http://127.0.0.1") or api.startswith("http://localhost"))
-        if is_remote:
-            return os.path.join(os.path.dirname(os.path.abspath(__file__)), "comfyui_cache", "output", "FeiShuBot")
-        return os.path.join(self.folder, "output", "FeiShuBot")
+        return self.store.snapshot.output_folder
     
+    def ensure_folders(self):
+        """创建输入/输出文件夹（首次创建 ComfyUIClient 及配置中的目录变化后调用，导入模块时不再访问磁盘）"""
+        snapshot = self.store.snapshot
+        folders = (snapshot.input_folder, snapshot.output_folder)
+        if self._folders_ready == folders:
+            return
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+        self._folders_ready = folders
+
     @property
     def workflow_configs(self) -> Dict:
-        """获取工作流配置"""
-        workflows_config = self._config.get("workflows", {}) if self._config else {}
-        workflow_configs = {}
-        
-        for name, workflow_data in workflows_config.items():
-            config_dict = {
-                "seed_id": str(workflow_data.get("seed_id")),
-                "input_image_id": str(workflow_data.get("input_image_id")),
-                "output_image_id": str(workflow_data.get("output_image_id")),
-                "workflow": workflow_data.get("workflow", ""),
-                "points_cost": workflow_data.get("points_cost", 10),
-                "remove_iterations": workflow_data.get("remove_iterations", 1)
-            }
-            if "prompt_node_id" in workflow_data:
-                config_dict["prompt_node_id"] = workflow_data["prompt_node_id"]
-            workflow_configs[name] = config_dict
-        
-        return workflow_configs
+        """获取工作流配置（只读映射）"""
+        return self.store.snapshot.workflow_configs
     
     @property
     def default_workflow(self) -> str:
         """获取默认工作流"""
-        return self._config.get("default_workflow", "Qwen_remove") if self._config else "Qwen_remove"
+        return self.store.snapshot.default_workflow
     
     @property
     def text_to_image_config(self) -> Dict:
-        """获取文生图配置"""
-        return self._config.get("text_to_image", {}) if self._config else {}
+        """获取文生图配置（只读映射）"""
+        return self.store.snapshot.text_to_image_config
 
 
 # 全局配置实例
 config = ComfyUIConfig()
 
 
+# ============================================================================
+# 工作流耗时统计
+# ============================================================================
+
+class WorkflowRuntimeStats:
+    """
+    按工作流记录最近若干次的执行耗时（提交到完成），用于估算排队等待时间与 ETA。
+    """
+
+    def __init__(self, window: int = 50, default_seconds: float = 60.0):
+        self.window = window
+        self.default_seconds = default_seconds
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, workflow_name: str, seconds: float):
+        """记录一次成功执行的耗时"""
+        if seconds <= 0:
+            return
+        with self._lock:
+            samples = self._samples.get(workflow_name)
+            if samples is None:
+                samples = self._samples[workflow_name] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, workflow_name: str, q: float) -> Optional[float]:
+        """获取耗时分位数（q 取 0~1），无样本时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples.get(workflow_name, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(q * (len(samples) - 1)))))
+        return samples[index]
+
+    def expected_seconds(self, workflow_name: str) -> float:
+        """预计耗时（中位数），无样本时使用默认值"""
+        p50 = self.percentile(workflow_name, 0.5)
+        return p50 if p50 is not None else self.default_seconds
+
+    def sample_count(self, workflow_name: str) -> int:
+        """已记录的样本数"""
+        with self._lock:
+            return len(self._samples.get(workflow_name, ()))
+
+    def estimate_remaining(self, workflow_name: str, elapsed: float,
+                           sampling_elapsed: float = 0.0,
+                           fraction: Optional[float] = None) -> float:
+        """
+        估算剩余秒数。
+        仅有历史数据时按“中位耗时 - 已用时”估算；收到采样进度后按采样速度外推，
+        并随进度推进逐渐提高实时外推的权重。
+
+        Args:
+            workflow_name: 工作流名称
+            elapsed: 提交以来已用时
+            sampling_elapsed: 当前采样器开始以来的用时
+            fraction: 当前采样器进度（value / max）
+        """
+        by_history = max(0.0, self.expected_seconds(workflow_name) - elapsed)
+        if not fraction or fraction < 0.05 or sampling_elapsed <= 0:
+            return by_history
+        by_progress = sampling_elapsed * (1.0 - fraction) / fraction
+        weight = min(1.0, fraction * 2)
+        return weight * by_progress + (1.0 - weight) * by_history
+
+    def poll_delay(self, workflow_name: str, elapsed: float,
+                   min_interval: float = 0.5, max_interval: float = 5.0) -> float:
+        """
+        无 WebSocket 事件时下一次轮询 /history 前的等待秒数（按该工作流的耗时分布）：
+        - 预计中位耗时（p50 的 90%）之前不轮询，直接等到该时间点
+        - p50 ~ p90 之间大多数任务完成，按 (p90 - p50) / 4 的间隔密集轮询
+        - 超过 p90 后间隔随超出时间增大（超出时间的 1/4），最长 max_interval
+        样本不足 3 个时没有可靠的分布，从 min_interval 起按已用时的 1/4 增大
+        """
+        def clamp(value: float) -> float:
+            return min(max_interval, max(min_interval, value))
+
+        if self.sample_count(workflow_name) < 3:
+            return clamp(elapsed / 4)
+        p50 = self.percentile(workflow_name, 0.5)
+        p90 = self.percentile(workflow_name, 0.9)
+        first = p50 * 0.9
+        if elapsed < first:
+            return max(min_interval, first - elapsed)
+        if elapsed < p90:
+            return clamp((p90 - p50) / 4)
+        return clamp((elapsed - p90) / 4)
+
+
+# 全局耗时统计实例（文生图使用 "text_to_image" 作为工作流名）
+runtime_stats = WorkflowRuntimeStats()
+TEXT_TO_IMAGE_WORKFLOW = "text_to_image"
+MAX_BATCH_IMAGES = 8
+
+
+def batch_workflow_name(total: int) -> str:
+    """批量文生图按总张数分别统计耗时（1 张与单次文生图共用统计）"""
+    return TEXT_TO_IMAGE_WORKFLOW if total <= 1 else f"{TEXT_TO_IMAGE_WORKFLOW}_x{total}"
+
+
 # ============================================================================
 # ComfyUI 工作流处理器
 # ============================================================================
@@ -252,6 +320,137 @@ class ComfyUIWorkflow:
         return json.loads(json.dumps(self.original_workflow))
 
 
+# ============================================================================
+# 工作流图工具
+# ============================================================================
+
+LATENT_CLASS_TYPES = ("EmptyLatentImage", "EmptySD3LatentImage")
+# 加载器节点：其模型文件输入决定了执行前需要驻留显存的模型
+LOADER_CLASS_TYPES = ("UNETLoader", "CLIPLoader", "VAELoader", "LoraLoaderModelOnly",
+                      "CheckpointLoaderSimple", "DualCLIPLoader")
+
+
+def _is_link(value) -> bool:
+    """API 格式中节点连线形如 ["节点ID", 输出序号]"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+
+_template_cache: Dict[str, Dict] = {}
+_template_lock = threading.Lock()
+
+
+def workflow_template(workflow_name: str) -> Optional[Dict]:
+    """按工作流名称读取模板（TEXT_TO_IMAGE_WORKFLOW 对应文生图配置），结果缓存，只读使用"""
+    if workflow_name == TEXT_TO_IMAGE_WORKFLOW:
+        workflow_file = config.text_to_image_config.get("workflow")
+    else:
+        workflow_file = config.workflow_configs.get(workflow_name, {}).get("workflow")
+    if not workflow_file:
+        return None
+    with _template_lock:
+        template = _template_cache.get(workflow_file)
+        if template is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflows", workflow_file)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    template = _template_cache[workflow_file] = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[ComfyUI] 读取工作流模板失败: {e}")
+                return None
+        return template
+
+
+def workflow_model_set(workflow: Dict) -> frozenset:
+    """工作流依赖的模型集合：{(加载器类型, 模型文件名), ...}"""
+    models = set()
+    for node_id in find_nodes_by_class(workflow, LOADER_CLASS_TYPES):
+        node = workflow[node_id]
+        for key, value in node.get("inputs", {}).items():
+            if key.endswith("_name") and isinstance(value, str):
+                models.add((node["class_type"], value))
+    return frozenset(models)
+
+
+def find_nodes_by_class(workflow: Dict, class_types) -> List[str]:
+    """按 class_type 查找节点ID"""
+    return [node_id for node_id, node in workflow.items() if node.get("class_type") in class_types]
+
+
+def downstream_nodes(workflow: Dict, root_ids: List[str]) -> set:
+    """返回直接或间接依赖 root_ids 的所有节点（包含 root_ids 本身）"""
+    consumers: Dict[str, List[str]] = {}
+    for node_id, node in workflow.items():
+        for value in node.get("inputs", {}).values():
+            if _is_link(value):
+                consumers.setdefault(value[0], []).append(node_id)
+    result = set()
+    stack = [str(node_id) for node_id in root_ids]
+    while stack:
+        node_id = stack.pop()
+        if node_id in result or node_id not in workflow:
+            continue
+        result.add(node_id)
+        stack.extend(consumers.get(node_id, ()))
+    return result
+
+
+def fan_out_workflow(workflow: Dict, root_ids: List[str],
+                     copies: int) -> Tuple[Dict, List[Dict[str, str]]]:
+    """
+    将依赖 root_ids 的子图复制为 copies 份，上游节点（模型加载、latent 等）由各份共享，
+    ComfyUI 在一次执行中只会加载一次模型。
+
+    Returns:
+        (新工作流, 每份的 原节点ID → 新节点ID 映射)；第 0 份沿用原节点ID
+    """
+    branch = downstream_nodes(workflow, root_ids)
+    graph = json.loads(json.dumps(workflow))
+    mappings = [{node_id: node_id for node_id in branch}]
+    next_id = max((int(node_id) for node_id in workflow if node_id.isdigit()), default=0) + 1
+    ordered = sorted(branch, key=lambda n: (not n.isdigit(), int(n) if n.isdigit() else 0, n))
+    for _ in range(1, copies):
+        mapping = {}
+        for node_id in ordered:
+            mapping[node_id] = str(next_id)
+            next_id += 1
+        for node_id in ordered:
+            node = json.loads(json.dumps(workflow[node_id]))
+            for key, value in node.get("inputs", {}).items():
+                if _is_link(value) and value[0] in mapping:
+                    node["inputs"][key] = [mapping[value[0]], value[1]]
+            graph[mapping[node_id]] = node
+        mappings.append(mapping)
+    return graph, mappings
+
+
+def workflow_iterations(cfg: Dict) -> int:
+    """工作流配置的处理迭代次数（remove_iterations，至少 1）"""
+    try:
+        return max(1, int(cfg.get("remove_iterations", 1)))
+    except (TypeError, ValueError):
+        return 1
+
+
+def output_reference(image_info: Dict) -> str:
+    """
+    /history 输出图片在 LoadImage 中的引用名：带 [output] 标注时 ComfyUI 直接从输出目录读取，
+    下一次迭代无需下载再上传
+    """
+    filename = image_info.get("filename", "")
+    subfolder = image_info.get("subfolder", "")
+    name = f"{subfolder}/{filename}" if subfolder else filename
+    return f"{name} [{image_info.get('type') or 'output'}]"
+
+
+@dataclass
+class IterationResult:
+    """多次迭代处理中一次迭代的结果"""
+    index: int                      # 第几次迭代（从 1 计）
+    total: int                      # 总迭代次数
+    seconds: float                  # 本次迭代耗时（提交到完成）
+    output: Optional[str] = None    # 中间结果图片（路径或 ImageBuffer）
+
+
 # ============================================================================
 # 工具函数
 # ============================================================================
@@ -261,30 +460,508 @@ def generate_random_seed() -> int:
     return random.randint(10**14, 10**15 - 1)
 
 
-def save_image_with_unique_name(source_path: str, target_folder: str) -> str:
-    """保存图像文件到指定文件夹，如果文件名重复则使用随机种子重命名"""
-    original_filename = os.path.basename(source_path)
+def save_image_with_unique_name(source, target_folder: str) -> str:
+    """保存图像（文件路径或 ImageBuffer）到指定文件夹，如果文件名重复则使用随机种子重命名"""
+    original_filename = source_name(source)
     file_ext = os.path.splitext(original_filename)[1]
     
     target_path = os.path.join(target_folder, original_filename)
-    
-    if not os.path.exists(target_path):
-        shutil.copy2(source_path, target_path)
-        return original_filename
-    
-    random_seed = generate_random_seed()
-    new_filename = f"{random_seed}{file_ext}"
-    target_path = os.path.join(target_folder, new_filename)
+    new_filename = original_filename
     
     while os.path.exists(target_path):
         random_seed = generate_random_seed()
         new_filename = f"{random_seed}{file_ext}"
         target_path = os.path.join(target_folder, new_filename)
     
-    shutil.copy2(source_path, target_path)
+    if isinstance(source, ImageBuffer):
+        source.save(target_path)
+    else:
+        shutil.copy2(source, target_path)
+        size = os.path.getsize(target_path)
+        disk_io.record_read(size)
+        disk_io.record_write(size)
     return new_filename
 
 
+# ============================================================================
+# 提交去重
+# ============================================================================
+
+# 确定性 prompt_id / client_id 的命名空间
+JOB_NAMESPACE = uuid.UUID("6f1d3c2e-8a4b-5c7d-9e0f-1a2b3c4d5e6f")
+
+
+def job_prompt_id(workflow_name: str, *params, request_id: str = None) -> Optional[str]:
+    """
+    由飞书 message_id（默认取当前请求上下文）与工作流参数派生确定性的 prompt_id。
+    同一条消息的工具重试、飞书重推（包括重启后的重推）得到相同的 prompt_id；无消息上下文时返回 None。
+    图片参数应传内容摘要（source_digest）而非文件名：重推时图片重新下载，临时文件名带时间戳会变化
+    """
+    if request_id is None:
+        request_id = get_request_id()
+    if not request_id or request_id == "-":
+        return None
+    key = json.dumps([request_id, workflow_name, list(params)], ensure_ascii=False, default=str)
+    return str(uuid.uuid5(JOB_NAMESPACE, key))
+
+
+def job_seed(job_id: Optional[str], index: int = 0) -> int:
+    """
+    任务种子：确定性任务由 prompt_id 派生（工作流与输出文件名前缀随之确定，复用已有任务时能按前缀找到其输出），
+    否则随机生成
+    """
+    if not job_id:
+        return generate_random_seed()
+    digest = hashlib.sha256(f"{job_id}:{index}".encode("utf-8")).digest()
+    return 10**14 + int.from_bytes(digest[:8], "big") % (9 * 10**14)
+
+
+def iteration_job_id(job_id: Optional[str], iteration: int) -> Optional[str]:
+    """多次迭代处理中第 iteration 次（从 1 计）提交的确定性 prompt_id"""
+    if not job_id:
+        return None
+    return str(uuid.uuid5(JOB_NAMESPACE, f"{job_id}#{iteration}"))
+
+
+def execution_seconds(history_entry: Dict) -> Optional[float]:
+    """/history 条目中 execution_start 到执行结束（成功/出错/中断）的秒数，缺少时间戳时返回 None"""
+    started = ended = None
+    for message in history_entry.get("status", {}).get("messages", []) or []:
+        if not isinstance(message, (list, tuple)) or len(message) < 2 or not isinstance(message[1], dict):
+            continue
+        event, timestamp = message[0], message[1].get("timestamp")
+        if timestamp is None:
+            continue
+        if event == "execution_start":
+            started = timestamp
+        elif event in ("execution_success", "execution_error", "execution_interrupted"):
+            ended = timestamp
+    if started is None or ended is None:
+        return None
+    return max(0.0, (ended - started) / 1000)
+
+
+class SubmissionLedger:
+    """
+    任务提交台账：记录每个任务键（确定性 prompt_id，或随机 prompt_id 本身）提交到服务端的 prompt_id，
+    统计复用与重复执行
+    - attached: 提交前（或不确定的提交失败后）在服务端找到同一任务，直接复用
+    - duplicates: 同一任务已有存活的执行（排队/执行中/已成功）时又提交了一次
+      （提交前无法查询服务端、或服务端不采用客户端 prompt_id 且进程重启过时才可能发生）
+    - gpu_seconds_saved: 复用任务的执行耗时，即避免重复执行的 GPU 时间
+    - gpu_seconds_wasted: 重复提交的任务的执行耗时
+    执行耗时取自 /history 的执行时间戳，在等待任务完成时记录。
+    """
+
+    def __init__(self, max_jobs: int = 1000):
+        self.max_jobs = max_jobs
+        self._runs: "OrderedDict[str, List[str]]" = OrderedDict()  # 任务键 -> 服务端 prompt_id
+        self._attached: Dict[str, int] = {}   # prompt_id -> 尚未计入节省时间的复用次数
+        self._reused: set = set()             # 复用过的 prompt_id
+        self._duplicates: set = set()
+        self._retired: set = set()            # 执行出错或服务端已无记录的 prompt_id
+        self._measured: Dict[str, float] = {}  # prompt_id -> 执行耗时
+        self._stats = {"submitted": 0, "attached": 0, "duplicates": 0,
+                       "gpu_seconds_saved": 0.0, "gpu_seconds_wasted": 0.0}
+        self._lock = threading.Lock()
+
+    def known_runs(self, job_id: str) -> List[str]:
+        """该任务键已提交过的服务端 prompt_id"""
+        with self._lock:
+            return list(self._runs.get(job_id, ()))
+
+    def record_submitted(self, job_id: str, prompt_id: str):
+        with self._lock:
+            runs = self._track(job_id, prompt_id)
+            self._retired.discard(prompt_id)
+            self._stats["submitted"] += 1
+            live = [pid for pid in runs if pid != prompt_id and pid not in self._retired]
+            if live:
+                self._stats["duplicates"] += 1
+                self._duplicates.add(prompt_id)
+                print(f"[ComfyUI] 任务重复提交: {prompt_id}（已有 {', '.join(live)}）")
+
+    def record_attached(self, job_id: str, prompt_id: str):
+        with self._lock:
+            self._track(job_id, prompt_id)
+            self._attached[prompt_id] = self._attached.get(prompt_id, 0) + 1
+            self._reused.add(prompt_id)
+            self._stats["attached"] += 1
+            self._credit(prompt_id)
+
+    def is_attached(self, prompt_id: str) -> bool:
+        """该 prompt_id 是否为复用的已有任务（可能已在执行甚至已完成）"""
+        with self._lock:
+            return prompt_id in self._reused
+
+    def retire(self, prompt_id: str):
+        """标记该 prompt_id 执行出错或服务端已无记录，之后同一任务重新提交不算重复"""
+        with self._lock:
+            self._retired.add(prompt_id)
+
+    def record_execution(self, prompt_id: str, seconds: Optional[float]):
+        """任务成功结束时记录其执行耗时（同一 prompt_id 只记录一次）"""
+        if seconds is None:
+            return
+        with self._lock:
+            if prompt_id in self._measured:
+                return
+            self._measured[prompt_id] = seconds
+            if prompt_id in self._duplicates:
+                self._stats["gpu_seconds_wasted"] += seconds
+            self._credit(prompt_id)
+
+    def _credit(self, prompt_id: str):
+        """复用的任务执行耗时已知时计入节省时间（调用方持有锁）"""
+        seconds = self._measured.get(prompt_id)
+        if seconds is not None and self._attached.get(prompt_id):
+            self._stats["gpu_seconds_saved"] += seconds * self._attached.pop(prompt_id)
+
+    def _track(self, job_id: str, prompt_id: str) -> List[str]:
+        """（调用方持有锁）"""
+        runs = self._runs.get(job_id)
+        if runs is None:
+            runs = self._runs[job_id] = []
+            while len(self._runs) > self.max_jobs:
+                _, old_runs = self._runs.popitem(last=False)
+                for old_id in old_runs:
+                    self._attached.pop(old_id, None)
+                    self._reused.discard(old_id)
+                    self._measured.pop(old_id, None)
+                    self._duplicates.discard(old_id)
+                    self._retired.discard(old_id)
+        else:
+            self._runs.move_to_end(job_id)
+        if prompt_id not in runs:
+            runs.append(prompt_id)
+        return runs
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = dict(self._stats)
+        result["gpu_seconds_saved"] = round(result["gpu_seconds_saved"], 1)
+        result["gpu_seconds_wasted"] = round(result["gpu_seconds_wasted"], 1)
+        return result
+
+
+# 全局提交台账
+submissions = SubmissionLedger()
+
+
+# ============================================================================
+# 任务取消
+# ============================================================================
+
+def request_owners(request_id: str = None) -> frozenset:
+    """请求上下文对应的 message_id 集合（微批合并的批次为各请求 message_id 以 + 拼接）"""
+    if request_id is None:
+        request_id = get_request_id()
+    return frozenset(part for part in (request_id or "").split("+") if part and part != "-")
+
+
+@dataclass
+class ActiveJob:
+    """已提交到 ComfyUI、正在等待完成的任务"""
+    client: "ComfyUIClient"
+    prompt_id: str
+    workflow_name: str
+    owners: frozenset
+    submitted_at: float = field(default_factory=time.time)
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    wakeups: List[threading.Event] = field(default_factory=list)  # 取消时一并唤醒的等待事件
+
+    def cancel(self):
+        self.cancelled.set()
+        for event in list(self.wakeups):
+            event.set()
+
+
+class JobRegistry:
+    """
+    正在等待的 ComfyUI 任务，按 message_id 取消：
+    - 排队中的任务从 /queue 删除，正在执行的任务经 /interrupt 中断（先经 /queue 确认正在执行的是该任务，
+      请求中带 prompt_id，较新的 ComfyUI 只在匹配时中断）
+    - 微批合并的任务只有全部所属请求都取消时才从服务端撤下
+    - 本地等待立即返回；取消后同一请求不再提交新任务
+    - 统计撤下的任务数与释放的 GPU 排队时间（按工作流历史耗时估算）
+    """
+
+    def __init__(self, cancelled_ttl: float = 600.0):
+        self.cancelled_ttl = cancelled_ttl
+        self._jobs: Dict[str, ActiveJob] = {}
+        self._cancelled: Dict[str, float] = {}  # message_id -> 取消时间
+        self._stats = {"cancel_requests": 0, "deleted": 0, "interrupted": 0, "reclaimed_seconds": 0.0}
+        self._lock = threading.Lock()
+
+    def is_cancelled(self, request_id: str = None) -> bool:
+        """请求（默认当前上下文）是否已被取消；合并批次要求全部所属请求都已取消"""
+        owners = request_owners(request_id)
+        with self._lock:
+            return bool(owners) and all(owner in self._cancelled for owner in owners)
+
+    def jobs_of(self, request_id: str) -> List[ActiveJob]:
+        owners = request_owners(request_id)
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owners & owners]
+
+    def register(self, client: "ComfyUIClient", prompt_id: str, workflow_name: str,
+                 request_id: str = None) -> ActiveJob:
+        job = ActiveJob(client, prompt_id, workflow_name, request_owners(request_id))
+        with self._lock:
+            self._jobs[prompt_id] = job
+        # 提交过程中请求已被取消：立即撤下
+        if self.is_cancelled(request_id):
+            self._withdraw([job])
+        return job
+
+    def unregister(self, job: ActiveJob):
+        with self._lock:
+            if self._jobs.get(job.prompt_id) is job:
+                del self._jobs[job.prompt_id]
+
+    def cancel(self, request_id: str) -> Dict:
+        """
+        取消请求的全部任务
+        Returns:
+            {"jobs": 撤下的任务数, "deleted": 从队列删除数, "interrupted": 中断数,
+             "shared": 与其他请求合并、仍在执行的任务数, "reclaimed_seconds": 释放的 GPU 时间估算}
+        """
+        owners = request_owners(request_id)
+        now = time.time()
+        with self._lock:
+            for owner in owners:
+                self._cancelled[owner] = now
+            for owner in [o for o, t in self._cancelled.items() if now - t > self.cancelled_ttl]:
+                del self._cancelled[owner]
+            related = [job for job in self._jobs.values() if job.owners & owners]
+            withdraw = [job for job in related if all(o in self._cancelled for o in job.owners)]
+            self._stats["cancel_requests"] += 1
+        report = self._withdraw(withdraw)
+        report["shared"] = len(related) - len(withdraw)
+        return report
+
+    def _withdraw(self, jobs: List[ActiveJob]) -> Dict:
+        """从服务端撤下任务并唤醒本地等待"""
+        report = {"jobs": 0, "deleted": 0, "interrupted": 0, "reclaimed_seconds": 0.0}
+        by_endpoint: Dict[str, List[ActiveJob]] = {}
+        for job in jobs:
+            by_endpoint.setdefault(job.client.api_url, []).append(job)
+        for group in by_endpoint.values():
+            try:
+                deleted, interrupted = group[0].client.cancel_prompts([job.prompt_id for job in group])
+            except Exception as e:
+                print(f"[ComfyUI] 撤下任务失败: {e}")
+                deleted, interrupted = [], []
+            now = time.time()
+            for job in group:
+                expected = runtime_stats.expected_seconds(job.workflow_name)
+                if job.prompt_id in deleted:
+                    report["deleted"] += 1
+                    report["reclaimed_seconds"] += expected
+                elif job.prompt_id in interrupted:
+                    report["interrupted"] += 1
+                    report["reclaimed_seconds"] += max(0.0, expected - (now - job.submitted_at))
+                job.cancel()
+        report["jobs"] = report["deleted"] + report["interrupted"]
+        with self._lock:
+            for key in ("deleted", "interrupted", "reclaimed_seconds"):
+                self._stats[key] += report[key]
+        if report["jobs"]:
+            print(f"[ComfyUI] 已撤下 {report['jobs']} 个任务（删除排队 {report['deleted']} 个，"
+                  f"中断执行 {report['interrupted']} 个），释放约 {report['reclaimed_seconds']:.0f} 秒 GPU 时间")
+        return report
+
+    def stats(self) -> Dict:
+        with self._lock:
+            result = dict(self._stats)
+            result["active"] = len(self._jobs)
+        result["reclaimed_seconds"] = round(result["reclaimed_seconds"], 1)
+        return result
+
+
+# 全局任务登记
+active_jobs = JobRegistry()
+
+
+# ============================================================================
+# 任务完成监视
+# ============================================================================
+
+@dataclass
+class _Watch:
+    """监视中的 prompt_id（同一任务的多个等待方共用）"""
+    workflow_name: str
+    registered_at: float
+    due: float                     # 下一次需要查询该任务的时间
+    max_interval: float
+    future: Future = field(default_factory=Future)
+    waiters: int = 1
+
+
+class CompletionWatcher:
+    """
+    每个服务器一个后台线程，监视所有已提交任务的完成状态：
+    - watch(prompt_id) 返回 Future，任务完成或执行出错时以其 /history 条目完成（调用方可阻塞等待或 add_done_callback）
+    - 各任务按 runtime_stats.poll_delay 计算下一次查询时间，最早到期的任务到期时一次 GET /history?max_items=N
+      查询全部任务（N 随监视中的任务数增长），两次请求至少间隔 min_interval
+    - 批量结果条数达到 N 时较早完成的任务可能被挤出：先查询一次 /queue，不在队列中的到期任务再单独查询 /history/{id}
+    - nudge(prompt_id) 使任务立即到期（WebSocket 报告执行结束时调用）
+    线程数与请求频率不随并发任务数增长。
+    """
+
+    def __init__(self, api_url: str, min_interval: float = 0.5, min_items: int = 16, max_items: int = 256):
+        self.api_url = api_url
+        self.min_interval = min_interval
+        self.min_items = min_items
+        self.max_items = max_items
+        self._watches: Dict[str, _Watch] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._fetched_at = 0.0
+        self._stats = {"watched": 0, "resolved": 0, "batch_fetches": 0, "queue_fetches": 0,
+                       "single_fetches": 0, "errors": 0}
+
+    def watch(self, prompt_id: str, workflow_name: str = "", max_interval: float = 5.0,
+              immediate: bool = False) -> Future:
+        """
+        开始监视任务，返回以 /history 条目完成的 Future
+        Args:
+            max_interval: 该任务两次查询的最长间隔
+            immediate: 立即查询一次（复用的已有任务可能已经完成）
+        """
+        now = time.time()
+        with self._cond:
+            watch = self._watches.get(prompt_id)
+            if watch is None:
+                due = now if immediate else now + runtime_stats.poll_delay(workflow_name, 0.0,
+                                                                            max_interval=max_interval)
+                watch = self._watches[prompt_id] = _Watch(workflow_name, now, due, max_interval)
+                self._stats["watched"] += 1
+            else:
+                watch.waiters += 1
+                watch.max_interval = min(watch.max_interval, max_interval)
+                if immediate:
+                    watch.due = now
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="comfyui-watcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return watch.future
+
+    def forget(self, prompt_id: str):
+        """等待方放弃等待（超时或取消）；所有等待方都放弃后停止监视"""
+        with self._cond:
+            watch = self._watches.get(prompt_id)
+            if watch is None:
+                return
+            watch.waiters -= 1
+            if watch.waiters <= 0:
+                del self._watches[prompt_id]
+
+    def nudge(self, prompt_id: str):
+        """使任务立即到期"""
+        with self._cond:
+            watch = self._watches.get(prompt_id)
+            if watch is not None:
+                watch.due = time.time()
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    due = min((watch.due for watch in self._watches.values()), default=None)
+                    if due is not None:
+                        due = max(due, self._fetched_at + self.min_interval)
+                        if due <= now:
+                            break
+                    self._cond.wait(None if due is None else due - now)
+                watches = dict(self._watches)
+                limit = min(self.max_items, max(self.min_items, 2 * len(watches)))
+            try:
+                self._poll(watches, limit)
+            except Exception as e:
+                with self._cond:
+                    self._fetched_at = time.time()
+                    self._stats["errors"] += 1
+                print(f"[ComfyUI] 查询任务状态失败: {e}")
+            self._reschedule()
+
+    def _poll(self, watches: Dict[str, _Watch], limit: int):
+        """查询一轮并完成已结束的任务"""
+        history = self._get(f"/history?max_items={limit}")
+        with self._cond:
+            self._fetched_at = time.time()
+            self._stats["batch_fetches"] += 1
+        missing = [prompt_id for prompt_id, watch in watches.items()
+                   if prompt_id not in history and watch.due <= self._fetched_at]
+        if missing and len(history) >= limit:
+            queue = self._get("/queue")
+            with self._cond:
+                self._stats["queue_fetches"] += 1
+            queued = {item[1] for key in ("queue_running", "queue_pending")
+                      for item in queue.get(key, []) if len(item) > 1}
+            for prompt_id in missing:
+                if prompt_id not in queued:
+                    with self._cond:
+                        self._stats["single_fetches"] += 1
+                    history.update(self._get(f"/history/{prompt_id}"))
+        for prompt_id, watch in watches.items():
+            entry = history.get(prompt_id)
+            status = (entry or {}).get("status", {})
+            if entry and (status.get("completed", False) or status.get("status_str") == "error"):
+                self._resolve(prompt_id, watch, entry)
+
+    def _resolve(self, prompt_id: str, watch: _Watch, entry: Dict):
+        with self._cond:
+            if self._watches.get(prompt_id) is watch:
+                del self._watches[prompt_id]
+            self._stats["resolved"] += 1
+        if not watch.future.done():
+            watch.future.set_result(entry)
+
+    def _reschedule(self):
+        """为到期但未完成的任务计算下一次查询时间"""
+        with self._cond:
+            now = time.time()
+            for watch in self._watches.values():
+                if watch.due <= now:
+                    watch.due = now + runtime_stats.poll_delay(watch.workflow_name, now - watch.registered_at,
+                                                               max_interval=watch.max_interval)
+
+    def _get(self, path: str) -> Dict:
+        from urllib import request
+        with request.urlopen(f"{self.api_url}{path}", timeout=5) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def stats(self) -> Dict:
+        with self._cond:
+            result = dict(self._stats)
+            result["watching"] = len(self._watches)
+        return result
+
+
+_watchers: Dict[str, CompletionWatcher] = {}
+_watchers_lock = threading.Lock()
+
+
+def completion_watcher(api_url: str) -> CompletionWatcher:
+    """服务器对应的 CompletionWatcher（按 api_url 共享）"""
+    with _watchers_lock:
+        watcher = _watchers.get(api_url)
+        if watcher is None:
+            watcher = _watchers[api_url] = CompletionWatcher(api_url)
+        return watcher
+
+
+def polling_stats() -> Dict[str, Dict]:
+    """各服务器的任务完成监视统计（batch_fetches + queue_fetches + single_fetches 为实际请求数）"""
+    with _watchers_lock:
+        watchers = list(_watchers.values())
+    return {watcher.api_url: watcher.stats() for watcher in watchers}
+
+
 # ============================================================================
 # ComfyUI 客户端
 # ============================================================================
@@ -292,14 +969,40 @@ def save_image_with_unique_name(source_path: str, target_folder: str) -> str:
 class ComfyUIClient:
     """ComfyUI 客户端"""
     
+    # 服务端是否采用客户端生成的 prompt_id（None 表示尚未确认）
+    _client_prompt_ids: Optional[bool] = None
+    
     def __init__(self, api_url: str = None):
         """
         初始化 ComfyUI 客户端
         :param api_url: ComfyUI API 地址，如 http://127.0.0.1:8188
         """
+        config.ensure_folders()
         self.api_url = api_url or config.api_url
+        self.client_id = uuid.uuid4().hex  # WebSocket 进度消息按 clientId 推送
         self._running = False
         self._process = None
+        # 连接失败时的回调 on_unreachable(api_url)，由 EndpointResolver.report_failure 设置
+        self.on_unreachable: Optional[Callable[[str], None]] = None
+    
+    def pinned(self, job_id: Optional[str] = None) -> "ComfyUIClient":
+        """
+        固定在当前端点上的客户端副本：一次任务的上传、提交、轮询与下载都使用同一个 api_url，
+        期间活动端点切换（self.api_url 被修改）不影响已开始的任务。
+        传入确定性任务的 job_id 时 client_id 也由其派生，重启后复用已有任务仍能收到它的 WebSocket 进度
+        """
+        client = copy.copy(self)
+        client.api_url = self.api_url
+        if job_id:
+            client.client_id = uuid.uuid5(JOB_NAMESPACE, job_id).hex
+        return client
+    
+    def _report_unreachable(self):
+        if self.on_unreachable:
+            try:
+                self.on_unreachable(self.api_url)
+            except Exception as e:
+                print(f"[ComfyUI] 上报端点不可达失败: {e}")
     
     @property
     def is_remote(self) -> bool:
@@ -319,32 +1022,36 @@ class ComfyUIClient:
         """检查服务器是否运行"""
         return self.check_server()
     
-    def check_server(self, max_attempts: int = 3, check_delay: int = 2) -> bool:
-        """检查 ComfyUI 服务器是否可访问"""
+    def check_server(self, max_attempts: int = 3, check_delay: float = 0.5) -> bool:
+        """
+        检查 ComfyUI 服务器是否可访问
+        失败时按指数退避重试（check_delay 为初始退避秒数）；该端点熔断期间直接返回 False
+        """
         try:
             import requests as req_lib
         except ImportError:
             return False
         
-        for attempt in range(max_attempts):
-            try:
-                resp = req_lib.get(f"{self.api_url}/system_stats", timeout=3, proxies=self.proxies)
-                if resp.status_code == 200:
-                    return True
-            except Exception:
-                if attempt < max_attempts - 1:
-                    time.sleep(check_delay)
-                else:
-                    return False
-        return False
+        policy = replace(POLICIES["comfyui"], attempts=max_attempts, base_delay=check_delay)
+        try:
+            resp = resilience.call(
+                lambda: req_lib.get(f"{self.api_url}/system_stats", timeout=3, proxies=self.proxies),
+                "comfyui", endpoint_of(self.api_url), policy=policy,
+                retry_result=lambda r: r.status_code != 200)
+        except CircuitOpenError:
+            return False
+        except Exception:
+            self._report_unreachable()
+            return False
+        return resp.status_code == 200
 
-    def upload_image(self, image_path: str, subfolder: str = "", overwrite: bool = True) -> Optional[str]:
+    def upload_image(self, image_path, subfolder: str = "", overwrite: bool = True) -> Optional[str]:
         """
         通过 HTTP API 上传图片到 ComfyUI 服务器。
         本地和远程服务器均可使用，远程时必须用此方法。
 
         Args:
-            image_path: 本地图片路径
+            image_path: 本地图片路径或 ImageBuffer
             subfolder: 子目录（如 "FeiShuBot"）
             overwrite: 是否覆盖同名文件
 
@@ -362,10 +1069,11 @@ class ComfyUIClient:
             print("[ComfyUI] requests 库未安装，无法上传图片到远程服务器")
             return None
 
-        filename = os.path.basename(image_path)
+        filename = source_name(image_path)
 
-        try:
-            with open(image_path, 'rb') as f:
+        def post():
+            # 每次重试重新打开数据源，multipart 流不能重复读取
+            with open_source(image_path) as f:
                 form = {
                     'image': (filename, f, 'application/octet-stream'),
                     'subfolder': ('', subfolder),
@@ -374,7 +1082,7 @@ class ComfyUIClient:
                 multi_form = MultipartEncoder(form)
 
                 headers = {'Content-Type': multi_form.content_type}
-                response = requests.post(
+                return requests.post(
                     f"{self.api_url}/upload/image",
                     headers=headers,
                     data=multi_form,
@@ -382,6 +1090,10 @@ class ComfyUIClient:
                     proxies=self.proxies
                 )
 
+        try:
+            # 同名覆盖上传，重复执行无副作用
+            response = resilience.call(post, "comfyui", endpoint_of(self.api_url), retry_result=retry_status)
+
             if response.status_code != 200:
                 print(f"[ComfyUI] 上传图片失败: HTTP {response.status_code}")
                 return None
@@ -396,7 +1108,7 @@ class ComfyUIClient:
             return None
 
     def download_output(self, filename: str, subfolder: str = "",
-                        local_save_path: str = None) -> Optional[str]:
+                        local_save_path: str = None, in_memory: bool = False):
         """
         通过 HTTP API 从 ComfyUI 服务器下载输出图片。
 
@@ -404,9 +1116,10 @@ class ComfyUIClient:
             filename: 远程文件名
             subfolder: 子目录
             local_save_path: 本地保存路径（含文件名），默认保存到 output_folder
+            in_memory: 远程下载时返回 ImageBuffer 而不写入本地文件
 
         Returns:
-            str: 本地文件路径，失败返回 None
+            本地文件路径或 ImageBuffer，失败返回 None
         """
         # 本地模式：直接检查本地文件
         if not self.is_remote:
@@ -424,23 +1137,25 @@ class ComfyUIClient:
                 "subfolder": subfolder,
                 "type": "output",
             }
-            response = req_lib.get(
-                f"{self.api_url}/view",
-                params=params,
-                timeout=60,
-                proxies=self.proxies
-            )
+            response = resilience.call(
+                lambda: req_lib.get(f"{self.api_url}/view", params=params, timeout=60, proxies=self.proxies),
+                "comfyui", endpoint_of(self.api_url), retry_result=retry_status)
 
             if response.status_code != 200:
                 print(f"[ComfyUI] 下载图片失败: HTTP {response.status_code}")
                 return None
 
+            if in_memory:
+                print(f"[ComfyUI] 图片下载成功: {filename} ({len(response.content)} bytes，内存)")
+                return ImageBuffer.from_bytes(response.content, filename)
+
             if not local_save_path:
                 os.makedirs(config.output_folder, exist_ok=True)
                 local_save_path = os.path.join(config.output_folder, filename)
 
             with open(local_save_path, 'wb') as f:
                 f.write(response.content)
+            disk_io.record_write(len(response.content))
 
             print(f"[ComfyUI] 图片下载成功: {local_save_path}")
             return local_save_path
@@ -529,94 +1244,212 @@ class ComfyUIClient:
             self._running = False
     
     def queue_prompt(self, prompt_workflow: Dict, max_retries: int = 3,
-                    retry_delay: int = 2) -> Optional[str]:
-        """将 prompt workflow 发送到 ComfyUI 服务器并排队执行"""
+                    retry_delay: float = 0.5, job_id: Optional[str] = None) -> Optional[str]:
+        """
+        将 prompt workflow 发送到 ComfyUI 服务器并排队执行
+        
+        请求中带客户端生成的 prompt_id。确认服务端采用客户端 prompt_id 之前，只在请求确定未发出时重试；
+        确认之后，超时等不确定的失败在重试前先按该 prompt_id 查询 /history 与 /queue，
+        已入队则直接使用，不会重复提交同一个任务。
+        
+        job_id 为确定性 prompt_id（见 job_prompt_id）：提交前先查询该任务（以及本进程内同一任务提交过的 prompt_id）
+        是否已在服务端排队、执行或成功完成，是则直接复用，不再提交；之前的执行出错时改用新的 prompt_id 重新提交。
+        """
         try:
             from urllib import request, error as urllib_error
         except ImportError:
             print("[ComfyUI] urllib 不可用")
             return None
         
-        p = {"prompt": prompt_workflow}
+        prompt_id = str(uuid.uuid4())
+        if job_id:
+            existing, failed = self._find_existing_run(job_id)
+            if existing:
+                return existing
+            if not failed and ComfyUIClient._client_prompt_ids is not False:
+                prompt_id = job_id
+        ledger_key = job_id or prompt_id
+        
+        p = {"prompt": prompt_workflow, "client_id": self.client_id, "prompt_id": prompt_id}
         data = json.dumps(p).encode('utf-8')
         req = request.Request(f"{self.api_url}/prompt", data=data)
+        idempotent = ComfyUIClient._client_prompt_ids is True
         
-        for attempt in range(max_retries):
+        def submit():
+            print(f"    正在提交工作流...")
+            response = request.urlopen(req, timeout=10)
+            return json.loads(response.read().decode('utf-8')).get('prompt_id')
+        
+        def already_queued(error):
+            if is_not_sent(error):
+                return None
+            # 无法确认时 run_state 抛出异常，放弃重试
+            if self.run_state(prompt_id) is None:
+                return None
+            submissions.record_attached(ledger_key, prompt_id)
+            return prompt_id
+        
+        policy = replace(POLICIES["comfyui"], attempts=max_retries, base_delay=retry_delay)
+        try:
+            returned_id = resilience.call(submit, "comfyui", endpoint_of(self.api_url), idempotent=idempotent,
+                                          before_retry=already_queued if idempotent else None, policy=policy)
+        except urllib_error.HTTPError as e:
+            print(f"    工作流被拒绝: HTTP {e.code} - {e.read()[:300]!r}")
+            return None
+        except Exception as e:
+            print(f"    发送失败: {e}")
+            if not isinstance(e, CircuitOpenError):
+                self._report_unreachable()
+            return None
+        
+        if returned_id:
+            # 服务端是否采用客户端生成的 prompt_id（较旧的 ComfyUI 会忽略该字段）
+            ComfyUIClient._client_prompt_ids = returned_id == prompt_id
+            submissions.record_submitted(ledger_key, returned_id)
+        print(f"    工作流已提交，prompt_id: {returned_id}")
+        return returned_id
+    
+    def _find_existing_run(self, job_id: str) -> Tuple[Optional[str], bool]:
+        """
+        查找服务端已有的同一任务：依次检查确定性 prompt_id 与本进程内该任务提交过的 prompt_id
+        Returns:
+            (可复用的 prompt_id 或 None, 是否找到执行出错的记录)
+        """
+        candidates = [job_id] if ComfyUIClient._client_prompt_ids is not False else []
+        candidates += [pid for pid in submissions.known_runs(job_id) if pid not in candidates]
+        failed = False
+        for candidate in reversed(candidates):
             try:
-                print(f"    正在提交工作流...")
-                response = request.urlopen(req, timeout=10)
-                result = json.loads(response.read().decode('utf-8'))
-                prompt_id = result.get('prompt_id')
-                print(f"    工作流已提交，prompt_id: {prompt_id}")
-                return prompt_id
-            except urllib_error.URLError as e:
-                print(f"    URL错误 (尝试 {attempt + 1}/{max_retries}): {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                else:
-                    return None
+                state = self.run_state(candidate)
             except Exception as e:
-                print(f"    发送失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
-                else:
-                    return None
+                print(f"    查询已有任务失败，按新任务提交: {e}")
+                return None, failed
+            if state in (None, "error"):
+                submissions.retire(candidate)
+                failed = failed or state == "error"
+            else:
+                submissions.record_attached(job_id, candidate)
+                print(f"    服务端已有该任务（{state}），复用 prompt_id: {candidate}")
+                return candidate, failed
+        return None, failed
+    
+    def run_state(self, prompt_id: str) -> Optional[str]:
+        """
+        按 prompt_id 查询任务在服务端的状态（/history 与 /queue）：
+        "success" / "error" / "running" / "pending"，服务端没有该任务时返回 None，查询失败时抛出异常
+        """
+        from urllib import request
+        with request.urlopen(f"{self.api_url}/history/{prompt_id}", timeout=5) as response:
+            entry = json.loads(response.read().decode('utf-8')).get(prompt_id)
+        if entry:
+            status = entry.get('status', {})
+            if status.get('completed', False):
+                return "success"
+            if status.get('status_str') == "error":
+                return "error"
+        with request.urlopen(f"{self.api_url}/queue", timeout=5) as response:
+            queue = json.loads(response.read().decode('utf-8'))
+        for state, key in (("running", "queue_running"), ("pending", "queue_pending")):
+            if any(len(item) > 1 and item[1] == prompt_id for item in queue.get(key, [])):
+                return state
+        return None
+    
+    def cancel_prompts(self, prompt_ids: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        从服务端撤下任务：排队中的经 /queue 删除，正在执行的经 /interrupt 中断
+        （只中断经 /queue 确认正在执行的本方任务，请求带 prompt_id）
+        Returns:
+            (已删除的 prompt_id, 已中断的 prompt_id)
+        """
+        from urllib import request
+        wanted = set(prompt_ids)
+        with request.urlopen(f"{self.api_url}/queue", timeout=5) as response:
+            queue = json.loads(response.read().decode('utf-8'))
+        pending = [item[1] for item in queue.get("queue_pending", []) if len(item) > 1 and item[1] in wanted]
+        running = [item[1] for item in queue.get("queue_running", []) if len(item) > 1 and item[1] in wanted]
+
+        def post(path: str, payload: Dict):
+            req = request.Request(f"{self.api_url}{path}", data=json.dumps(payload).encode('utf-8'),
+                                  headers={"Content-Type": "application/json"})
+            request.urlopen(req, timeout=5).close()
+
+        if pending:
+            post("/queue", {"delete": pending})
+        for prompt_id in running:
+            post("/interrupt", {"prompt_id": prompt_id})
+        return pending, running
     
     def wait_for_completion(self, prompt_id: str, check_interval: int = 5,
-                          timeout: int = 120) -> bool:
-        """轮询检查任务完成状态"""
-        try:
-            from urllib import request, error as urllib_error
-        except ImportError:
-            return False
-        
+                          timeout: int = 120,
+                          on_progress: Optional[Callable[["ProgressEvent"], None]] = None,
+                          workflow_name: str = "", job: Optional[ActiveJob] = None) -> bool:
+        """
+        等待任务完成
+
+        任务交给该服务器的 CompletionWatcher 监视（后台线程批量查询 /history，轮询间隔按该工作流的耗时分布决定，
+        最长 check_interval），本线程只等待其 Future，不发起请求；复用的已有任务提交后立即检查一次。
+        传入 on_progress 时同时监听 ComfyUI 的 WebSocket 进度事件并回调（节流由调用方负责），
+        WebSocket 报告执行结束时立即查询，不必等满轮询间隔。
+        传入 job（JobRegistry 登记的任务）时，任务被取消后立即返回 False。
+        """
         start_time = time.time()
-        check_count = 0
-        initial_interval = 15
-        initial_phase = True
+        last_report = start_time
+        watcher = completion_watcher(self.api_url)
+        future = watcher.watch(prompt_id, workflow_name, max_interval=check_interval,
+                               immediate=submissions.is_attached(prompt_id))
+        wakeup = threading.Event()
+        future.add_done_callback(lambda _: wakeup.set())
+        if job:
+            job.wakeups.append(wakeup)
+        monitor = None
+        nudged = False
+        if on_progress:
+            monitor = ComfyUIProgressMonitor(self, prompt_id, workflow_name, on_progress, start_time)
+            monitor.start()
         
-        while time.time() - start_time < timeout:
-            check_count += 1
-            current_interval = initial_interval if initial_phase else check_interval
-            
-            try:
-                req = request.Request(f"{self.api_url}/history/{prompt_id}")
-                response = request.urlopen(req, timeout=5)
-                result = json.loads(response.read().decode('utf-8'))
-                
-                if prompt_id in result:
-                    history_data = result[prompt_id]
-                    status = history_data.get('status', {}).get('completed', False)
-                    if status:
-                        print(f"    任务已完成 (耗时: {int(time.time() - start_time)}秒)")
-                        return True
-                    
-                    exec_info = history_data.get('status', {}).get('exec_info', None)
-                    if exec_info and 'error' in str(exec_info).lower():
-                        print(f"    任务执行出错: {exec_info}")
-                        return False
-                
-                if check_count % 5 == 0:
-                    elapsed = int(time.time() - start_time)
-                    print(f"    等待任务完成... (已等待 {elapsed}秒)")
-                
-            except urllib_error.HTTPError as e:
-                if e.code == 404:
-                    if check_count <= 3 or check_count % 10 == 0:
-                        print(f"    任务尚未开始 (检查次数: {check_count})")
-                    pass
-                else:
-                    print(f"    HTTP错误: {e.code} - {e}")
-            except Exception as e:
-                print(f"    检查状态时出错: {e}")
-            
-            if time.time() - start_time >= 30:
-                initial_phase = False
+        try:
+            while not future.done():
+                if job and job.cancelled.is_set():
+                    print(f"    任务已取消")
+                    if monitor:
+                        monitor.finish(False)
+                    return False
+                elapsed = time.time() - start_time
+                if elapsed >= timeout:
+                    print(f"    等待超时 (超过 {timeout} 秒)")
+                    if monitor:
+                        monitor.finish(False)
+                    return False
+                if monitor:
+                    monitor.tick()
+                    if monitor.finished.is_set() and not nudged:
+                        watcher.nudge(prompt_id)
+                        nudged = True
+                if time.time() - last_report >= 10:
+                    last_report = time.time()
+                    print(f"    等待任务完成... (已等待 {int(last_report - start_time)}秒)")
+                # 有进度监听时每秒醒来一次刷新进度与检查 WebSocket 结束事件，否则只在完成、取消或超时时醒来
+                wakeup.wait(min(timeout - elapsed, 1.0 if monitor else 10.0))
             
-            time.sleep(current_interval)
-        
-        print(f"    等待超时 (超过 {timeout} 秒)")
-        return False
+            history_data = future.result()
+            status = history_data.get('status', {})
+            if status.get('completed', False):
+                print(f"    任务已完成 (耗时: {int(time.time() - start_time)}秒)")
+                submissions.record_execution(prompt_id, execution_seconds(history_data))
+                if monitor:
+                    monitor.finish(True)
+                return True
+            print(f"    任务执行出错: {status.get('exec_info') or status.get('messages')}")
+            if monitor:
+                monitor.finish(False)
+            return False
+        finally:
+            if not future.done():
+                watcher.forget(prompt_id)
+            if job and wakeup in job.wakeups:
+                job.wakeups.remove(wakeup)
+            if monitor:
+                monitor.stop()
     
     def find_output_file(self, search_pattern: str, output_folder: str = None) -> Optional[str]:
         """查找输出文件"""
@@ -663,17 +1496,207 @@ class ComfyUIClient:
         return None
 
 
+# ============================================================================
+# 执行进度监听
+# ============================================================================
+
+@dataclass
+class ProgressEvent:
+    """一次执行进度快照"""
+    prompt_id: str
+    stage: str                      # queued / running / finished / failed
+    elapsed: float                  # 提交以来已用时（秒）
+    eta_seconds: float              # 预计剩余秒数
+    node: Optional[str] = None      # 当前执行节点
+    value: int = 0                  # 当前采样步数
+    max: int = 0                    # 采样总步数
+    queue_remaining: Optional[int] = None
+
+    @property
+    def percent(self) -> float:
+        """整体进度估算（0~100），由已用时与预计剩余时间换算"""
+        if self.stage == "finished":
+            return 100.0
+        total = self.elapsed + self.eta_seconds
+        if total <= 0:
+            return 0.0
+        return min(99.0, 100.0 * self.elapsed / total)
+
+
+class ComfyUIProgressMonitor:
+    """
+    监听 ComfyUI WebSocket（/ws?clientId=...）推送的执行事件：
+    status（队列剩余）、execution_start、executing（当前节点，node 为空表示结束）、
+    progress（采样步数 value/max）、execution_error。
+    websocket-client 未安装或连接失败时退化为仅按历史耗时估算进度。
+    """
+
+    def __init__(self, client: "ComfyUIClient", prompt_id: str, workflow_name: str,
+                 callback: Callable[[ProgressEvent], None], start_time: float = None):
+        self.client = client
+        self.prompt_id = prompt_id
+        self.workflow_name = workflow_name
+        self.callback = callback
+        self.start_time = start_time or time.time()
+        self.finished = threading.Event()
+        self._stage = "queued"
+        self._node: Optional[str] = None
+        self._value = 0
+        self._max = 0
+        self._sampling_started: Optional[float] = None
+        self._queue_remaining: Optional[int] = None
+        self._ws = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def ws_url(self) -> str:
+        url = self.client.api_url.rstrip("/")
+        if url.startswith("https://"):
+            url = "wss://" + url[len("https://"):]
+        elif url.startswith("http://"):
+            url = "ws://" + url[len("http://"):]
+        return f"{url}/ws?clientId={self.client.client_id}"
+
+    def start(self) -> bool:
+        """启动后台监听线程，websocket-client 不可用时返回 False"""
+        try:
+            import websocket
+        except ImportError:
+            print("[ComfyUI] websocket-client 未安装，进度仅按历史耗时估算")
+            return False
+        self._thread = threading.Thread(target=self._run, args=(websocket,),
+                                        name=f"comfyui-progress-{self.prompt_id[:8]}", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """停止监听并关闭连接"""
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def tick(self):
+        """按当前状态回调一次（没有新的 WebSocket 事件时也能刷新已用时/剩余时间）"""
+        self._emit()
+
+    def finish(self, success: bool):
+        """由轮询结果确定最终状态并回调"""
+        with self._lock:
+            self._stage = "finished" if success else "failed"
+        self.finished.set()
+        self._emit()
+
+    # ---- 内部实现 ----
+
+    def _snapshot(self) -> ProgressEvent:
+        now = time.time()
+        with self._lock:
+            elapsed = now - self.start_time
+            fraction = self._value / self._max if self._max else None
+            sampling_elapsed = now - self._sampling_started if self._sampling_started else 0.0
+            if self._stage in ("finished", "failed"):
+                eta = 0.0
+            else:
+                eta = runtime_stats.estimate_remaining(
+                    self.workflow_name, elapsed, sampling_elapsed, fraction)
+            return ProgressEvent(prompt_id=self.prompt_id, stage=self._stage, elapsed=elapsed,
+                                 eta_seconds=eta, node=self._node, value=self._value,
+                                 max=self._max, queue_remaining=self._queue_remaining)
+
+    def _emit(self):
+        try:
+            self.callback(self._snapshot())
+        except Exception as e:
+            print(f"[ComfyUI] 进度回调异常: {e}")
+
+    def _run(self, websocket):
+        try:
+            self._ws = websocket.create_connection(self.ws_url, timeout=10)
+        except Exception as e:
+            print(f"[ComfyUI] 进度 WebSocket 连接失败，仅按历史耗时估算: {e}")
+            return
+        self._ws.settimeout(1)
+        try:
+            while not self._stopped.is_set():
+                try:
+                    message = self._ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if isinstance(message, bytes):
+                    continue  # 预览图等二进制帧
+                if self._handle(json.loads(message)):
+                    self._emit()
+        except Exception as e:
+            if not self._stopped.is_set():
+                print(f"[ComfyUI] 进度 WebSocket 中断: {e}")
+        finally:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+
+    def _handle(self, message: Dict) -> bool:
+        """更新内部状态，返回是否需要回调"""
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if msg_type == "status":
+            remaining = data.get("status", {}).get("exec_info", {}).get("queue_remaining")
+            with self._lock:
+                if self._stage != "queued" or remaining is None:
+                    return False
+                self._queue_remaining = remaining
+            return True
+        if data.get("prompt_id") != self.prompt_id:
+            return False
+        with self._lock:
+            if msg_type == "execution_start":
+                self._stage = "running"
+            elif msg_type == "executing":
+                if data.get("node") is None:
+                    self._stage = "finished"
+                    self.finished.set()
+                else:
+                    self._stage = "running"
+                    self._node = data.get("node")
+            elif msg_type == "progress":
+                value, maximum = int(data.get("value", 0)), int(data.get("max", 0))
+                # 新的采样器开始（步数回到起点或节点变化）时重新计时
+                if self._sampling_started is None or value < self._value or data.get("node") != self._node:
+                    self._sampling_started = time.time()
+                self._stage = "running"
+                self._node = data.get("node", self._node)
+                self._value, self._max = value, maximum
+            elif msg_type == "execution_error":
+                self._stage = "failed"
+                self.finished.set()
+            else:
+                return False
+        return True
+
+
 # ============================================================================
 # 图像处理器
 # ============================================================================
 
 class ImageProcessor:
-    """图像处理器"""
+    """
+    图像处理器
+    输入图片可以是文件路径或 ImageBuffer；in_memory=True 时远程服务器的输出以 ImageBuffer 返回，
+    本地服务器的输出本就在磁盘上，仍返回文件路径。
+    """
     
-    def __init__(self, client: ComfyUIClient = None):
+    def __init__(self, client: ComfyUIClient = None, in_memory: bool = False):
         self.client = client or ComfyUIClient()
+        self.in_memory = in_memory
     
-    def _get_remote_output(self, prompt_id: str, search_pattern: str) -> Optional[str]:
+    def _get_remote_output(self, prompt_id: str, search_pattern: str,
+                           client: ComfyUIClient = None) -> Optional[str]:
         """
         从远程 ComfyUI 服务器获取输出图片。
         通过 /history API 获取输出文件信息，再通过 /view API 下载。
@@ -681,10 +1704,12 @@ class ImageProcessor:
         Args:
             prompt_id: 工作流 prompt ID
             search_pattern: 搜索模式（seed 值）
+            client: 提交该任务的（固定端点的）客户端，默认 self.client
 
         Returns:
             str: 下载后的本地文件路径，失败返回 None
         """
+        client = client or self.client
         try:
             import requests as req_lib
         except ImportError:
@@ -694,9 +1719,9 @@ class ImageProcessor:
         try:
             # 从 history 获取输出信息
             response = req_lib.get(
-                f"{self.client.api_url}/history/{prompt_id}",
+                f"{client.api_url}/history/{prompt_id}",
                 timeout=10,
-                proxies=self.client.proxies
+                proxies=client.proxies
             )
             if response.status_code != 200:
                 print(f"[ComfyUI] 获取历史记录失败: HTTP {response.status_code}")
@@ -717,7 +1742,7 @@ class ImageProcessor:
                     subfolder = img_info.get('subfolder', '')
                     # 检查文件名是否匹配
                     if search_pattern in filename:
-                        return self.client.download_output(filename, subfolder)
+                        return client.download_output(filename, subfolder, in_memory=self.in_memory)
 
             # 如果没有精确匹配，尝试下载第一张图
             for node_id, node_output in outputs.items():
@@ -727,7 +1752,7 @@ class ImageProcessor:
                     subfolder = img_info.get('subfolder', '')
                     if filename:
                         print(f"[ComfyUI] 未精确匹配，下载第一张输出: {filename}")
-                        return self.client.download_output(filename, subfolder)
+                        return client.download_output(filename, subfolder, in_memory=self.in_memory)
 
             print("[ComfyUI] 远程输出中未找到图片")
             return None
@@ -738,14 +1763,46 @@ class ImageProcessor:
             traceback.print_exc()
             return None
     
-    def process_image(self, image_path: str, workflow_name: str) -> Optional[str]:
+    def _run_prompt(self, client: ComfyUIClient, prompt_workflow: Dict, workflow_name: str,
+                    job_id: Optional[str] = None, timeout: int = 300,
+                    on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                    record_runtime: bool = True) -> Optional[str]:
+        """
+        提交工作流并等待完成，返回 prompt_id；提交失败、执行失败、超时或被取消时返回 None。
+        等待期间任务登记在 active_jobs 中，可按 message_id 取消；请求已取消时不再提交。
+        """
+        if active_jobs.is_cancelled():
+            print("  请求已取消，不再提交")
+            return None
+        started = time.time()
+        prompt_id = client.queue_prompt(prompt_workflow, job_id=job_id)
+        if not prompt_id:
+            return None
+        job = active_jobs.register(client, prompt_id, workflow_name)
+        try:
+            if not client.wait_for_completion(prompt_id, check_interval=5, timeout=timeout,
+                                              on_progress=on_progress, workflow_name=workflow_name, job=job):
+                return None
+        finally:
+            active_jobs.unregister(job)
+        if record_runtime:
+            runtime_stats.record(workflow_name, time.time() - started)
+        return prompt_id
+    
+    def process_image(self, image_path: str, workflow_name: str,
+                      on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                      on_iteration: Optional[Callable[[IterationResult], None]] = None) -> Optional[str]:
         """
-        使用 ComfyUI 处理图像
+        使用 ComfyUI 处理图像（工作流配置 remove_iterations > 1 时迭代处理，见 _run_iterations）
         :param image_path: 图像文件路径
         :param workflow_name: 工作流名称
+        :param on_progress: 执行进度回调（可选）
+        :param on_iteration: 中间迭代结果回调（可选）
         :return: 处理后的图片路径，失败返回 None
         """
-        if not self.client.check_server():
+        job_id = job_prompt_id(workflow_name, source_digest(image_path))
+        client = self.client.pinned(job_id)
+        if not client.check_server():
             print("  ComfyUI 服务器未运行")
             return None
         
@@ -759,8 +1816,8 @@ class ImageProcessor:
         try:
             # 上传/保存图像到 ComfyUI
             print(f"  上传图像到 ComfyUI...")
-            if self.client.is_remote:
-                image_filename = self.client.upload_image(image_path, subfolder="FeiShuBot")
+            if client.is_remote:
+                image_filename = client.upload_image(image_path, subfolder="FeiShuBot")
             else:
                 image_filename = save_image_with_unique_name(image_path, config.input_folder)
             if not image_filename:
@@ -781,8 +1838,14 @@ class ImageProcessor:
             # 加载工作流
             workflow_handler.load_workflow()
             
+            iterations = workflow_iterations(cfg)
+            if iterations > 1:
+                return self._run_iterations(
+                    client, workflow_handler, workflow_name, job_id, [(image_filename, None)], iterations,
+                    on_progress, (lambda _, result: on_iteration(result)) if on_iteration else None)[0]
+            
             # 设置参数
-            seed_value = generate_random_seed()
+            seed_value = job_seed(job_id)
             prompt_workflow = workflow_handler.create_workflow_copy()
             prompt_workflow[workflow_handler.seed_id]["inputs"]["seed"] = int(seed_value)
             
@@ -790,21 +1853,18 @@ class ImageProcessor:
             prompt_workflow[workflow_handler.output_image_id]["inputs"]["filename_prefix"] = output_prefix
             prompt_workflow[workflow_handler.input_image_id]["inputs"]["image"] = image_filename
             
-            # 提交工作流
+            # 提交工作流并等待任务完成
             print(f"  正在提交工作流...")
-            prompt_id = self.client.queue_prompt(prompt_workflow)
+            prompt_id = self._run_prompt(client, prompt_workflow, workflow_name, job_id,
+                                         on_progress=on_progress)
             if not prompt_id:
                 return None
             
-            # 等待任务完成
-            if not self.client.wait_for_completion(prompt_id, check_interval=2, timeout=300):
-                return None
-            
             # 获取输出文件
-            if self.client.is_remote:
-                output_file = self._get_remote_output(prompt_id, str(seed_value))
+            if client.is_remote:
+                output_file = self._get_remote_output(prompt_id, str(seed_value), client)
             else:
-                output_file = self.client.find_output_file(str(seed_value))
+                output_file = client.find_output_file(str(seed_value))
             if output_file:
                 print(f"  处理完成: {output_file}")
                 return output_file
@@ -817,18 +1877,22 @@ class ImageProcessor:
             traceback.print_exc()
             return None
     
-    def process_text_to_image(self, prompt: str) -> Optional[str]:
+    def process_text_to_image(self, prompt: str,
+                              on_progress: Optional[Callable[[ProgressEvent], None]] = None) -> Optional[str]:
         """
         使用 ComfyUI 进行文生图
         :param prompt: 提示词
+        :param on_progress: 执行进度回调（可选）
         :return: 生成的图片路径，失败返回 None
         """
+        job_id = job_prompt_id(TEXT_TO_IMAGE_WORKFLOW, prompt)
+        client = self.client.pinned(job_id)
         text_to_image_config = config.text_to_image_config
         if not text_to_image_config:
             print("  文生图配置未找到")
             return None
         
-        if not self.client.check_server():
+        if not client.check_server():
             print("  ComfyUI 服务器未运行")
             return None
         
@@ -847,7 +1911,7 @@ class ImageProcessor:
             workflow_handler.load_workflow()
             workflow_handler.set_prompt(prompt)
             
-            seed_value = generate_random_seed()
+            seed_value = job_seed(job_id)
             workflow_handler.set_seed(seed_value)
             
             output_prefix = f"FeiShuBot\\t2i_{seed_value}"
@@ -855,18 +1919,16 @@ class ImageProcessor:
             
             prompt_workflow = workflow_handler.get_workflow()
             
-            prompt_id = self.client.queue_prompt(prompt_workflow)
+            prompt_id = self._run_prompt(client, prompt_workflow, TEXT_TO_IMAGE_WORKFLOW, job_id,
+                                         on_progress=on_progress)
             if not prompt_id:
                 return None
             
-            if not self.client.wait_for_completion(prompt_id, check_interval=2, timeout=300):
-                return None
-            
             search_pattern = f"t2i_{seed_value}"
-            if self.client.is_remote:
-                output_file = self._get_remote_output(prompt_id, search_pattern)
+            if client.is_remote:
+                output_file = self._get_remote_output(prompt_id, search_pattern, client)
             else:
-                output_file = self.client.find_output_file(search_pattern)
+                output_file = client.find_output_file(search_pattern)
             
             return output_file
             
@@ -876,16 +1938,339 @@ class ImageProcessor:
             traceback.print_exc()
             return None
     
+    def _history_outputs(self, prompt_id: str, client: ComfyUIClient = None) -> Optional[Dict]:
+        """/history 中该任务的 outputs（节点ID → 输出），获取失败时返回 None"""
+        client = client or self.client
+        try:
+            import requests as req_lib
+        except ImportError:
+            print("[ComfyUI] requests 库未安装，无法获取输出")
+            return None
+
+        try:
+            response = req_lib.get(f"{client.api_url}/history/{prompt_id}",
+                                   timeout=10, proxies=client.proxies)
+            if response.status_code != 200:
+                print(f"[ComfyUI] 获取历史记录失败: HTTP {response.status_code}")
+                return None
+            return response.json().get(prompt_id, {}).get('outputs', {})
+        except Exception as e:
+            print(f"[ComfyUI] 获取历史记录异常: {e}")
+            return None
+    
+    def _fetch_output(self, image_info: Dict, client: ComfyUIClient = None) -> Optional[str]:
+        """
+        取得一张输出图片：本地服务器直接定位输出目录中的文件，远程服务器通过 /view 下载
+        """
+        client = client or self.client
+        filename = image_info.get('filename', '')
+        subfolder = image_info.get('subfolder', '')
+        if not filename:
+            return None
+        if client.is_remote:
+            return client.download_output(filename, subfolder, in_memory=self.in_memory)
+        output_root = os.path.dirname(config.output_folder)
+        path = os.path.join(output_root, *re.split(r"[\\/]", subfolder), filename) \
+            if subfolder else os.path.join(output_root, filename)
+        if not os.path.exists(path):
+            path = client.find_output_file(os.path.splitext(filename)[0])
+        return path
+    
+    def _collect_outputs(self, prompt_id: str, node_ids: List[str],
+                         client: ComfyUIClient = None) -> List[List[str]]:
+        """
+        收集 /history 中各输出节点的全部图片，返回与 node_ids 一一对应的路径列表
+        本地服务器直接定位输出目录中的文件，远程服务器通过 /view 下载。
+        """
+        outputs = self._history_outputs(prompt_id, client)
+        if outputs is None:
+            return [[] for _ in node_ids]
+
+        groups = []
+        for node_id in node_ids:
+            files = []
+            for img_info in outputs.get(node_id, {}).get('images', []):
+                path = self._fetch_output(img_info, client)
+                if path:
+                    files.append(path)
+            groups.append(files)
+        return groups
+    
+    def _run_iterations(self, client: ComfyUIClient, workflow_handler: "ComfyUIWorkflow", workflow_name: str,
+                        job_id: Optional[str], items: List[Tuple[str, Optional[str]]], iterations: int,
+                        on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                        on_iteration: Optional[Callable[[int, IterationResult], None]] = None) -> List[Optional[str]]:
+        """
+        多次迭代处理：第 k 次的输出直接作为第 k+1 次的输入
+        每次迭代是一次独立提交（多张图片时按 fan_out_workflow 合并为一次），输入图以 [output] 标注引用
+        上一次在服务端的输出，中间结果不下载也不重新上传；模型在两次提交之间保持加载。
+        每次迭代使用独立的确定性 prompt_id，重推或重启后已完成的迭代直接复用。
+
+        Args:
+            items: [(已上传/保存的输入图文件名, 提示词或 None), ...]
+            on_iteration: 中间迭代完成时以 (items 中的序号, IterationResult) 回调，此时才下载中间结果
+        Returns:
+            与 items 一一对应的最终输出图片路径，失败的位置为 None
+        """
+        base = workflow_handler.create_workflow_copy()
+        roots = [workflow_handler.input_image_id, workflow_handler.seed_id, workflow_handler.output_image_id]
+        if workflow_handler.prompt_node_id:
+            roots.append(workflow_handler.prompt_node_id)
+        results: List[Optional[str]] = [None] * len(items)
+        inputs = {index: image for index, (image, _) in enumerate(items)}
+        timings = []
+        for iteration in range(1, iterations + 1):
+            alive = sorted(inputs)
+            round_id = iteration_job_id(job_id, iteration)
+            if len(alive) > 1:
+                prompt_workflow, mappings = fan_out_workflow(base, roots, len(alive))
+            else:
+                prompt_workflow = json.loads(json.dumps(base))
+                mappings = [{node_id: node_id for node_id in roots}]
+            
+            batch_tag = job_seed(round_id)
+            output_ids = {}
+            for position, (index, mapping) in enumerate(zip(alive, mappings)):
+                prompt = items[index][1]
+                prompt_workflow[mapping[workflow_handler.input_image_id]]["inputs"]["image"] = inputs[index]
+                prompt_workflow[mapping[workflow_handler.seed_id]]["inputs"]["seed"] = job_seed(round_id, position + 1)
+                if workflow_handler.prompt_node_id and prompt:
+                    prompt_workflow[mapping[workflow_handler.prompt_node_id]]["inputs"]["prompt"] = prompt
+                output_id = mapping[workflow_handler.output_image_id]
+                prompt_workflow[output_id]["inputs"]["filename_prefix"] = f"FeiShuBot\\{batch_tag}_{position}"
+                output_ids[index] = output_id
+            
+            print(f"  第 {iteration}/{iterations} 次迭代: 提交 {len(alive)} 张")
+            started = time.time()
+            prompt_id = self._run_prompt(client, prompt_workflow, workflow_name, round_id,
+                                         timeout=300 + 60 * (len(alive) - 1), on_progress=on_progress,
+                                         record_runtime=len(alive) == 1)
+            if not prompt_id:
+                return results
+            seconds = time.time() - started
+            timings.append(seconds)
+            print(f"  第 {iteration}/{iterations} 次迭代完成: {seconds:.1f}秒")
+            
+            outputs = self._history_outputs(prompt_id, client)
+            if outputs is None:
+                return results
+            for index in alive:
+                images = outputs.get(output_ids[index], {}).get('images', [])
+                if not images:
+                    print(f"  第 {iteration} 次迭代未产出图片（第 {index + 1} 张）")
+                    del inputs[index]
+                elif iteration == iterations:
+                    results[index] = self._fetch_output(images[0], client)
+                else:
+                    inputs[index] = output_reference(images[0])
+                    if on_iteration:
+                        try:
+                            on_iteration(index, IterationResult(iteration, iterations, seconds,
+                                                                self._fetch_output(images[0], client)))
+                        except Exception as e:
+                            print(f"  中间结果回调出错: {e}")
+            if not inputs:
+                break
+        
+        print(f"  迭代耗时: {' / '.join(f'{t:.1f}s' for t in timings)}（总计 {sum(timings):.1f}秒）")
+        return results
+    
+    def process_text_to_image_batch(self, prompts: List[str], images_per_prompt: int = 1,
+                                     on_progress: Optional[Callable[[ProgressEvent], None]] = None) -> List[str]:
+        """
+        批量文生图：一次提交生成多张图片
+        - 多个不同提示词：复制依赖提示词/种子的子图（加载器共享），每份使用独立提示词与种子
+        - 每个提示词多张：设置 latent 节点的 batch_size，同一次采样产出多张变体
+        :param prompts: 提示词列表
+        :param images_per_prompt: 每个提示词生成的图片数
+        :param on_progress: 执行进度回调（可选）
+        :return: 生成的图片路径列表（按提示词顺序），失败返回空列表
+        """
+        groups = self.process_text_to_image_grouped(prompts, images_per_prompt, on_progress)
+        return [path for group in groups for path in group]
+    
+    def process_text_to_image_grouped(self, prompts: List[str], images_per_prompt: int = 1,
+                                      on_progress: Optional[Callable[[ProgressEvent], None]] = None) -> List[List[str]]:
+        """
+        与 process_text_to_image_batch 相同，但按提示词分组返回结果（供调度器把结果分发回各个请求）
+        :return: 与 prompts 一一对应的图片路径列表，失败返回空列表
+        """
+        text_to_image_config = config.text_to_image_config
+        if not text_to_image_config:
+            print("  文生图配置未找到")
+            return []
+        
+        total = len(prompts) * images_per_prompt
+        if total <= 0:
+            return []
+        if total > MAX_BATCH_IMAGES:
+            print(f"  批量数量过多: {total} > {MAX_BATCH_IMAGES}")
+            return []
+        
+        workflow_name = batch_workflow_name(total)
+        job_id = job_prompt_id(workflow_name, list(prompts), images_per_prompt)
+        client = self.client.pinned(job_id)
+        
+        if not client.check_server():
+            print("  ComfyUI 服务器未运行")
+            return []
+        
+        try:
+            print(f"  开始批量文生图: {len(prompts)} 个提示词 x {images_per_prompt} 张")
+            
+            workflow_handler = ComfyUIWorkflow(
+                seed_id=str(text_to_image_config["seed_id"]),
+                input_image_id=None,
+                output_image_id=str(text_to_image_config["output_image_id"]),
+                workflow=text_to_image_config["workflow"],
+                prompt_node_id=text_to_image_config.get("prompt_node_id")
+            )
+            workflow_handler.load_workflow()
+            base = workflow_handler.create_workflow_copy()
+            
+            if images_per_prompt > 1:
+                latent_ids = find_nodes_by_class(base, LATENT_CLASS_TYPES)
+                if not latent_ids:
+                    print("  工作流中未找到 latent 节点，无法设置 batch_size")
+                    return []
+                for latent_id in latent_ids:
+                    base[latent_id]["inputs"]["batch_size"] = images_per_prompt
+            
+            roots = [workflow_handler.prompt_node_id, workflow_handler.seed_id,
+                     workflow_handler.output_image_id]
+            prompt_workflow, mappings = fan_out_workflow(base, roots, len(prompts))
+            
+            batch_tag = job_seed(job_id)
+            output_ids = []
+            for index, (prompt, mapping) in enumerate(zip(prompts, mappings)):
+                prompt_workflow[mapping[workflow_handler.prompt_node_id]]["inputs"]["text"] = prompt
+                prompt_workflow[mapping[workflow_handler.seed_id]]["inputs"]["seed"] = job_seed(job_id, index + 1)
+                output_id = mapping[workflow_handler.output_image_id]
+                prompt_workflow[output_id]["inputs"]["filename_prefix"] = f"FeiShuBot\\t2i_{batch_tag}_{index}"
+                output_ids.append(output_id)
+            
+            prompt_id = self._run_prompt(client, prompt_workflow, workflow_name, job_id,
+                                         timeout=300 + 60 * (total - 1), on_progress=on_progress)
+            if not prompt_id:
+                return []
+            
+            groups = self._collect_outputs(prompt_id, output_ids, client)
+            print(f"  批量文生图完成: {sum(len(g) for g in groups)}/{total} 张")
+            return groups
+            
+        except Exception as e:
+            print(f"  批量文生图出错: {e}")
+            import traceback
+            traceback.print_exc()
+            return []
+    
+    def process_images_grouped(self, workflow_name: str, items: List[Tuple[str, Optional[str]]],
+                               on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                               on_iteration: Optional[Callable[[int, IterationResult], None]] = None
+                               ) -> List[Optional[str]]:
+        """
+        多张图片使用同一工作流合并为一次提交：复制依赖输入图/提示词/种子的子图，模型加载节点共享
+        （remove_iterations > 1 时每次迭代合并为一次提交）
+        :param workflow_name: 工作流名称
+        :param items: [(图像文件路径, 提示词或 None), ...]
+        :param on_progress: 执行进度回调（可选）
+        :param on_iteration: 中间迭代结果回调（可选），参数为 (items 中的序号, IterationResult)
+        :return: 与 items 一一对应的输出图片路径，失败的位置为 None
+        """
+        if not items:
+            return []
+        job_id = job_prompt_id(workflow_name, [(source_digest(path), prompt) for path, prompt in items])
+        client = self.client.pinned(job_id)
+        if not client.check_server():
+            print("  ComfyUI 服务器未运行")
+            return [None] * len(items)
+        
+        workflow_configs = config.workflow_configs
+        if workflow_name not in workflow_configs:
+            print(f"  未知的工作流: {workflow_name}")
+            return [None] * len(items)
+        
+        cfg = workflow_configs[workflow_name]
+        
+        try:
+            image_filenames = []
+            for image_path, _ in items:
+                if client.is_remote:
+                    image_filename = client.upload_image(image_path, subfolder="FeiShuBot")
+                else:
+                    image_filename = save_image_with_unique_name(image_path, config.input_folder)
+                if not image_filename:
+                    print(f"  图像上传/保存失败: {image_path}")
+                    return [None] * len(items)
+                image_filenames.append(image_filename)
+            
+            workflow_handler = ComfyUIWorkflow(
+                seed_id=cfg["seed_id"],
+                input_image_id=cfg["input_image_id"],
+                output_image_id=cfg["output_image_id"],
+                workflow=cfg["workflow"],
+                prompt_node_id=cfg.get("prompt_node_id")
+            )
+            workflow_handler.load_workflow()
+            
+            iterations = workflow_iterations(cfg)
+            if iterations > 1:
+                return self._run_iterations(
+                    client, workflow_handler, workflow_name, job_id,
+                    [(image_filename, prompt) for image_filename, (_, prompt) in zip(image_filenames, items)],
+                    iterations, on_progress, on_iteration)
+            
+            roots = [workflow_handler.input_image_id, workflow_handler.seed_id,
+                     workflow_handler.output_image_id]
+            if workflow_handler.prompt_node_id:
+                roots.append(workflow_handler.prompt_node_id)
+            prompt_workflow, mappings = fan_out_workflow(
+                workflow_handler.create_workflow_copy(), roots, len(items))
+            
+            batch_tag = job_seed(job_id)
+            output_ids = []
+            for index, ((_, prompt), image_filename, mapping) in enumerate(
+                    zip(items, image_filenames, mappings)):
+                prompt_workflow[mapping[workflow_handler.input_image_id]]["inputs"]["image"] = image_filename
+                prompt_workflow[mapping[workflow_handler.seed_id]]["inputs"]["seed"] = job_seed(job_id, index + 1)
+                if workflow_handler.prompt_node_id and prompt:
+                    prompt_workflow[mapping[workflow_handler.prompt_node_id]]["inputs"]["prompt"] = prompt
+                output_id = mapping[workflow_handler.output_image_id]
+                prompt_workflow[output_id]["inputs"]["filename_prefix"] = f"FeiShuBot\\{batch_tag}_{index}"
+                output_ids.append(output_id)
+            
+            prompt_id = self._run_prompt(client, prompt_workflow, workflow_name, job_id,
+                                         timeout=300 + 60 * (len(items) - 1), on_progress=on_progress,
+                                         record_runtime=len(items) == 1)
+            if not prompt_id:
+                return [None] * len(items)
+            
+            groups = self._collect_outputs(prompt_id, output_ids, client)
+            print(f"  合并处理完成: {sum(1 for g in groups if g)}/{len(items)} 张")
+            return [group[0] if group else None for group in groups]
+            
+        except Exception as e:
+            print(f"  合并处理图像时出错: {e}")
+            import traceback
+            traceback.print_exc()
+            return [None] * len(items)
+    
     def process_image_with_prompt(self, image_path: str, workflow_name: str, 
-                                  prompt: str) -> Optional[str]:
+                                  prompt: str,
+                                  on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+                                  on_iteration: Optional[Callable[[IterationResult], None]] = None) -> Optional[str]:
         """
-        使用 ComfyUI 处理图像（带提示词，用于图像编辑）
+        使用 ComfyUI 处理图像（带提示词，用于图像编辑；remove_iterations > 1 时迭代处理）
         :param image_path: 图像文件路径
         :param workflow_name: 工作流名称
         :param prompt: 编辑提示词
+        :param on_progress: 执行进度回调（可选）
+        :param on_iteration: 中间迭代结果回调（可选）
         :return: 处理后的图片路径，失败返回 None
         """
-        if not self.client.check_server():
+        job_id = job_prompt_id(workflow_name, source_digest(image_path), prompt)
+        client = self.client.pinned(job_id)
+        if not client.check_server():
             print("  ComfyUI 服务器未运行")
             return None
         
@@ -899,8 +2284,8 @@ class ImageProcessor:
         try:
             # 上传/保存图像到 ComfyUI
             print(f"  上传图像到 ComfyUI...")
-            if self.client.is_remote:
-                image_filename = self.client.upload_image(image_path, subfolder="FeiShuBot")
+            if client.is_remote:
+                image_filename = client.upload_image(image_path, subfolder="FeiShuBot")
             else:
                 image_filename = save_image_with_unique_name(image_path, config.input_folder)
             if not image_filename:
@@ -920,7 +2305,13 @@ class ImageProcessor:
             
             workflow_handler.load_workflow()
             
-            seed_value = generate_random_seed()
+            iterations = workflow_iterations(cfg)
+            if iterations > 1:
+                return self._run_iterations(
+                    client, workflow_handler, workflow_name, job_id, [(image_filename, prompt)], iterations,
+                    on_progress, (lambda _, result: on_iteration(result)) if on_iteration else None)[0]
+            
+            seed_value = job_seed(job_id)
             prompt_workflow = workflow_handler.create_workflow_copy()
             prompt_workflow[workflow_handler.seed_id]["inputs"]["seed"] = int(seed_value)
             
@@ -933,17 +2324,15 @@ class ImageProcessor:
             
             print(f"  正在提交工作流...")
             
-            prompt_id = self.client.queue_prompt(prompt_workflow)
+            prompt_id = self._run_prompt(client, prompt_workflow, workflow_name, job_id,
+                                         on_progress=on_progress)
             if not prompt_id:
                 return None
             
-            if not self.client.wait_for_completion(prompt_id, check_interval=2, timeout=300):
-                return None
-            
-            if self.client.is_remote:
-                output_file = self._get_remote_output(prompt_id, str(seed_value))
+            if client.is_remote:
+                output_file = self._get_remote_output(prompt_id, str(seed_value), client)
             else:
-                output_file = self.client.find_output_file(str(seed_value))
+                output_file = client.find_output_file(str(seed_value))
             if output_file:
                 print(f"  处理完成: {output_file}")
                 return output_file
@@ -956,10 +2345,3 @@ class ImageProcessor:
             traceback.print_exc()
             return None
 
-
-# ============================================================================
-# 创建必要文件夹
-# ============================================================================
-
-os.makedirs(config.input_folder, exist_ok=True)
-os.makedirs(config.output_folder, exist_ok=True)
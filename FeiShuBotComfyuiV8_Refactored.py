@@ -14,6 +14,7 @@ import json
 import time
 import os
 import sys
+import bisect
 import shutil
 import random
 import threading
@@ -31,6 +32,10 @@ from feishu_client import FeishuClient, FeishuMessenger, FeishuAPI
 
 # 导入 ComfyUI 模块
 from Comfyui import ComfyUIClient, ImageProcessor, config as comfyui_config
+from Comfyui import runtime_stats, TEXT_TO_IMAGE_WORKFLOW
+
+# 导入共享的 TTL 缓存（消息去重）
+from ttl_cache import TTLCache
 
 
 # ============================================================================
@@ -164,57 +169,20 @@ os.makedirs(AppConfig.COMFYUI_OUTPUT_FOLDER, exist_ok=True)
 
 @dataclass
 class MessageDeduplicator:
-    """消息去重管理器"""
+    """消息去重管理器（基于 TTLCache，O(1) 检查与按时间淘汰）"""
 
-    processed_messages: Dict[str, float] = field(default_factory=dict)
-    lock: threading.Lock = field(default_factory=threading.Lock)
     max_cache_size: int = 1000
     cache_ttl: int = 600  # 10分钟
+    persist_path: Optional[str] = None
+    _cache: TTLCache = field(init=False, repr=False)
 
-    def is_duplicate(self, message_id: str) -> bool:
-        """检查消息是否重复"""
-        with self.lock:
-            current_time = time.time()
-
-            # 清理过期记录
-            self._cleanup_expired(current_time)
-
-            # 检查是否重复
-            if message_id in self.processed_messages:
-                return True
+    def __post_init__(self):
+        self._cache = TTLCache(max_size=self.max_cache_size, ttl=self.cache_ttl,
+                               persist_path=self.persist_path, namespace="processed_messages")
 
-            # 标记为已处理
-            self.processed_messages[message_id] = current_time
-
-            # 限制缓存大小
-            self._limit_cache_size()
-
-            return False
-
-    def _cleanup_expired(self, current_time: float):
-        """清理过期的消息记录"""
-        expired_keys = [
-            msg_id for msg_id, timestamp in self.processed_messages.items()
-            if current_time - timestamp > self.cache_ttl
-        ]
-        for key in expired_keys:
-            del self.processed_messages[key]
-        if expired_keys:
-            print(f"  [去重] 清理了 {len(expired_keys)} 条过期消息记录")
-
-    def _limit_cache_size(self):
-        """限制缓存大小"""
-        if len(self.processed_messages) > self.max_cache_size:
-            # 按时间戳排序，保留最新的500条
-            sorted_items = sorted(
-                self.processed_messages.items(),
-                key=lambda x: x[1],
-                reverse=True
-            )
-            to_remove = sorted_items[500:]
-            for msg_id, _ in to_remove:
-                del self.processed_messages[msg_id]
-            print(f"  [去重] 限制缓存大小，保留最新的500条")
+    def is_duplicate(self, message_id: str) -> bool:
+        """检查消息是否重复，未重复时标记为已处理"""
+        return not self._cache.add(message_id, time.time())
 
     def generate_message_id(self, chat_id: str, content: str) -> str:
         """生成消息ID（当原始ID为空时）"""
@@ -222,8 +190,10 @@ class MessageDeduplicator:
         return f"{chat_id}_{content[:50]}_{current_time}"
 
 
-# 全局消息去重实例
-message_deduplicator = MessageDeduplicator()
+# 全局消息去重实例（持久化到 data/ 目录，重启后仍可识别重复推送）
+message_deduplicator = MessageDeduplicator(
+    persist_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "bot_state.sqlite3")
+)
 
 
 # ============================================================================
@@ -235,27 +205,118 @@ class Task:
     """任务数据结构"""
     task_number: int
     user_id: str
+    workflow_name: str = ""
+    expected_seconds: float = 0.0  # 入队时估算的执行耗时
     created_time: float = field(default_factory=time.time)
+    started_time: Optional[float] = None
     status: str = "pending"  # pending, processing, completed, failed
 
 
+class FenwickTree:
+    """
+    树状数组（Fenwick Tree），支持 O(log n) 的单点更新与前缀和查询。
+    下标从 1 开始，容量不足时自动扩容（O(n) 重建，均摊 O(1)）。
+    """
+
+    def __init__(self, size: int = 1024):
+        self._size = size
+        self._tree = [0.0] * (size + 1)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def add(self, index: int, delta: float):
+        """下标 index 处增加 delta"""
+        while index <= self._size:
+            self._tree[index] += delta
+            index += index & -index
+
+    def prefix_sum(self, index: int) -> float:
+        """计算 [1, index] 的和"""
+        index = min(index, self._size)
+        total = 0.0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def find_kth(self, k: int) -> int:
+        """查找前缀和首次达到 k 的最小下标（要求各点值非负），不存在时返回 0"""
+        index = 0
+        step = 1 << self._size.bit_length()
+        while step:
+            nxt = index + step
+            if nxt <= self._size and self._tree[nxt] < k:
+                index = nxt
+                k -= self._tree[nxt]
+            step >>= 1
+        return index + 1 if index < self._size else 0
+
+    @classmethod
+    def build(cls, size: int, values: Dict[int, float]) -> "FenwickTree":
+        """由 {下标: 值} 线性构建"""
+        tree = cls(size)
+        for index, value in values.items():
+            tree._tree[index] += value
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                tree._tree[parent] += tree._tree[index]
+        return tree
+
+
 class TaskQueue:
-    """任务队列管理器"""
+    """
+    任务队列管理器
+    任务序号单调递增，用两棵树状数组分别维护“任务是否在队列中”和“任务预计耗时”，
+    位置、排名、每个用户的任务列表及 ETA 查询均为 O(log n)。
+    """
 
-    def __init__(self):
+    def __init__(self, initial_capacity: int = 1024):
         self.tasks: Dict[int, Task] = {}
         self.lock = threading.Lock()
         self.counter = 0
-        self.counter_lock = threading.Lock()
+        self._base = 1  # 树状数组下标 1 对应的任务序号
+        self._presence = FenwickTree(initial_capacity)
+        self._durations = FenwickTree(initial_capacity)
+        self._user_tasks: Dict[str, List[int]] = {}
+
+    # ---- 内部工具 ----
 
-    def add_task(self, user_id: str) -> int:
+    def _index(self, task_number: int) -> int:
+        return task_number - self._base + 1
+
+    def _ensure_capacity(self, task_number: int):
+        """容量不足时以最小在队任务为新基准重建树状数组"""
+        if self._index(task_number) <= self._presence.size:
+            return
+        self._base = min(self.tasks) if self.tasks else task_number
+        size = max(self._presence.size, 2 * (task_number - self._base + 1))
+        self._presence = FenwickTree.build(
+            size, {self._index(n): 1 for n in self.tasks})
+        self._durations = FenwickTree.build(
+            size, {self._index(n): t.expected_seconds for n, t in self.tasks.items()})
+
+    def _position(self, task_number: int) -> int:
+        return int(self._presence.prefix_sum(self._index(task_number)))
+
+    # ---- 公共接口 ----
+
+    def add_task(self, user_id: str, workflow_name: str = "") -> int:
         """添加新任务到队列"""
-        with self.counter_lock:
+        expected = runtime_stats.expected_seconds(workflow_name) if workflow_name else 0.0
+        with self.lock:
             self.counter += 1
             task_number = self.counter
-
-        with self.lock:
-            self.tasks[task_number] = Task(task_number=task_number, user_id=user_id)
+            self._ensure_capacity(task_number)
+            self.tasks[task_number] = Task(task_number=task_number, user_id=user_id,
+                                           workflow_name=workflow_name, expected_seconds=expected)
+            index = self._index(task_number)
+            self._presence.add(index, 1)
+            self._durations.add(index, expected)
+            # 任务序号单调递增，直接追加即保持有序
+            self._user_tasks.setdefault(user_id, []).append(task_number)
             print(f"  [队列] 任务 #{task_number} (用户 {user_id}) 已加入队列，队列长度: {len(self.tasks)}")
 
         return task_number
@@ -263,11 +324,20 @@ class TaskQueue:
     def remove_task(self, task_number: int) -> bool:
         """从队列移除任务"""
         with self.lock:
-            if task_number in self.tasks:
-                del self.tasks[task_number]
-                print(f"  [队列] 任务 #{task_number} 已从队列移除，队列长度: {len(self.tasks)}")
-                return True
-            return False
+            task = self.tasks.pop(task_number, None)
+            if task is None:
+                return False
+            index = self._index(task_number)
+            self._presence.add(index, -1)
+            self._durations.add(index, -task.expected_seconds)
+            user_tasks = self._user_tasks.get(task.user_id, [])
+            pos = bisect.bisect_left(user_tasks, task_number)
+            if pos < len(user_tasks) and user_tasks[pos] == task_number:
+                user_tasks.pop(pos)
+            if not user_tasks:
+                self._user_tasks.pop(task.user_id, None)
+            print(f"  [队列] 任务 #{task_number} 已从队列移除，队列长度: {len(self.tasks)}")
+            return True
 
     def get_task_info(self, task_number: int) -> Optional[Tuple[int, int, int]]:
         """
@@ -275,21 +345,40 @@ class TaskQueue:
         :return: (位置, 前面等待数, 总任务数)
         """
         with self.lock:
-            task_numbers = sorted(self.tasks.keys())
-            if task_number not in task_numbers:
+            if task_number not in self.tasks:
                 return None
 
-            position = task_numbers.index(task_number) + 1
-            waiting = position - 1
-            total = len(task_numbers)
+            position = self._position(task_number)
+            return (position, position - 1, len(self.tasks))
 
-            return (position, waiting, total)
+    def get_task_eta(self, task_number: int) -> Optional[float]:
+        """
+        估算任务完成还需的秒数：前面所有任务与自身的预计耗时之和，
+        减去队首任务已经执行的时间
+        """
+        with self.lock:
+            task = self.tasks.get(task_number)
+            if task is None:
+                return None
+            eta = self._durations.prefix_sum(self._index(task_number))
+            head_index = self._presence.find_kth(1)
+            head = self.tasks.get(self._base + head_index - 1) if head_index else None
+            if head is not None and head.started_time is not None:
+                eta -= min(head.expected_seconds, time.time() - head.started_time)
+            return max(0.0, eta)
+
+    def mark_processing(self, task_number: int):
+        """标记任务开始执行（用于 ETA 扣除已执行时间）"""
+        with self.lock:
+            task = self.tasks.get(task_number)
+            if task is not None:
+                task.status = "processing"
+                task.started_time = time.time()
 
     def get_user_tasks(self, user_id: str) -> List[int]:
-        """获取用户的所有任务序号"""
+        """获取用户的所有任务序号（按序号升序）"""
         with self.lock:
-            return [task_num for task_num, task in self.tasks.items()
-                    if task.user_id == user_id]
+            return list(self._user_tasks.get(user_id, []))
 
     def format_user_status(self, user_id: str) -> str:
         """格式化用户的队列状态"""
@@ -298,17 +387,31 @@ class TaskQueue:
         if not user_tasks:
             return "📭 您当前没有在处理的任务"
 
-        task_numbers = sorted(self.tasks.keys())
-        total = len(task_numbers)
+        with self.lock:
+            total = len(self.tasks)
+            positions = [(task_num, self._position(task_num)) for task_num in user_tasks
+                         if task_num in self.tasks]
         status_lines = [f"📊 当前队列总任务数: {total}", ""]
 
-        for task_num in sorted(user_tasks):
-            position = task_numbers.index(task_num) + 1
-            status_lines.append(f"  任务 #{task_num}: 位置 {position}/{total}")
+        for task_num, position in positions:
+            line = f"  任务 #{task_num}: 位置 {position}/{total}"
+            eta = self.get_task_eta(task_num)
+            if eta is not None:
+                line += f"，预计 {format_eta(eta)} 后完成"
+            status_lines.append(line)
 
         return "\n".join(status_lines)
 
 
+def format_eta(seconds: float) -> str:
+    """格式化预计等待时间"""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}秒"
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes}分{seconds:02d}秒"
+
+
 # 全局任务队列实例
 task_queue = TaskQueue()
 
@@ -776,6 +879,7 @@ class ImageProcessor:
             print(f"  正在提交工作流到 ComfyUI...")
 
             # 提交工作流
+            started = time.time()
             prompt_id = queue_prompt(prompt_workflow)
             if not prompt_id:
                 print("  工作流提交失败")
@@ -785,6 +889,7 @@ class ImageProcessor:
             if not wait_for_completion(prompt_id, check_interval=2, timeout=300):
                 print("  任务未完成")
                 return None
+            runtime_stats.record(workflow_name, time.time() - started)
 
             # 查找输出文件
             output_file = find_output_file(str(seed_value))
@@ -847,6 +952,7 @@ class ImageProcessor:
             prompt_workflow = workflow_handler.get_workflow()
 
             # 提交到ComfyUI
+            started = time.time()
             prompt_id = queue_prompt(prompt_workflow)
             if not prompt_id:
                 print("  工作流提交失败")
@@ -856,6 +962,7 @@ class ImageProcessor:
             if not wait_for_completion(prompt_id, check_interval=2, timeout=300):
                 print("  任务未完成")
                 return None
+            runtime_stats.record(TEXT_TO_IMAGE_WORKFLOW, time.time() - started)
 
             # 查找输出文件
             search_pattern = f"t2i_{seed_value}"
@@ -929,6 +1036,7 @@ class ImageProcessor:
             print(f"  正在提交工作流到 ComfyUI...")
 
             # 提交工作流
+            started = time.time()
             prompt_id = queue_prompt(prompt_workflow)
             if not prompt_id:
                 print("  工作流提交失败")
@@ -938,6 +1046,7 @@ class ImageProcessor:
             if not wait_for_completion(prompt_id, check_interval=2, timeout=300):
                 print("  任务未完成")
                 return None
+            runtime_stats.record(workflow_name, time.time() - started)
 
             # 查找输出文件
             output_file = find_output_file(str(seed_value))
@@ -1333,6 +1442,7 @@ class MessageHandler:
 
                 # 使用ComfyUI处理图片（带提示词）
                 print(f"  正在处理图片...")
+                task_queue.mark_processing(task_number)
                 output_image_path = ImageProcessor.process_image_with_prompt(
                     image_path,
                     workflow_name,
@@ -1506,7 +1616,7 @@ class MessageHandler:
                     points_cost = workflow_config.get("points_cost", 2)
 
                     # 生成任务序号并加入队列
-                    task_number = task_queue.add_task(chat_id)
+                    task_number = task_queue.add_task(chat_id, workflow_name)
                     task_info = task_queue.get_task_info(task_number)
 
                     if task_info:
@@ -1534,14 +1644,15 @@ class MessageHandler:
                 return
 
             # 生成任务序号并加入队列
-            task_number = task_queue.add_task(chat_id)
+            task_number = task_queue.add_task(chat_id, workflow_name)
             task_info = task_queue.get_task_info(task_number)
 
             if task_info:
                 position, waiting, total = task_info
+                eta = task_queue.get_task_eta(task_number)
                 # 发送处理中消息
                 reply_content = json.dumps({
-                    "text": f"📸 收到图片！\n\n任务序号: #{task_number}\n队列位置: {position}/{total}\n前面等待: {waiting} 个任务\n\n正在使用 {get_user_workflow(chat_id)} 处理...\n请稍候..."
+                    "text": f"📸 收到图片！\n\n任务序号: #{task_number}\n队列位置: {position}/{total}\n前面等待: {waiting} 个任务\n预计完成: 约 {format_eta(eta or 0)} 后\n\n正在使用 {workflow_name} 处理...\n请稍候..."
                 })
                 self.messenger.send_message(chat_id, reply_content, "text")
 
@@ -1552,9 +1663,10 @@ class MessageHandler:
             if temp_image_path:
                 # 使用ComfyUI处理图片
                 print(f"  正在处理图片...")
+                task_queue.mark_processing(task_number)
                 output_image_path = ImageProcessor.process_image(
                     temp_image_path,
-                    get_user_workflow(chat_id)
+                    workflow_name
                 )
 
                 if output_image_path:
@@ -1740,6 +1852,7 @@ def create_client():
     return lark.Client.builder() \
         .app_id(AppConfig.FEISHU_APP_ID) \
         .app_secret(AppConfig.FEISHU_APP_SECRET) \
+        .enable_set_token(True) \
         .build()
 
 
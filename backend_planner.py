@@ -0,0 +1,126 @@
+"""
+后端缓存亲和调度模块
+ComfyUI 只重新执行输入发生变化的节点，但切换工作流（例如 Z-image 与 Qwen_edit 交替）
+意味着卸载并重新加载 UNet/CLIP/VAE/LoRA，耗时远高于一次采样。
+
+CacheAffinityPlanner 记录每个后端最近执行过的模型集合（UNETLoader、CLIPLoader、
+VAELoader、LoraLoaderModelOnly 等加载器的输入），为每次提交选择预计完成最早的后端：
+    预计等待 = 该后端在途任务数 × 单次耗时 + （模型未驻留时）模型加载耗时
+因此所需模型已驻留的后端优先，只有在其排队过长时才会让另一个后端换模型。
+命中率等统计通过 stats() 获取。
+"""
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Backend:
+    """单个 ComfyUI 后端及其模型驻留状态"""
+    name: str
+    processor: object                       # Comfyui.ImageProcessor
+    resident: deque = field(default_factory=deque)  # 最近执行过的模型集合（新的在右）
+    last_workflow: Optional[str] = None
+    inflight: int = 0
+    submissions: int = 0
+    model_loads: int = 0
+    last_used: float = 0.0
+
+    def has_models(self, models: frozenset) -> bool:
+        return any(models <= resident for resident in self.resident)
+
+
+class CacheAffinityPlanner:
+    """
+    按模型驻留情况选择后端
+
+    Args:
+        backends: [(名称, ImageProcessor), ...]
+        reload_seconds: 模型加载的估计耗时
+        resident_sets: 每个后端认为仍驻留的最近模型集合数（显存足够同时容纳多个工作流时调大）
+    """
+
+    def __init__(self, backends: List[tuple], reload_seconds: float = 20.0, resident_sets: int = 1):
+        if not backends:
+            raise ValueError("至少需要一个后端")
+        self.backends = [Backend(name=name, processor=processor) for name, processor in backends]
+        self.reload_seconds = reload_seconds
+        self.resident_sets = max(1, resident_sets)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @classmethod
+    def from_urls(cls, urls: List[str], default_processor=None, **kwargs) -> "CacheAffinityPlanner":
+        """
+        根据后端地址创建规划器；default_processor 作为第一个后端（沿用其地址切换逻辑），
+        其余地址各自创建 ComfyUIClient + ImageProcessor
+        """
+        from Comfyui import ComfyUIClient, ImageProcessor
+        backends = []
+        if default_processor is not None:
+            backends.append((default_processor.client.api_url, default_processor))
+        for url in urls:
+            url = url.rstrip("/")
+            if any(name == url for name, _ in backends):
+                continue
+            in_memory = getattr(default_processor, "in_memory", False)
+            backends.append((url, ImageProcessor(ComfyUIClient(url), in_memory=in_memory)))
+        return cls(backends, **kwargs)
+
+    def acquire(self, workflow_name: str, models: frozenset) -> Backend:
+        """选择后端并登记一个在途任务，执行完成后必须调用 release()"""
+        from Comfyui import runtime_stats
+        job_seconds = runtime_stats.expected_seconds(workflow_name)
+        with self._lock:
+            def expected_wait(backend: Backend):
+                reload = 0.0 if backend.has_models(models) else self.reload_seconds
+                return (backend.inflight * job_seconds + reload, backend.last_used)
+
+            backend = min(self.backends, key=expected_wait)
+            hit = backend.has_models(models)
+            if hit:
+                self._hits += 1
+                # 命中的集合整体移到最新位置：新任务只用到其中一部分，其余模型仍然驻留，保留完整集合
+                resident = next(r for r in backend.resident if models <= r)
+                backend.resident.remove(resident)
+                backend.resident.append(resident)
+            else:
+                self._misses += 1
+                backend.model_loads += 1
+                if backend.last_workflow is not None:
+                    logger.info("[调度] 后端 %s 切换模型: %s -> %s",
+                                backend.name, backend.last_workflow, workflow_name)
+                backend.resident.append(models)
+            while len(backend.resident) > self.resident_sets:
+                backend.resident.popleft()
+            backend.last_workflow = workflow_name
+            backend.inflight += 1
+            backend.submissions += 1
+            backend.last_used = time.time()
+            return backend
+
+    def release(self, backend: Backend):
+        """任务结束（成功或失败）"""
+        with self._lock:
+            backend.inflight = max(0, backend.inflight - 1)
+
+    def stats(self) -> Dict:
+        """缓存亲和命中率与各后端状态"""
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / total if total else 0.0,
+                "backends": {
+                    b.name: {"last_workflow": b.last_workflow, "inflight": b.inflight,
+                             "submissions": b.submissions, "model_loads": b.model_loads}
+                    for b in self.backends
+                },
+            }
@@ -0,0 +1,265 @@
+"""
+微批调度模块
+在提交到 ComfyUI 之前短暂收集同一工作流的并发请求，合并为一次图提交：
+- 第一个请求到达后最多等待 window 秒，期间到达的兼容请求（同一工作流模板）合并为一批
+- 一批达到 max_batch 时立即提交，不再等待窗口结束
+- 合并后的图中模型加载节点共享，ComfyUI 只需调度/加载一次
+- 结果按请求顺序分发回各自的 Future
+
+window 越大合并机会越多（吞吐高），但单个请求的排队延迟也越大；
+window=0 或 max_batch=1 时退化为逐个提交。stats() 报告合并率与等待时间。
+配置 planner（backend_planner.CacheAffinityPlanner）后，每批按模型驻留情况选择后端执行。
+"""
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bot_logging import get_request_id, request_context
+
+logger = logging.getLogger(__name__)
+
+# 调度键：(任务类型, 工作流名称)
+BatchKey = Tuple[str, str]
+
+KIND_TEXT_TO_IMAGE = "text_to_image"
+KIND_IMAGE = "image"
+
+
+@dataclass
+class _PendingJob:
+    """等待合并的单个请求"""
+    payload: Any
+    on_progress: Optional[Callable] = None
+    on_iteration: Optional[Callable] = None   # 多次迭代处理的中间结果回调（仅图像处理）
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.time)
+    request_id: str = field(default_factory=get_request_id)  # 提交线程的请求上下文（飞书 message_id）
+
+
+class MicroBatchScheduler:
+    """
+    ComfyUI 请求微批调度器
+
+    Args:
+        processor: Comfyui.ImageProcessor
+        window: 收集窗口（秒）
+        max_batch: 单批最多合并的请求数
+        max_workers: 同时执行的批次数
+        planner: 多后端时的缓存亲和规划器（可选），不设置时全部提交给 processor
+    """
+
+    def __init__(self, processor, window: float = 0.3, max_batch: int = 4, max_workers: int = 2,
+                 planner=None):
+        self.processor = processor
+        self.planner = planner
+        self.window = max(0.0, window)
+        self.max_batch = max(1, max_batch)
+        self._pending: Dict[BatchKey, List[_PendingJob]] = {}
+        self._inflight: List[_PendingJob] = []
+        self._deadlines: Dict[BatchKey, float] = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="comfyui-batch")
+        self._stopped = False
+        self._stats = {"requests": 0, "batches": 0, "batched_requests": 0,
+                       "wait_seconds_total": 0.0, "wait_seconds_max": 0.0,
+                       "run_seconds_total": 0.0, "cancelled": 0}
+        self._flusher = threading.Thread(target=self._flush_loop, name="comfyui-batch-flusher", daemon=True)
+        self._flusher.start()
+
+    # ==================== 提交接口 ====================
+
+    def submit_text_to_image(self, prompt: str, on_progress: Optional[Callable] = None) -> Future:
+        """提交文生图请求，Future 结果为图片路径或 None"""
+        from Comfyui import TEXT_TO_IMAGE_WORKFLOW
+        return self._submit((KIND_TEXT_TO_IMAGE, TEXT_TO_IMAGE_WORKFLOW), prompt, on_progress)
+
+    def submit_image(self, image_path: str, workflow_name: str, prompt: Optional[str] = None,
+                     on_progress: Optional[Callable] = None,
+                     on_iteration: Optional[Callable] = None) -> Future:
+        """
+        提交图像处理请求（prompt 为 None 时不设置提示词），Future 结果为图片路径或 None；
+        工作流迭代多次时，on_iteration 以 Comfyui.IterationResult 接收该请求的中间结果
+        """
+        return self._submit((KIND_IMAGE, workflow_name), (image_path, prompt), on_progress, on_iteration)
+
+    def _submit(self, key: BatchKey, payload: Any, on_progress: Optional[Callable],
+                on_iteration: Optional[Callable] = None) -> Future:
+        job = _PendingJob(payload=payload, on_progress=on_progress, on_iteration=on_iteration)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("调度器已停止")
+            self._stats["requests"] += 1
+            jobs = self._pending.setdefault(key, [])
+            jobs.append(job)
+            if len(jobs) == 1:
+                self._deadlines[key] = job.enqueued_at + self.window
+            if len(jobs) >= self.max_batch or self.window == 0:
+                self._dispatch(key)
+            else:
+                self._cond.notify()
+        return job.future
+
+    # ==================== 调度 ====================
+
+    def _flush_loop(self):
+        """到期的批次提交到执行线程池"""
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                for key in [k for k, deadline in self._deadlines.items() if deadline <= now]:
+                    self._dispatch(key)
+                timeout = min(self._deadlines.values()) - now if self._deadlines else None
+                self._cond.wait(timeout)
+
+    def _dispatch(self, key: BatchKey):
+        """取出 key 下的全部请求并提交执行（调用方持有锁）"""
+        jobs = self._pending.pop(key, [])
+        self._deadlines.pop(key, None)
+        if not jobs:
+            return
+        now = time.time()
+        for job in jobs:
+            wait = now - job.enqueued_at
+            self._stats["wait_seconds_total"] += wait
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], wait)
+        self._stats["batches"] += 1
+        if len(jobs) > 1:
+            self._stats["batched_requests"] += len(jobs)
+        self._inflight.extend(jobs)
+        self._executor.submit(self._run_batch, key, jobs)
+
+    def cancel(self, request_id: str) -> int:
+        """
+        取消某条消息的请求：尚在收集窗口中的直接移出批次，已提交执行的立即以 None 结束其 Future
+        （服务端任务由 Comfyui.active_jobs 撤下；合并批次中其他请求不受影响）。返回取消的请求数
+        """
+        cancelled = []
+        with self._cond:
+            for key in list(self._pending):
+                jobs = self._pending[key]
+                cancelled += [job for job in jobs if job.request_id == request_id]
+                remaining = [job for job in jobs if job.request_id != request_id]
+                if remaining:
+                    self._pending[key] = remaining
+                else:
+                    del self._pending[key]
+                    self._deadlines.pop(key, None)
+            cancelled += [job for job in self._inflight if job.request_id == request_id]
+            self._stats["cancelled"] += len(cancelled)
+        for job in cancelled:
+            if not job.future.done():
+                job.future.set_result(None)
+        return len(cancelled)
+
+    def _run_batch(self, key: BatchKey, jobs: List[_PendingJob]):
+        # 执行线程沿用请求上下文：合并批次的 request_id 为各请求的 message_id 拼接，
+        # ImageProcessor 据此派生确定性 prompt_id（有请求缺少上下文时整批按无上下文处理）
+        request_ids = [job.request_id for job in jobs if job.request_id != "-"]
+        with request_context("+".join(request_ids) if len(request_ids) == len(jobs) else "-"):
+            self._execute_batch(key, jobs)
+
+    def _execute_batch(self, key: BatchKey, jobs: List[_PendingJob]):
+        kind, workflow_name = key
+        callbacks = [job.on_progress for job in jobs if job.on_progress]
+
+        def on_progress(event):
+            for callback in callbacks:
+                callback(event)
+
+        def on_iteration(index, result):
+            callback = jobs[index].on_iteration
+            if callback and not jobs[index].future.done():
+                callback(result)
+
+        started = time.time()
+        backend = None
+        try:
+            processor = self.processor
+            if self.planner:
+                from Comfyui import workflow_template, workflow_model_set
+                template = workflow_template(workflow_name)
+                backend = self.planner.acquire(
+                    workflow_name, workflow_model_set(template) if template else frozenset())
+                processor = backend.processor
+            if len(jobs) > 1:
+                logger.info("[调度] 合并 %d 个 %s 请求为一次提交", len(jobs), workflow_name)
+            if kind == KIND_TEXT_TO_IMAGE:
+                results = self._run_text_to_image(processor, [job.payload for job in jobs],
+                                                  on_progress if callbacks else None)
+            else:
+                results = self._run_images(processor, workflow_name, [job.payload for job in jobs],
+                                           on_progress if callbacks else None,
+                                           on_iteration if any(job.on_iteration for job in jobs) else None)
+            for job, result in zip(jobs, results):
+                if not job.future.done():
+                    job.future.set_result(result)
+        except Exception as e:
+            logger.exception("[调度] 批次执行异常: %s", e)
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+        finally:
+            if backend is not None:
+                self.planner.release(backend)
+            with self._cond:
+                self._stats["run_seconds_total"] += time.time() - started
+                finished = {id(job) for job in jobs}
+                self._inflight = [job for job in self._inflight if id(job) not in finished]
+
+    @staticmethod
+    def _run_text_to_image(processor, prompts: List[str], on_progress) -> List[Optional[str]]:
+        if len(prompts) == 1:
+            return [processor.process_text_to_image(prompts[0], on_progress=on_progress)]
+        groups = processor.process_text_to_image_grouped(prompts, on_progress=on_progress)
+        if not groups:
+            return [None] * len(prompts)
+        return [group[0] if group else None for group in groups]
+
+    @staticmethod
+    def _run_images(processor, workflow_name: str, items: List[Tuple[str, Optional[str]]],
+                    on_progress, on_iteration=None) -> List[Optional[str]]:
+        if len(items) == 1:
+            image_path, prompt = items[0]
+            single = (lambda result: on_iteration(0, result)) if on_iteration else None
+            if prompt is None:
+                return [processor.process_image(image_path, workflow_name, on_progress=on_progress,
+                                                on_iteration=single)]
+            return [processor.process_image_with_prompt(image_path, workflow_name, prompt,
+                                                        on_progress=on_progress, on_iteration=single)]
+        return processor.process_images_grouped(workflow_name, items, on_progress=on_progress,
+                                                on_iteration=on_iteration)
+
+    # ==================== 统计与关闭 ====================
+
+    def stats(self) -> Dict[str, Any]:
+        """合并率、平均批大小、排队等待时间、缓存亲和命中率"""
+        with self._cond:
+            s = dict(self._stats)
+            waiting = sum(len(jobs) for jobs in self._pending.values())
+        dispatched, batches = s["requests"] - waiting, s["batches"]
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "requests": s["requests"],
+            "batches": batches,
+            "avg_batch_size": dispatched / batches if batches else 0.0,
+            "batched_ratio": s["batched_requests"] / dispatched if dispatched else 0.0,
+            "submissions_saved": dispatched - batches,
+            "avg_wait_ms": s["wait_seconds_total"] / dispatched * 1000 if dispatched else 0.0,
+            "max_wait_ms": s["wait_seconds_max"] * 1000,
+            "avg_batch_run_seconds": s["run_seconds_total"] / batches if batches else 0.0,
+            "cancelled": s["cancelled"],
+            "affinity": self.planner.stats() if self.planner else None,
+        }
+
+    def shutdown(self, wait: bool = True):
+        """提交剩余请求并停止调度"""
+        with self._cond:
+            for key in list(self._pending):
+                self._dispatch(key)
+            self._stopped = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,301 @@
+"""
+日志模块
+基于 QueueHandler/QueueListener 的非阻塞日志管道：
+业务线程只负责把 LogRecord 放入队列，格式化、采样后的写盘与控制台输出都在后台线程完成。
+
+主要功能：
+- 结构化 JSON 日志（文件），附带 request_id（通常为飞书 message_id）
+- 惰性格式化：record.msg % record.args 推迟到后台线程执行
+- 高频级别（DEBUG/INFO）按 1/N 采样，WARNING 及以上始终保留
+- 按天切换日志文件，单文件超过大小上限时滚动
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# ============================================================================
+# 请求上下文
+# ============================================================================
+
+_request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+def get_request_id() -> str:
+    """获取当前线程/上下文的请求ID"""
+    return _request_id_var.get()
+
+
+@contextmanager
+def request_context(request_id: str):
+    """在 with 块内为所有日志记录附带 request_id"""
+    token = _request_id_var.set(request_id or "-")
+    try:
+        yield
+    finally:
+        _request_id_var.reset(token)
+
+
+# ============================================================================
+# 过滤器与格式化器
+# ============================================================================
+
+class RequestIdFilter(logging.Filter):
+    """在调用线程中捕获 request_id（contextvar 无法跨越队列）"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = _request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    高频级别采样过滤器。
+    sample_every={logging.DEBUG: 10} 表示每个 logger 的 DEBUG 日志每 10 条保留 1 条。
+    通过 extra={"no_sample": True} 可让单条记录跳过采样。
+    """
+
+    def __init__(self, sample_every: Optional[Dict[int, int]] = None):
+        super().__init__()
+        self.sample_every = {lvl: n for lvl, n in (sample_every or {}).items() if n and n > 1}
+        self._counters: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        every = self.sample_every.get(record.levelno)
+        if not every or getattr(record, "no_sample", False):
+            return True
+        key = (record.name, record.levelno)
+        with self._lock:
+            count = self._counters.get(key, 0)
+            self._counters[key] = count + 1
+            if count % every == 0:
+                return True
+            self.dropped += 1
+            return False
+
+
+# LogRecord 自带的属性，JSON 输出时不重复展开
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "request_id", "no_sample",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """结构化 JSON 格式化器，每条记录一行"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    不在调用线程格式化的 QueueHandler。
+    标准 QueueHandler.prepare() 会在入队前执行 format()，这里直接把原始记录交给后台线程。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# ============================================================================
+# 文件滚动
+# ============================================================================
+
+class DailySizeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    按天 + 按大小滚动的文件处理器。
+    文件名形如 bot_20260418.log；日期变化时切换到新文件，
+    同一天内超过 max_bytes 时按 bot_20260418.log.1 ... 的方式滚动。
+    """
+
+    def __init__(self, log_dir: str, prefix: str = "bot", max_bytes: int = 20 * 1024 * 1024,
+                 backup_count: int = 10, encoding: str = "utf-8"):
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self._day = time.strftime("%Y%m%d")
+        os.makedirs(log_dir, exist_ok=True)
+        super().__init__(self._path_for(self._day), maxBytes=max_bytes,
+                         backupCount=backup_count, encoding=encoding, delay=True)
+
+    def _path_for(self, day: str) -> str:
+        return os.path.join(self.log_dir, f"{self.prefix}_{day}.log")
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.strftime("%Y%m%d") != self._day:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        today = time.strftime("%Y%m%d")
+        if today != self._day:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+            self._day = today
+            self.baseFilename = os.path.abspath(self._path_for(today))
+            return
+        super().doRollover()
+
+
+# ============================================================================
+# 初始化
+# ============================================================================
+
+CONSOLE_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+CONSOLE_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(log_dir: str, level: int = logging.INFO, console: bool = True,
+                  json_file: bool = True, max_bytes: int = 20 * 1024 * 1024,
+                  backup_count: int = 10,
+                  sample_every: Optional[Dict[int, int]] = None) -> logging.handlers.QueueListener:
+    """
+    配置根 logger 使用非阻塞日志管道，可重复调用（会先停止旧的后台线程）。
+
+    Args:
+        log_dir: 日志目录
+        level: 根 logger 级别
+        console: 是否同时输出到控制台（可读文本格式）
+        json_file: 文件是否使用 JSON 格式
+        max_bytes: 单个日志文件大小上限
+        backup_count: 同一天内保留的滚动文件数量
+        sample_every: 级别 → 采样间隔，默认 DEBUG 每 10 条保留 1 条
+
+    Returns:
+        QueueListener: 后台日志线程
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    if sample_every is None:
+        sample_every = {logging.DEBUG: 10}
+
+    file_handler = DailySizeRotatingFileHandler(log_dir, max_bytes=max_bytes, backup_count=backup_count)
+    file_handler.setFormatter(JsonFormatter() if json_file
+                              else logging.Formatter(CONSOLE_FORMAT, CONSOLE_DATEFMT))
+    handlers = [file_handler]
+    if console:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT, CONSOLE_DATEFMT))
+        handlers.append(stream_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(SamplingFilter(sample_every))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """停止后台日志线程并刷新剩余记录"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+# ============================================================================
+# 开销测量
+# ============================================================================
+
+def measure_logging_overhead(n: int = 20000, log_dir: str = None) -> Dict[str, float]:
+    """
+    测量单条消息的日志在调用线程上的耗时（微秒），对比同步写盘与队列方案。
+    两种方案使用相同的文件 handler、JSON 格式、过滤器与日志调用，差别只在写盘发生在调用线程还是后台线程；
+    queued_drain_us_per_message 为队列方案包含后台写完全部记录的总耗时，用于确认吞吐没有下降。
+    """
+    import tempfile
+    log_dir = log_dir or tempfile.mkdtemp(prefix="bot_log_bench_")
+    results = {}
+    message_id = "om_bench_message_id"
+    content = '{"text":"' + "x" * 200 + '"}'
+
+    def make_file_handler(prefix: str) -> logging.Handler:
+        handler = DailySizeRotatingFileHandler(log_dir, prefix=prefix)
+        handler.setFormatter(JsonFormatter())
+        return handler
+
+    def add_filters(handler: logging.Handler) -> logging.Handler:
+        handler.addFilter(RequestIdFilter())
+        handler.addFilter(SamplingFilter({logging.DEBUG: 10}))
+        return handler
+
+    def log_messages():
+        with request_context(message_id):
+            for _ in range(n):
+                bench_logger.info("收到新消息 chat_id=%s", "oc_bench")
+                bench_logger.info("原始内容: %s", content)
+
+    bench_logger = logging.getLogger("bot_logging.bench")
+    bench_logger.propagate = False
+    bench_logger.setLevel(logging.INFO)
+
+    # 同步方案：调用线程内格式化并写盘
+    sync_handler = add_filters(make_file_handler("sync"))
+    bench_logger.handlers = [sync_handler]
+    start = time.perf_counter()
+    log_messages()
+    results["sync_us_per_message"] = (time.perf_counter() - start) / n * 1e6
+    sync_handler.close()
+
+    # 队列方案：调用线程只入队，后台线程格式化并写盘
+    log_queue = queue.SimpleQueue()
+    queue_handler = add_filters(_LazyQueueHandler(log_queue))
+    file_handler = make_file_handler("queued")
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    bench_logger.handlers = [queue_handler]
+    listener.start()
+    start = time.perf_counter()
+    log_messages()
+    results["queued_us_per_message"] = (time.perf_counter() - start) / n * 1e6
+    listener.stop()  # 等待后台线程写完队列中的记录
+    results["queued_drain_us_per_message"] = (time.perf_counter() - start) / n * 1e6
+    file_handler.close()
+    bench_logger.handlers = []
+    return results
+
+
+if __name__ == "__main__":
+    for key, value in measure_logging_overhead().items():
+        print(f"{key}: {value:.2f}")
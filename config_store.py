@@ -0,0 +1,455 @@
+"""
+配置管理模块
+config.json5 的读取、快照与热更新：
+- parse_json5(): 完整的 JSON5 解析（注释、尾逗号、单引号字符串、无引号键、十六进制/Infinity/NaN 等），
+  不再按行截断 //，值中的 URL 不受影响
+- ConfigSnapshot: 不可变快照，api_url / 工作流配置 / 输入输出目录等派生值在加载时计算一次，
+  读取只是属性访问（O(1)）
+- ConfigStore: 按文件 mtime 检测变化并重新加载，新快照构建完成后整体替换引用（读取方不会看到半新半旧的配置）；
+  解析失败时保留旧快照。subscribe() 注册变更回调，如 ComfyUI 客户端随 comfyUI.url 切换到新的 ngrok 地址
+"""
+import os
+import math
+import logging
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# JSON5 解析
+# ============================================================================
+
+class JSON5Error(ValueError):
+    """JSON5 语法错误（包含行列号）"""
+
+    def __init__(self, message: str, text: str, pos: int):
+        line = text.count("\n", 0, pos) + 1
+        column = pos - (text.rfind("\n", 0, pos) + 1) + 1
+        super().__init__(f"{message}（第 {line} 行第 {column} 列）")
+        self.line = line
+        self.column = column
+
+
+_WHITESPACE = " \t\n\r\v\f\u00a0\ufeff\u2028\u2029"
+_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v", "0": "\0",
+            "'": "'", '"': '"', "\\": "\\", "/": "/"}
+_LITERALS = {"true": True, "false": False, "null": None, "Infinity": math.inf, "NaN": math.nan}
+
+
+class _JSON5Parser:
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def error(self, message: str):
+        raise JSON5Error(message, self.text, self.pos)
+
+    def skip(self):
+        """跳过空白与注释"""
+        text, n = self.text, len(self.text)
+        while self.pos < n:
+            ch = text[self.pos]
+            if ch in _WHITESPACE:
+                self.pos += 1
+            elif text.startswith("//", self.pos):
+                end = text.find("\n", self.pos)
+                self.pos = n if end < 0 else end + 1
+            elif text.startswith("/*", self.pos):
+                end = text.find("*/", self.pos + 2)
+                if end < 0:
+                    self.error("注释未闭合")
+                self.pos = end + 2
+            else:
+                return
+
+    def peek(self) -> str:
+        return self.text[self.pos] if self.pos < len(self.text) else ""
+
+    def parse(self) -> Any:
+        self.skip()
+        value = self.value()
+        self.skip()
+        if self.pos < len(self.text):
+            self.error("多余的内容")
+        return value
+
+    def value(self) -> Any:
+        ch = self.peek()
+        if ch == "{":
+            return self.obj()
+        if ch == "[":
+            return self.array()
+        if ch in "\"'":
+            return self.string()
+        if ch and (ch in "+-." or ch.isdigit()):
+            return self.number()
+        word = self.identifier()
+        if word in _LITERALS:
+            return _LITERALS[word]
+        self.error(f"无法识别的值 {word or ch!r}")
+
+    def obj(self) -> Dict[str, Any]:
+        self.pos += 1
+        result = {}
+        while True:
+            self.skip()
+            if self.peek() == "}":
+                self.pos += 1
+                return result
+            key = self.string() if self.peek() in "\"'" else self.identifier()
+            if key is None:
+                self.error("缺少键名")
+            self.skip()
+            if self.peek() != ":":
+                self.error("缺少冒号")
+            self.pos += 1
+            self.skip()
+            result[key] = self.value()
+            self.skip()
+            ch = self.peek()
+            if ch == ",":
+                self.pos += 1
+            elif ch != "}":
+                self.error("对象成员之间缺少逗号")
+
+    def array(self) -> List[Any]:
+        self.pos += 1
+        result = []
+        while True:
+            self.skip()
+            if self.peek() == "]":
+                self.pos += 1
+                return result
+            result.append(self.value())
+            self.skip()
+            ch = self.peek()
+            if ch == ",":
+                self.pos += 1
+            elif ch != "]":
+                self.error("数组元素之间缺少逗号")
+
+    def identifier(self) -> Optional[str]:
+        start = self.pos
+        text = self.text
+        while self.pos < len(text) and (text[self.pos].isalnum() or text[self.pos] in "_$"):
+            self.pos += 1
+        word = text[start:self.pos]
+        if not word:
+            return None
+        if word[0].isdigit():
+            self.pos = start
+            self.error("键名不能以数字开头")
+        return word
+
+    def string(self) -> str:
+        quote = self.text[self.pos]
+        self.pos += 1
+        parts = []
+        text = self.text
+        while True:
+            if self.pos >= len(text):
+                self.error("字符串未闭合")
+            ch = text[self.pos]
+            if ch == quote:
+                self.pos += 1
+                return "".join(parts)
+            if ch == "\\":
+                self.pos += 1
+                esc = text[self.pos:self.pos + 1]
+                if esc in _ESCAPES:
+                    parts.append(_ESCAPES[esc])
+                    self.pos += 1
+                elif esc in ("u", "x"):
+                    width = 4 if esc == "u" else 2
+                    code = self.hex_digits(self.pos + 1, width)
+                    self.pos += 1 + width
+                    if 0xD800 <= code <= 0xDBFF and esc == "u":
+                        # 代理对：高位代理后必须紧跟 \u 低位代理，合并为一个字符
+                        if text[self.pos:self.pos + 2] != "\\u":
+                            self.error("孤立的 UTF-16 代理")
+                        low = self.hex_digits(self.pos + 2, 4)
+                        if not 0xDC00 <= low <= 0xDFFF:
+                            self.error("孤立的 UTF-16 代理")
+                        code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                        self.pos += 6
+                    elif 0xDC00 <= code <= 0xDFFF:
+                        self.error("孤立的 UTF-16 代理")
+                    parts.append(chr(code))
+                elif esc in ("\n", "\u2028", "\u2029"):
+                    self.pos += 1  # 续行
+                elif esc == "\r":
+                    self.pos += 2 if text[self.pos + 1:self.pos + 2] == "\n" else 1
+                else:
+                    parts.append(esc)
+                    self.pos += 1
+            elif ch == "\n":
+                self.error("字符串中不能直接换行")
+            else:
+                end = self.pos
+                while end < len(text) and text[end] not in (quote, "\\", "\n"):
+                    end += 1
+                parts.append(text[self.pos:end])
+                self.pos = end
+
+    def hex_digits(self, start: int, width: int) -> int:
+        """读取 start 处 width 位十六进制数字"""
+        digits = self.text[start:start + width]
+        if len(digits) != width or any(c not in "0123456789abcdefABCDEF" for c in digits):
+            self.error("无效的转义序列")
+        return int(digits, 16)
+
+    def number(self):
+        text = self.text
+        start = self.pos
+        sign = 1
+        if text[self.pos] in "+-":
+            sign = -1 if text[self.pos] == "-" else 1
+            self.pos += 1
+        word = self.identifier() if self.peek().isalpha() else None
+        if word is not None:
+            if word in ("Infinity", "NaN"):
+                return sign * _LITERALS[word]
+            self.pos = start
+            self.error("无效的数字")
+        if text.startswith(("0x", "0X"), self.pos):
+            end = self.pos + 2
+            while end < len(text) and text[end] in "0123456789abcdefABCDEF":
+                end += 1
+            value = int(text[self.pos + 2:end], 16) if end > self.pos + 2 else self.error("无效的十六进制数")
+            self.pos = end
+            return sign * value
+        end = self.pos
+        while end < len(text) and (text[end].isdigit() or text[end] in ".eE" or
+                                   (text[end] in "+-" and text[end - 1] in "eE")):
+            end += 1
+        literal = text[self.pos:end]
+        try:
+            value = float(literal) if any(c in literal for c in ".eE") else int(literal)
+        except ValueError:
+            self.error(f"无效的数字 {literal!r}")
+        self.pos = end
+        return sign * value
+
+
+def parse_json5(text: str) -> Any:
+    """解析 JSON5 文本，语法错误抛出 JSON5Error"""
+    return _JSON5Parser(text).parse()
+
+
+def freeze(value: Any) -> Any:
+    """递归转换为只读结构：dict → MappingProxyType，list → tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+# ============================================================================
+# 配置快照
+# ============================================================================
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """一次加载的完整配置，派生值在 build() 中计算一次"""
+    raw: Mapping[str, Any]
+    version: int
+    api_url: str
+    is_remote: bool
+    proxy_settings: Mapping[str, Optional[str]]
+    folder: str
+    python_exe: str
+    main_py: str
+    input_folder: str
+    output_folder: str
+    workflow_configs: Mapping[str, Mapping[str, Any]]
+    default_workflow: str
+    text_to_image_config: Mapping[str, Any]
+
+    def get(self, key: str, default=None):
+        return self.raw.get(key, default)
+
+    @classmethod
+    def build(cls, data: Dict[str, Any], base_dir: str, version: int = 0) -> "ConfigSnapshot":
+        data = data if isinstance(data, dict) else {}
+        comfyui = data.get("comfyUI", {}) or {}
+
+        # 支持直接配置完整 URL（如 ngrok 地址 https://xxxx.ngrok-free.app）
+        url = comfyui.get("url", "")
+        if url:
+            api_url = url.rstrip("/")
+        else:
+            api_url = f"http://{comfyui.get('host', '127.0.0.1')}:{comfyui.get('port', '8188')}"
+        is_remote = not (api_url.startswith("http://127.0.0.1") or api_url.startswith("http://localhost"))
+
+        proxy = data.get("proxy", {}) or {}
+        http_proxy, https_proxy = proxy.get("http", ""), proxy.get("https", "")
+        if proxy.get("use_proxy", False) and (http_proxy or https_proxy):
+            proxy_settings = {"http": http_proxy, "https": https_proxy}
+        else:
+            proxy_settings = {"http": None, "https": None}
+
+        folder = comfyui.get("folder", "ComfyUI")
+        python_exe = os.path.join(folder, "python", "python.exe" if os.name == "nt" else "python")
+        # 远程模式使用本地缓存目录
+        if is_remote:
+            input_folder = os.path.join(base_dir, "comfyui_cache", "input")
+            output_folder = os.path.join(base_dir, "comfyui_cache", "output", "FeiShuBot")
+        else:
+            input_folder = os.path.join(folder, "input")
+            output_folder = os.path.join(folder, "output", "FeiShuBot")
+
+        workflow_configs = {}
+        for name, workflow in (data.get("workflows", {}) or {}).items():
+            entry = {
+                "seed_id": str(workflow.get("seed_id")),
+                "input_image_id": str(workflow.get("input_image_id")),
+                "output_image_id": str(workflow.get("output_image_id")),
+                "workflow": workflow.get("workflow", ""),
+                "points_cost": workflow.get("points_cost", 10),
+                "remove_iterations": workflow.get("remove_iterations", 1),
+                "stream_iterations": bool(workflow.get("stream_iterations", False)),
+            }
+            if "prompt_node_id" in workflow:
+                entry["prompt_node_id"] = workflow["prompt_node_id"]
+            workflow_configs[name] = entry
+
+        return cls(
+            raw=freeze(data),
+            version=version,
+            api_url=api_url,
+            is_remote=is_remote,
+            proxy_settings=freeze(proxy_settings),
+            folder=folder,
+            python_exe=python_exe,
+            main_py=os.path.join(folder, "main.py"),
+            input_folder=input_folder,
+            output_folder=output_folder,
+            workflow_configs=freeze(workflow_configs),
+            default_workflow=data.get("default_workflow", "Qwen_remove"),
+            text_to_image_config=freeze(data.get("text_to_image", {}) or {}),
+        )
+
+
+# ============================================================================
+# 配置存储与热更新
+# ============================================================================
+
+Subscriber = Callable[[ConfigSnapshot, ConfigSnapshot], None]
+
+
+class ConfigStore:
+    """
+    配置文件存储
+
+    Args:
+        path: 配置文件路径（不存在时使用空配置）
+        base_dir: 派生路径（远程模式缓存目录）的基准目录，默认为配置文件所在目录
+    """
+
+    def __init__(self, path: str, base_dir: str = None):
+        self.path = path
+        self.base_dir = base_dir or os.path.dirname(os.path.abspath(path))
+        self._lock = threading.Lock()
+        self._signature: Optional[Tuple[int, int]] = None
+        self._subscribers: List[Tuple[Subscriber, Optional[str]]] = []
+        self._watcher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.reloads = 0
+        self.errors = 0
+        self._snapshot = ConfigSnapshot.build({}, self.base_dir)
+        self.reload(force=True)
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        """当前快照（引用整体替换，读取无需加锁）"""
+        return self._snapshot
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self, force: bool = False) -> bool:
+        """文件有变化（或 force）时重新加载，返回快照是否被替换"""
+        with self._lock:
+            signature = self._stat()
+            if not force and signature == self._signature:
+                return False
+            self._signature = signature
+            if signature is None:
+                data = {}
+            else:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = parse_json5(f.read())
+                except (OSError, JSON5Error) as e:
+                    self.errors += 1
+                    logger.warning("[配置] 加载 %s 失败，继续使用当前配置: %s", self.path, e)
+                    return False
+            old = self._snapshot
+            new = ConfigSnapshot.build(data, self.base_dir, old.version + 1)
+            self._snapshot = new
+            self.reloads += 1
+            subscribers = list(self._subscribers)
+
+        if old.version:
+            logger.info("[配置] 已重新加载 %s（版本 %d）", self.path, new.version)
+        for callback, field in subscribers:
+            if field is not None and getattr(old, field) == getattr(new, field):
+                continue
+            try:
+                callback(old, new)
+            except Exception:
+                logger.exception("[配置] 变更回调执行失败")
+        return True
+
+    def subscribe(self, callback: Subscriber, field: str = None) -> Callable[[], None]:
+        """
+        注册变更回调 callback(old, new)；指定 field（ConfigSnapshot 的属性名）时仅在该值变化时调用
+
+        Returns:
+            取消订阅的函数
+        """
+        entry = (callback, field)
+        with self._lock:
+            self._subscribers.append(entry)
+
+        def unsubscribe():
+            with self._lock:
+                if entry in self._subscribers:
+                    self._subscribers.remove(entry)
+        return unsubscribe
+
+    def start_watching(self, interval: float = 2.0):
+        """后台线程每 interval 秒检查一次文件 mtime/大小，变化时重新加载"""
+        if self._watcher and self._watcher.is_alive():
+            return
+        self._stop.clear()
+
+        def watch():
+            while not self._stop.wait(interval):
+                try:
+                    self.reload()
+                except Exception:
+                    logger.exception("[配置] 检查配置文件失败")
+
+        self._watcher = threading.Thread(target=watch, name="config-watch", daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+
+def write_atomic(path: str, content: str):
+    """先写临时文件再替换，热更新不会读到写了一半的配置；content 原样写入，不转换换行符"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
@@ -0,0 +1,443 @@
+"""
+飞书云文档写入模块
+CreateDoc / WriteDoc 的正文统一由 DocWriter 追加到文档：
+- Markdown 单遍解析为文档块：标题、无序/有序列表、引用、分割线、代码块，以及行内粗体/斜体/行内代码/链接
+- 按接口单次请求的子块上限（50）分批，批次严格按顺序提交，前一批成功后才提交下一批，文档中块的顺序与原文一致
+- 每批生成一个 client_token，超时/频控/5xx 重试时沿用同一个 token，服务端据此去重，重试不会写出重复内容
+- 解析与序列化在后台线程中提前进行（流水线），与网络请求重叠；请求间隔受单文档编辑频率（默认 3 次/秒）限制
+
+python doc_writer.py --bench 5000 使用本地替身服务测量 5000 段文档的写入吞吐。
+"""
+import re
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import argparse
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+
+# 创建子块接口单次请求的子块数量上限
+MAX_CHILDREN_PER_REQUEST = 50
+# 单个文档的编辑接口调用频率上限（次/秒）
+DOC_EDIT_QPS = 3.0
+# 需要重试的错误码：频控
+RETRY_CODES = {99991400}
+
+# 文档块类型
+BLOCK_TEXT = 2
+BLOCK_HEADING1 = 3          # heading1 ~ heading9 为 3 ~ 11
+BLOCK_BULLET = 12
+BLOCK_ORDERED = 13
+BLOCK_CODE = 14
+BLOCK_QUOTE = 15
+BLOCK_DIVIDER = 22
+
+# 代码块语言（飞书枚举值，未列出的语言按纯文本处理）
+CODE_LANGUAGES = {
+    "plaintext": 1, "text": 1, "bash": 7, "sh": 7, "csharp": 8, "c#": 8, "cpp": 9, "c++": 9, "c": 10,
+    "css": 12, "go": 22, "html": 24, "json": 28, "java": 29, "javascript": 30, "js": 30,
+    "kotlin": 32, "lua": 36, "markdown": 39, "md": 39, "php": 43, "python": 49, "py": 49,
+    "ruby": 52, "rust": 53, "sql": 56, "shell": 60, "swift": 61, "typescript": 63, "ts": 63,
+    "xml": 66, "yaml": 67, "yml": 67,
+}
+
+
+# ============================================================================
+# Markdown → 文档块
+# ============================================================================
+
+_HEADING = re.compile(r"^(#{1,9})\s+(.*)$")
+_BULLET = re.compile(r"^[-*+]\s+(.*)$")
+_ORDERED = re.compile(r"^\d+[.)]\s+(.*)$")
+_QUOTE = re.compile(r"^>\s?(.*)$")
+_DIVIDER = re.compile(r"^([-*_])(\s*\1){2,}$")
+_INLINE = re.compile(r"\*\*(?P<bold>.+?)\*\*|`(?P<code>[^`]+)`|\[(?P<label>[^\]]+)\]\((?P<url>[^)\s]+)\)"
+                     r"|(?<![\w*])\*(?P<italic>[^*\s][^*]*?)\*(?![\w*])")
+
+
+def _text_run(content: str, **style) -> Dict:
+    return {"text_run": {"content": content, "text_element_style": style}}
+
+
+def inline_elements(text: str) -> List[Dict]:
+    """解析行内格式（粗体、斜体、行内代码、链接）为 text_run 列表"""
+    elements = []
+    pos = 0
+    for match in _INLINE.finditer(text):
+        if match.start() > pos:
+            elements.append(_text_run(text[pos:match.start()]))
+        if match.group("bold") is not None:
+            elements.append(_text_run(match.group("bold"), bold=True))
+        elif match.group("code") is not None:
+            elements.append(_text_run(match.group("code"), inline_code=True))
+        elif match.group("label") is not None:
+            elements.append(_text_run(match.group("label"), link={"url": quote(match.group("url"), safe="")}))
+        else:
+            elements.append(_text_run(match.group("italic"), italic=True))
+        pos = match.end()
+    if pos < len(text):
+        elements.append(_text_run(text[pos:]))
+    return elements
+
+
+def _block(block_type: int, key: str, elements: List[Dict], **style) -> Dict:
+    return {"block_type": block_type, key: {"elements": elements, "style": style}}
+
+
+def _code_block(lines: List[str], language: str) -> Dict:
+    return _block(BLOCK_CODE, "code", [_text_run("\n".join(lines))],
+                  language=CODE_LANGUAGES.get(language, 1), wrap=False)
+
+
+def markdown_blocks(content: str) -> Iterator[Dict]:
+    """
+    逐行解析 Markdown 并依次产出文档块（单遍，不构建中间结构）
+
+    空行只作为段落分隔，不产出空白块；代码块内保留原始缩进与空行。
+    """
+    code_lines: Optional[List[str]] = None
+    code_language = ""
+    for line in content.splitlines():
+        stripped = line.strip()
+        if code_lines is not None:
+            if stripped.startswith("```"):
+                yield _code_block(code_lines, code_language)
+                code_lines = None
+            else:
+                code_lines.append(line)
+            continue
+        if stripped.startswith("```"):
+            code_lines, code_language = [], stripped[3:].strip().lower()
+            continue
+        if not stripped:
+            continue
+
+        match = _HEADING.match(stripped)
+        if match:
+            level = len(match.group(1))
+            yield _block(BLOCK_HEADING1 + level - 1, f"heading{level}", inline_elements(match.group(2)))
+        elif _DIVIDER.match(stripped):
+            yield {"block_type": BLOCK_DIVIDER, "divider": {}}
+        elif _BULLET.match(stripped):
+            yield _block(BLOCK_BULLET, "bullet", inline_elements(_BULLET.match(stripped).group(1)))
+        elif _ORDERED.match(stripped):
+            yield _block(BLOCK_ORDERED, "ordered", inline_elements(_ORDERED.match(stripped).group(1)))
+        elif _QUOTE.match(stripped):
+            yield _block(BLOCK_QUOTE, "quote", inline_elements(_QUOTE.match(stripped).group(1)))
+        else:
+            yield _block(BLOCK_TEXT, "text", inline_elements(stripped))
+    if code_lines:
+        # 未闭合的代码块按已读到的内容输出
+        yield _code_block(code_lines, code_language)
+
+
+def chunked(blocks: Iterable[Dict], size: int = MAX_CHILDREN_PER_REQUEST) -> Iterator[List[Dict]]:
+    chunk = []
+    for block in blocks:
+        chunk.append(block)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ============================================================================
+# 分批写入
+# ============================================================================
+
+@dataclass
+class WriteResult:
+    """一次追加写入的结果"""
+    blocks: int = 0              # 成功写入的块数
+    requests: int = 0            # 成功的批次数
+    retries: int = 0
+    seconds: float = 0.0
+    revision_id: Optional[int] = None
+    error: Optional[str] = None  # 失败原因；失败时文档中只有前 blocks 个块
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class DocWriter:
+    """
+    文档块分批写入器
+
+    Args:
+        token_provider: 返回 tenant_access_token 的函数（每次请求前调用，令牌由其负责缓存与刷新）
+        api_base: 飞书开放接口地址
+        chunk_size: 每批子块数（不超过接口上限 50）
+        max_qps: 单文档请求频率上限
+        max_retries: 单批最大重试次数
+        prefetch: 后台线程提前准备的批次数
+        timeout: 单次请求超时秒数
+        session: 共用的 requests.Session（不传则自建，close() 时关闭）
+    """
+
+    def __init__(self, token_provider: Callable[[], Optional[str]], api_base: str,
+                 chunk_size: int = MAX_CHILDREN_PER_REQUEST, max_qps: float = DOC_EDIT_QPS,
+                 max_retries: int = 4, prefetch: int = 4, timeout: float = 15.0, session=None):
+        import requests
+        self.token_provider = token_provider
+        self.api_base = api_base.rstrip("/")
+        self.chunk_size = max(1, min(chunk_size, MAX_CHILDREN_PER_REQUEST))
+        self.min_interval = 1.0 / max_qps if max_qps else 0.0
+        self.max_retries = max_retries
+        self.prefetch = max(1, prefetch)
+        self.timeout = timeout
+        # 复用连接，批量写入时避免每批重新握手
+        self._own_session = session is None
+        self._session = session or requests.Session()
+
+    def append(self, doc_id: str, content: str = None, blocks: Iterable[Dict] = None,
+               parent_id: str = None) -> WriteResult:
+        """
+        把 Markdown 正文（或已构建的块）追加到 parent_id（默认文档根块）的末尾
+
+        Returns:
+            WriteResult
+        """
+        source = blocks if blocks is not None else markdown_blocks(content or "")
+        url = f"{self.api_base}/docx/v1/documents/{doc_id}/blocks/{parent_id or doc_id}/children"
+        result = WriteResult()
+        started = time.time()
+
+        # 后台线程解析并序列化批次，最多领先 prefetch 批
+        chunks: "queue.Queue" = queue.Queue(maxsize=self.prefetch)
+        cancelled = threading.Event()
+
+        def put(item) -> bool:
+            while not cancelled.is_set():
+                try:
+                    chunks.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for chunk in chunked(source, self.chunk_size):
+                    body = json.dumps({"children": chunk}, ensure_ascii=False).encode("utf-8")
+                    if not put((len(chunk), body)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        threading.Thread(target=produce, name="doc-writer-prepare", daemon=True).start()
+
+        next_slot = 0.0
+        try:
+            while True:
+                item = chunks.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    result.error = f"构建文档块失败: {item}"
+                    break
+                count, body = item
+                error, next_slot = self._post_chunk(url, body, next_slot, result)
+                if error:
+                    result.error = error
+                    break
+                result.blocks += count
+                result.requests += 1
+        finally:
+            cancelled.set()
+            result.seconds = time.time() - started
+        return result
+
+    def _post_chunk(self, url: str, body: bytes, next_slot: float, result: WriteResult):
+        """提交一批（按需重试，同一批始终使用同一个 client_token），返回 (错误信息, 下次可提交时间)"""
+        params = {"document_revision_id": -1, "client_token": str(uuid.uuid4())}
+        error = None
+        for attempt in range(self.max_retries + 1):
+            wait = next_slot - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            next_slot = time.time() + self.min_interval
+
+            token = self.token_provider()
+            if not token:
+                return "无法获取飞书访问令牌", next_slot
+            headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json; charset=utf-8"}
+            try:
+                resp = self._session.post(url, params=params, data=body, headers=headers, timeout=self.timeout)
+                status = resp.status_code
+                payload = resp.json() if status < 500 else {}
+            except Exception as e:
+                status, payload, error = 0, {}, f"请求异常: {e}"
+            else:
+                code = payload.get("code")
+                if code == 0:
+                    result.revision_id = payload.get("data", {}).get("document_revision_id", result.revision_id)
+                    return None, next_slot
+                error = f"code={code}, msg={payload.get('msg', '')}" if payload else f"HTTP {status}"
+                if status != 429 and status < 500 and code not in RETRY_CODES:
+                    return error, next_slot
+
+            if attempt < self.max_retries:
+                result.retries += 1
+                delay = min(8.0, 0.5 * 2 ** attempt) * random.uniform(0.8, 1.2)
+                logger.warning("[文档写入] 批次提交失败（%s），%.1f 秒后重试", error, delay)
+                next_slot = max(next_slot, time.time() + delay)
+        return error, next_slot
+
+    def close(self):
+        if self._own_session:
+            self._session.close()
+
+
+# ============================================================================
+# 吞吐测试
+# ============================================================================
+
+class FakeDocServer:
+    """
+    创建子块接口的本地替身：限制每批子块数与单文档请求频率，按 client_token 去重，
+    每隔 fail_every 次请求在写入后返回 502，模拟"已生效但响应丢失"
+    """
+
+    def __init__(self, latency: float = 0.05, qps: float = DOC_EDIT_QPS, fail_every: int = 0):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlparse, parse_qs
+
+        self.latency = latency
+        self.qps = qps
+        self.fail_every = fail_every
+        self.children: List[Dict] = []
+        self.requests = 0
+        self.rejected = 0
+        self._tokens: Dict[str, int] = {}
+        self._last = 0.0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, payload: Dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                token = parse_qs(urlparse(self.path).query).get("client_token", [""])[0]
+                time.sleep(server.latency)
+                status, payload = server.handle(body.get("children", []), token)
+                self._reply(status, payload)
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}/open-apis"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def handle(self, children: List[Dict], token: str):
+        with self._lock:
+            self.requests += 1
+            now = time.time()
+            if self.qps and now - self._last < 1.0 / self.qps * 0.9:
+                self.rejected += 1
+                return 400, {"code": 99991400, "msg": "request trigger frequency limit"}
+            self._last = now
+            if len(children) > MAX_CHILDREN_PER_REQUEST:
+                return 400, {"code": 1770001, "msg": "invalid param: children exceeds limit"}
+            if token and token in self._tokens:
+                return 200, {"code": 0, "data": {"document_revision_id": self._tokens[token]}}
+            self.children.extend(children)
+            revision = len(self.children)
+            if token:
+                self._tokens[token] = revision
+            if self.fail_every and self.requests % self.fail_every == 0:
+                return 502, {}
+            return 200, {"code": 0, "data": {"document_revision_id": revision}}
+
+    def stop(self):
+        self._httpd.shutdown()
+
+
+def measure_throughput(paragraphs: int = 5000, latency: float = 0.05, qps: float = DOC_EDIT_QPS,
+                       fail_every: int = 0) -> Dict[str, float]:
+    """
+    生成 paragraphs 段的 Markdown 文档（穿插标题、列表、代码块），分别用旧方式（一次提交全部段落）
+    与 DocWriter 写入替身服务，返回耗时、请求数与顺序/去重校验结果
+    """
+    lines = []
+    for i in range(paragraphs):
+        if i % 100 == 0:
+            lines.append(f"## 第 {i // 100 + 1} 节")
+        if i % 50 == 25:
+            lines += ["```python", f"print({i})", "```"]
+        elif i % 10 == 5:
+            lines.append(f"- 列表项 {i}，含 **粗体** 与 `代码`")
+        else:
+            lines.append(f"第 {i} 段：飞书文档写入吞吐测试。")
+    content = "\n".join(lines)
+
+    started = time.time()
+    blocks = list(markdown_blocks(content))
+    parse_seconds = time.time() - started
+
+    # 旧方式：全部段落一次提交
+    legacy = FakeDocServer(latency, qps=0)
+    import requests
+    started = time.time()
+    resp = requests.post(f"{legacy.url}/docx/v1/documents/d/blocks/d/children",
+                         json={"children": blocks}, timeout=60)
+    legacy_seconds = time.time() - started
+    legacy_code = resp.json().get("code")
+    legacy.stop()
+
+    server = FakeDocServer(latency, qps, fail_every)
+    writer = DocWriter(lambda: "token", server.url, max_qps=qps)
+    result = writer.append("d", content)
+    writer.close()
+    server.stop()
+
+    written = [json.dumps(block, sort_keys=True) for block in server.children]
+    expected = [json.dumps(block, sort_keys=True) for block in blocks]
+    return {
+        "paragraphs": paragraphs,
+        "blocks": len(blocks),
+        "parse_seconds": parse_seconds,
+        "legacy_code": legacy_code,
+        "legacy_seconds": legacy_seconds,
+        "seconds": result.seconds,
+        "requests": result.requests,
+        "retries": result.retries,
+        "server_requests": server.requests,
+        "server_rejected": server.rejected,
+        "blocks_per_s": result.blocks / result.seconds if result.seconds else 0.0,
+        "in_order": written == expected,
+        "error": result.error,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="飞书云文档分批写入")
+    parser.add_argument("--bench", type=int, metavar="N", help="测量 N 段文档的写入吞吐")
+    parser.add_argument("--latency", type=float, default=0.05, help="替身服务单次请求耗时（秒）")
+    parser.add_argument("--qps", type=float, default=DOC_EDIT_QPS, help="单文档请求频率上限")
+    parser.add_argument("--fail-every", type=int, default=0, help="每 N 次请求模拟一次响应丢失")
+    args = parser.parse_args()
+    if args.bench:
+        r = measure_throughput(args.bench, args.latency, args.qps, args.fail_every)
+        print(f"{r['paragraphs']} 段 → {r['blocks']} 个块，解析 {r['parse_seconds'] * 1000:.0f}ms")
+        print(f"  旧方式（一次提交）: code={r['legacy_code']}, {r['legacy_seconds']:.2f}s")
+        print(f"  DocWriter: {r['seconds']:.2f}s, {r['requests']} 批, 重试 {r['retries']} 次, "
+              f"{r['blocks_per_s']:.0f} 块/s, 服务端收到 {r['server_requests']} 次请求（频控拒绝 {r['server_rejected']}）")
+        print(f"  顺序与去重校验: {'通过' if r['in_order'] else '失败'}" + (f", 错误: {r['error']}" if r['error'] else ""))
@@ -0,0 +1,342 @@
+"""
+ComfyUI 端点解析模块
+维护一组按优先级排列的候选地址，后台持续探测可用性与往返延迟（RTT），选出当前使用的端点：
+- 候选来源：配置地址（config.json5 的 comfyUI.url 或 host:port，以及 comfyUI.endpoints）
+  → ngrok 本地 API（127.0.0.1:4040）发现的隧道地址 → 默认公网地址
+- 当前端点连续探测失败达到阈值才切换，避免偶发超时来回跳；更高优先级的端点连续恢复若干次后切回
+- 请求失败时调用 report_failure() 立即触发一次探测，不必等到下一个探测周期；
+  当前端点异常期间按较短间隔探测
+- 切换只替换一个引用并通知订阅者（ComfyUIClient 更新 api_url）；已开始的任务使用
+  ComfyUIClient.pinned() 固定在提交时的端点上，上传、轮询、下载不会中途换到另一台服务器
+
+python endpoint_resolver.py --bench 用两个本地替身服务器测量主端点宕机后的切换耗时。
+"""
+import json
+import time
+import logging
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# ngrok 本地 API
+NGROK_API_URL = "http://127.0.0.1:4040/api/tunnels"
+
+# 默认 ngrok 公网地址（本地 API 不可用时作为最后的候选）
+DEFAULT_TUNNEL_URL = "https://candi-sporogonial-eliz.ngrok-free.dev"
+
+# 候选层级：同层级内按 RTT 选择，不同层级按层级优先
+TIER_CONFIGURED = 0
+TIER_TUNNEL = 1
+TIER_FALLBACK = 2
+
+# 探测请求不走系统代理（与 ComfyUIClient 访问远程服务器时一致）
+_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def probe_endpoint(url: str, timeout: float = 3.0) -> Optional[float]:
+    """GET /system_stats，成功返回往返耗时（秒），失败返回 None"""
+    started = time.perf_counter()
+    try:
+        with _opener.open(f"{url}/system_stats", timeout=timeout) as resp:
+            resp.read()
+            if resp.status != 200:
+                return None
+    except Exception:
+        return None
+    return time.perf_counter() - started
+
+
+def discover_tunnels(api_url: str = NGROK_API_URL, timeout: float = 2.0) -> List[str]:
+    """通过 ngrok 本地 API 获取公网地址（https 在前），不可用时返回空列表"""
+    try:
+        with _opener.open(api_url, timeout=timeout) as resp:
+            data = json.loads(resp.read().decode())
+    except Exception:
+        return []
+    urls = [tunnel.get("public_url", "") for tunnel in data.get("tunnels", [])]
+    return [url.rstrip("/") for url in sorted(urls, key=lambda u: not u.startswith("https://")) if url]
+
+
+@dataclass
+class Endpoint:
+    """候选端点及其探测状态"""
+    url: str
+    tier: int
+    rtt: Optional[float] = None     # RTT 指数滑动平均（秒）
+    successes: int = 0              # 连续成功次数
+    failures: int = 0               # 连续失败次数
+    checked_at: float = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.successes > 0
+
+    def record(self, rtt: Optional[float], now: float):
+        self.checked_at = now
+        if rtt is None:
+            self.failures += 1
+            self.successes = 0
+            return
+        self.failures = 0
+        self.successes += 1
+        self.rtt = rtt if self.rtt is None else 0.7 * self.rtt + 0.3 * rtt
+
+
+class EndpointResolver:
+    """
+    ComfyUI 端点解析器
+
+    Args:
+        configured: 配置中的地址（按优先级）
+        tunnel_api: ngrok 本地 API 地址，None 表示不发现隧道
+        fallback_urls: 最后的候选地址
+        interval: 正常探测间隔（秒）
+        fast_interval: 当前端点异常或尚无可用端点时的探测间隔
+        timeout: 单次探测超时
+        fail_threshold: 当前端点连续失败多少次后切换
+        rise_threshold: 更高优先级端点连续成功多少次后切回
+        probe / discover: 探测与隧道发现函数（默认走 HTTP）
+    """
+
+    def __init__(self, configured: Sequence[str], tunnel_api: Optional[str] = NGROK_API_URL,
+                 fallback_urls: Sequence[str] = (DEFAULT_TUNNEL_URL,), interval: float = 15.0,
+                 fast_interval: float = 1.0, timeout: float = 3.0, fail_threshold: int = 2,
+                 rise_threshold: int = 2, probe: Callable[[str, float], Optional[float]] = probe_endpoint,
+                 discover: Callable[[str], List[str]] = discover_tunnels):
+        self.tunnel_api = tunnel_api
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.timeout = timeout
+        self.fail_threshold = fail_threshold
+        self.rise_threshold = rise_threshold
+        self._probe = probe
+        self._discover = discover
+        self._configured = [url.rstrip("/") for url in configured if url]
+        self._fallback = [url.rstrip("/") for url in fallback_urls if url]
+        self._endpoints: Dict[str, Endpoint] = {}
+        self._active: Optional[Endpoint] = None
+        self._down_since: Optional[float] = None
+        self._subscribers: List[Callable[[Optional[str], str], None]] = []
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="endpoint-probe")
+        self._stats = {"probes": 0, "switches": 0, "failovers": []}
+        self._sync_candidates([])
+
+    # ==================== 候选管理 ====================
+
+    def _sync_candidates(self, tunnels: List[str]):
+        """按层级重建候选集合，保留已有端点的探测状态（调用方不持有 _lock）"""
+        ordered = [(url, TIER_CONFIGURED) for url in self._configured]
+        ordered += [(url, TIER_TUNNEL) for url in tunnels]
+        ordered += [(url, TIER_FALLBACK) for url in self._fallback]
+        with self._lock:
+            endpoints = {}
+            for url, tier in ordered:
+                if url in endpoints:
+                    continue
+                endpoint = self._endpoints.get(url) or Endpoint(url, tier)
+                endpoint.tier = tier
+                endpoints[url] = endpoint
+            self._endpoints = endpoints
+
+    def set_configured(self, urls: Sequence[str]):
+        """配置地址变化（config.json5 热更新）后替换配置层候选，并尽快重新探测"""
+        self._configured = [url.rstrip("/") for url in urls if url]
+        self._sync_candidates([e.url for e in self.endpoints() if e.tier == TIER_TUNNEL])
+        self._wake.set()
+
+    def endpoints(self) -> List[Endpoint]:
+        with self._lock:
+            return list(self._endpoints.values())
+
+    # ==================== 当前端点 ====================
+
+    @property
+    def active(self) -> Optional[Endpoint]:
+        return self._active
+
+    @property
+    def active_url(self) -> str:
+        """当前端点；尚无可用端点时返回优先级最高的候选"""
+        active = self._active
+        if active:
+            return active.url
+        candidates = self.endpoints()
+        return candidates[0].url if candidates else ""
+
+    def subscribe(self, callback: Callable[[Optional[str], str], None]):
+        """注册切换回调 callback(old_url, new_url)"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def report_failure(self, url: str):
+        """请求方连接端点失败：计为一次探测失败并立即触发一次探测"""
+        with self._lock:
+            endpoint = self._endpoints.get(url.rstrip("/"))
+            if endpoint is None:
+                return
+            endpoint.record(None, time.monotonic())
+            if endpoint is self._active and self._down_since is None:
+                self._down_since = endpoint.checked_at
+        self._wake.set()
+
+    # ==================== 探测与选择 ====================
+
+    def refresh(self) -> Optional[str]:
+        """发现隧道、并发探测全部候选并重新选择，返回当前端点地址（无可用端点时为 None）"""
+        with self._refresh_lock:
+            if self.tunnel_api:
+                self._sync_candidates(self._discover(self.tunnel_api))
+            candidates = self.endpoints()
+            results = list(self._executor.map(lambda e: self._probe(e.url, self.timeout), candidates))
+            now = time.monotonic()
+            with self._lock:
+                for endpoint, rtt in zip(candidates, results):
+                    endpoint.record(rtt, now)
+                self._stats["probes"] += len(candidates)
+            self._select(now)
+            active = self._active
+            return active.url if active and active.healthy else None
+
+    def _select(self, now: float):
+        with self._lock:
+            current = self._active
+            healthy = [e for e in self._endpoints.values() if e.healthy]
+            current_ok = current is not None and current.url in self._endpoints and \
+                current.failures < self.fail_threshold
+            if current is not None and current.failures and self._down_since is None:
+                self._down_since = now
+            if current_ok:
+                # 更高层级的端点稳定恢复后切回
+                better = [e for e in healthy if e.tier < current.tier and e.successes >= self.rise_threshold]
+                chosen = min(better, key=lambda e: (e.tier, e.rtt)) if better else current
+            else:
+                chosen = min(healthy, key=lambda e: (e.tier, e.rtt)) if healthy else None
+            if chosen is None or chosen is current:
+                if current_ok and current.healthy:
+                    self._down_since = None
+                return
+            old_url = current.url if current else None
+            self._active = chosen
+            self._stats["switches"] += 1
+            failover = None
+            if self._down_since is not None and old_url is not None and not current_ok:
+                failover = now - self._down_since
+                self._stats["failovers"].append(failover)
+            self._down_since = None
+            subscribers = list(self._subscribers)
+
+        if failover is not None:
+            logger.warning("[端点] %s 不可达，%.2f 秒后切换到 %s（RTT %.0f ms）",
+                           old_url, failover, chosen.url, chosen.rtt * 1000)
+        else:
+            logger.info("[端点] 使用 ComfyUI 端点 %s（RTT %.0f ms）", chosen.url, chosen.rtt * 1000)
+        for callback in subscribers:
+            try:
+                callback(old_url, chosen.url)
+            except Exception:
+                logger.exception("[端点] 切换回调执行失败")
+
+    # ==================== 后台探测 ====================
+
+    def start(self):
+        """启动后台探测线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="endpoint-resolver", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("[端点] 探测失败")
+            active = self._active
+            degraded = active is None or not active.healthy or self._down_since is not None
+            self._wake.wait(self.fast_interval if degraded else self.interval)
+            self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            failovers = list(self._stats["failovers"])
+            return {
+                "active": self._active.url if self._active else None,
+                "probes": self._stats["probes"],
+                "switches": self._stats["switches"],
+                "failovers": len(failovers),
+                "failover_max": max(failovers) if failovers else 0.0,
+                "endpoints": {e.url: None if e.rtt is None else round(e.rtt * 1000, 1)
+                              for e in self._endpoints.values()},
+            }
+
+
+# ============================================================================
+# 切换耗时测量
+# ============================================================================
+
+def measure_failover(interval: float = 15.0, fast_interval: float = 0.5, report: bool = True,
+                     timeout: float = 1.0) -> Dict[str, float]:
+    """
+    启动两个本地替身服务器，主服务器作为配置地址、备用服务器作为发现的隧道地址，
+    主服务器停止后测量切换到备用服务器的耗时
+
+    Args:
+        report: 模拟请求方在主服务器停止后立即 report_failure()；False 时只靠周期探测
+    """
+    from fake_comfyui import start_fake_server, stop_fake_server
+
+    primary, primary_url = start_fake_server()
+    backup, backup_url = start_fake_server()
+    resolver = EndpointResolver([primary_url], tunnel_api=NGROK_API_URL, fallback_urls=(),
+                                interval=interval, fast_interval=fast_interval, timeout=timeout,
+                                discover=lambda api_url: [backup_url])
+    switched = threading.Event()
+    resolver.subscribe(lambda old, new: new == backup_url and switched.set())
+    try:
+        resolver.start()
+        deadline = time.monotonic() + 10
+        while resolver.active_url != primary_url or not resolver.active:
+            if time.monotonic() > deadline:
+                raise RuntimeError("主端点未就绪")
+            time.sleep(0.01)
+        stop_fake_server(primary)
+        down_at = time.monotonic()
+        if report:
+            resolver.report_failure(primary_url)
+        if not switched.wait(interval * resolver.fail_threshold + 30):
+            raise RuntimeError("未切换到备用端点")
+        return {"failover_seconds": time.monotonic() - down_at, "report": report,
+                "interval": interval, "fast_interval": fast_interval}
+    finally:
+        resolver.stop()
+        stop_fake_server(backup)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ComfyUI 端点切换耗时测量")
+    parser.add_argument("--bench", action="store_true", help="用本地替身服务器测量主端点宕机后的切换耗时")
+    parser.add_argument("--interval", type=float, default=15.0, help="正常探测间隔（秒）")
+    parser.add_argument("--fast-interval", type=float, default=0.5, help="异常时的探测间隔（秒）")
+    args = parser.parse_args()
+    if args.bench:
+        for report in (True, False):
+            result = measure_failover(args.interval, args.fast_interval, report)
+            mode = "请求失败上报" if report else "仅周期探测"
+            print(f"{mode}: 切换耗时 {result['failover_seconds']:.2f}s "
+                  f"（探测间隔 {args.interval:g}s，异常时 {args.fast_interval:g}s）")
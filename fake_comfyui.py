@@ -0,0 +1,434 @@
+"""
+ComfyUI 本地替身服务器
+仅依赖标准库，模拟 ComfyUI 的 HTTP 接口与执行耗时，用于在没有 GPU 的环境下
+对提交/轮询/批量/调度等逻辑做吞吐与故障测试。
+
+支持的接口：
+- GET  /system_stats
+- POST /prompt              提交工作流，返回 prompt_id
+- GET  /history[/{id}]      执行结果（outputs 中的 images 列表与真实 ComfyUI 格式一致；/history?max_items=N 返回最近 N 条）
+- GET  /queue               queue_running / queue_pending
+- POST /queue               {"delete": [...]} 或 {"clear": true}
+- POST /interrupt           中断正在执行的任务（带 {"prompt_id": ...} 时只在正在执行的是该任务时中断）
+- GET  /view                下载输出图片
+- POST /upload/image        接收上传（仅记录文件名）
+
+耗时模型（FakeCostModel）：
+每次执行 = 固定调度开销 + 模型加载（加载器输入与上一次执行不同才计入）
+         + 每个 SaveImage 节点的采样耗时（latent batch 内后续图片按 batch_efficiency 折算）
+
+用法：python fake_comfyui.py --port 8189 [--output-dir DIR]
+      python fake_comfyui.py --bench-batch 4     # 串行 vs 批量文生图吞吐
+"""
+import os
+import re
+import json
+import time
+import uuid
+import zlib
+import struct
+import logging
+import argparse
+import threading
+from collections import deque
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# 加载器节点：其输入决定了需要驻留的模型
+LOADER_CLASS_TYPES = ("UNETLoader", "CLIPLoader", "VAELoader", "LoraLoaderModelOnly",
+                      "CheckpointLoaderSimple", "DualCLIPLoader")
+LATENT_CLASS_TYPES = ("EmptyLatentImage", "EmptySD3LatentImage")
+
+
+# ============================================================================
+# 耗时模型
+# ============================================================================
+
+@dataclass
+class FakeCostModel:
+    """模拟执行耗时（秒）"""
+    submit_overhead: float = 0.05   # 每次执行的调度/编码开销
+    model_load: float = 0.5         # 模型集合变化时的加载耗时
+    per_image: float = 0.2          # 单张图片的采样耗时
+    batch_efficiency: float = 0.6   # latent batch 中后续每张图片相对单张的耗时比例
+
+    def execution_time(self, graph: Dict, model_changed: bool) -> float:
+        seconds = self.submit_overhead + (self.model_load if model_changed else 0.0)
+        for batch in output_batches(graph).values():
+            seconds += self.per_image * (1 + (batch - 1) * self.batch_efficiency)
+        return seconds
+
+
+def model_signature(graph: Dict) -> Tuple:
+    """加载器节点的输入集合，用于判断是否需要重新加载模型"""
+    items = []
+    for node in graph.values():
+        if node.get("class_type") in LOADER_CLASS_TYPES:
+            inputs = {k: v for k, v in node.get("inputs", {}).items() if not isinstance(v, list)}
+            items.append((node["class_type"], json.dumps(inputs, sort_keys=True)))
+    return tuple(sorted(items))
+
+
+def output_batches(graph: Dict) -> Dict[str, int]:
+    """每个 SaveImage 节点输出的图片数量（取上游 latent 节点的 batch_size）"""
+    def batch_of(node_id: str, seen: set) -> int:
+        if node_id in seen or node_id not in graph:
+            return 1
+        seen.add(node_id)
+        node = graph[node_id]
+        if node.get("class_type") in LATENT_CLASS_TYPES:
+            return int(node.get("inputs", {}).get("batch_size", 1))
+        batch = 1
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                batch = max(batch, batch_of(value[0], seen))
+        return batch
+
+    return {node_id: batch_of(node_id, set()) for node_id, node in graph.items()
+            if node.get("class_type") == "SaveImage"}
+
+
+def _tiny_png() -> bytes:
+    """1x1 白色 PNG"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+    header = struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(b"\x00\xff\xff\xff")) + chunk(b"IEND", b""))
+
+
+# ============================================================================
+# 模拟服务器状态
+# ============================================================================
+
+class FakeComfyUIState:
+    """队列、执行线程与历史记录"""
+
+    def __init__(self, cost: FakeCostModel = None, output_dir: Optional[str] = None):
+        self.cost = cost or FakeCostModel()
+        self.output_dir = output_dir
+        self.pending: deque = deque()
+        self.running: Optional[list] = None
+        self.history: Dict[str, Dict] = {}
+        self.files: Dict[Tuple[str, str], bytes] = {}
+        self.uploads: List[str] = []
+        self.counter = 0
+        self.file_counter = 0
+        self.loaded_models: Tuple = ()
+        self.stats = {"prompts": 0, "executions": 0, "model_loads": 0, "images": 0, "busy_seconds": 0.0}
+        self._lock = threading.Condition()
+        self._interrupt = threading.Event()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, name="fake-comfyui-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, graph: Dict, client_id: str = "", prompt_id: Optional[str] = None) -> Tuple[str, int]:
+        with self._lock:
+            prompt_id = prompt_id or str(uuid.uuid4())
+            self.counter += 1
+            self.stats["prompts"] += 1
+            self.pending.append([self.counter, prompt_id, graph, {"client_id": client_id}, []])
+            self._lock.notify_all()
+            return prompt_id, self.counter
+
+    def delete(self, prompt_ids: List[str]) -> int:
+        with self._lock:
+            before = len(self.pending)
+            self.pending = deque(item for item in self.pending if item[1] not in prompt_ids)
+            return before - len(self.pending)
+
+    def clear(self):
+        with self._lock:
+            self.pending.clear()
+
+    def interrupt(self, prompt_id: Optional[str] = None):
+        with self._lock:
+            if prompt_id and (self.running is None or self.running[1] != prompt_id):
+                return
+            self._interrupt.set()
+
+    def queue_snapshot(self) -> Dict:
+        with self._lock:
+            return {"queue_running": [self.running] if self.running else [],
+                    "queue_pending": list(self.pending)}
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._lock.notify_all()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self.pending and not self._stopped:
+                    self._lock.wait()
+                if self._stopped:
+                    return
+                item = self.running = self.pending.popleft()
+            self._interrupt.clear()
+            _, prompt_id, graph, _, _ = item
+            signature = model_signature(graph)
+            model_changed = signature != self.loaded_models
+            seconds = self.cost.execution_time(graph, model_changed)
+            started_ms = int(time.time() * 1000)
+            interrupted = self._interrupt.wait(seconds)
+            ended_ms = int(time.time() * 1000)
+            with self._lock:
+                self.running = None
+                self.stats["executions"] += 1
+                self.stats["busy_seconds"] += (ended_ms - started_ms) / 1000
+                if model_changed:
+                    self.stats["model_loads"] += 1
+                    self.loaded_models = signature
+                if interrupted:
+                    self.history[prompt_id] = {
+                        "prompt": item, "outputs": {},
+                        "status": {"status_str": "error", "completed": False,
+                                   "messages": [["execution_start", {"prompt_id": prompt_id, "timestamp": started_ms}],
+                                                ["execution_interrupted", {"prompt_id": prompt_id, "timestamp": ended_ms}]]},
+                    }
+                    continue
+                self.history[prompt_id] = {
+                    "prompt": item, "outputs": self._write_outputs(graph),
+                    "status": {"status_str": "success", "completed": True,
+                               "messages": [["execution_start", {"prompt_id": prompt_id, "timestamp": started_ms}],
+                                            ["execution_success", {"prompt_id": prompt_id, "timestamp": ended_ms}]]},
+                }
+
+    def _write_outputs(self, graph: Dict) -> Dict:
+        outputs = {}
+        png = _tiny_png()
+        for node_id, batch in output_batches(graph).items():
+            prefix = str(graph[node_id].get("inputs", {}).get("filename_prefix", "ComfyUI"))
+            parts = re.split(r"[\\/]", prefix)
+            subfolder, base = "/".join(parts[:-1]), parts[-1]
+            images = []
+            for _ in range(batch):
+                self.file_counter += 1
+                filename = f"{base}_{self.file_counter:05d}_.png"
+                self.files[(subfolder, filename)] = png
+                if self.output_dir:
+                    folder = os.path.join(self.output_dir, *subfolder.split("/")) if subfolder else self.output_dir
+                    os.makedirs(folder, exist_ok=True)
+                    with open(os.path.join(folder, filename), "wb") as f:
+                        f.write(png)
+                images.append({"filename": filename, "subfolder": subfolder, "type": "output"})
+            self.stats["images"] += batch
+            outputs[node_id] = {"images": images}
+        return outputs
+
+
+# ============================================================================
+# HTTP 接口
+# ============================================================================
+
+class _Handler(BaseHTTPRequestHandler):
+    state: FakeComfyUIState = None
+
+    def log_message(self, format, *args):
+        logger.debug("[FakeComfyUI] " + format, *args)
+
+    def _send_json(self, payload, status: int = 200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        if path == "/system_stats":
+            self._send_json({"system": {"os": "fake", "python_version": "", "embedded_python": False},
+                             "devices": []})
+        elif path == "/queue":
+            self._send_json(self.state.queue_snapshot())
+        elif path == "/history":
+            max_items = parse_qs(url.query).get("max_items", [""])[0]
+            items = list(self.state.history.items())
+            if max_items.isdigit():
+                items = items[-int(max_items):] if int(max_items) else []
+            self._send_json(dict(items))
+        elif path.startswith("/history/"):
+            prompt_id = path[len("/history/"):]
+            item = self.state.history.get(prompt_id)
+            self._send_json({prompt_id: item} if item else {})
+        elif path == "/view":
+            query = parse_qs(url.query)
+            key = (query.get("subfolder", [""])[0], query.get("filename", [""])[0])
+            data = self.state.files.get(key)
+            if data is None:
+                self._send_json({"error": "not found"}, 404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip("/")
+        body = self._read_body()
+        if path == "/prompt":
+            try:
+                payload = json.loads(body or b"{}")
+                graph = payload["prompt"]
+            except (ValueError, KeyError):
+                self._send_json({"error": "invalid prompt"}, 400)
+                return
+            prompt_id, number = self.state.submit(graph, payload.get("client_id", ""),
+                                                  payload.get("prompt_id"))
+            self._send_json({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+        elif path == "/queue":
+            payload = json.loads(body or b"{}")
+            if payload.get("clear"):
+                self.state.clear()
+            if payload.get("delete"):
+                self.state.delete(payload["delete"])
+            self._send_json({})
+        elif path == "/interrupt":
+            payload = json.loads(body or b"{}")
+            self.state.interrupt(payload.get("prompt_id"))
+            self._send_json({})
+        elif path == "/upload/image":
+            match = re.search(rb'filename="([^"]+)"', body)
+            name = match.group(1).decode("utf-8", "replace") if match else f"upload_{uuid.uuid4().hex}.png"
+            self.state.uploads.append(name)
+            self._send_json({"name": name, "subfolder": "", "type": "input"})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+
+def start_fake_server(port: int = 0, cost: FakeCostModel = None,
+                      output_dir: Optional[str] = None) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    在后台线程启动替身服务器
+
+    Returns:
+        (server, api_url)：server.state 为 FakeComfyUIState，用完调用 stop_fake_server(server)
+    """
+    state = FakeComfyUIState(cost, output_dir)
+    handler = type("FakeComfyUIHandler", (_Handler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, name="fake-comfyui-http", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def stop_fake_server(server: ThreadingHTTPServer):
+    server.state.stop()
+    server.shutdown()
+    server.server_close()
+
+
+# ============================================================================
+# 吞吐测量
+# ============================================================================
+
+def _wait_history(api_url: str, prompt_id: str, interval: float = 0.02, timeout: float = 120) -> Dict:
+    """高频轮询 /history，排除轮询间隔对测量的影响"""
+    from urllib import request
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with request.urlopen(f"{api_url}/history/{prompt_id}", timeout=5) as resp:
+            result = json.loads(resp.read().decode("utf-8"))
+        if prompt_id in result:
+            return result[prompt_id]
+        time.sleep(interval)
+    raise TimeoutError(prompt_id)
+
+
+def measure_batch_throughput(count: int = 4, cost: FakeCostModel = None) -> Dict[str, float]:
+    """
+    对比文生图的三种提交方式生成 count 张图片的耗时：
+    - serial: 每张图单独 queue_prompt
+    - fan_out: 不同提示词复制子图后一次提交
+    - latent_batch: 同一提示词设置 batch_size 后一次提交
+    """
+    from Comfyui import (ComfyUIClient, ComfyUIWorkflow, config, fan_out_workflow,
+                         find_nodes_by_class, generate_random_seed, LATENT_CLASS_TYPES)
+
+    t2i = config.text_to_image_config
+    handler = ComfyUIWorkflow(seed_id=str(t2i["seed_id"]), input_image_id=None,
+                              output_image_id=str(t2i["output_image_id"]),
+                              workflow=t2i["workflow"], prompt_node_id=t2i.get("prompt_node_id"))
+    handler.load_workflow()
+    roots = [handler.prompt_node_id, handler.seed_id, handler.output_image_id]
+
+    server, api_url = start_fake_server(cost=cost)
+    client = ComfyUIClient(api_url)
+    results = {}
+    try:
+        def run(graphs: List[Dict]) -> Tuple[float, int]:
+            start = time.perf_counter()
+            images = 0
+            for graph in graphs:
+                item = _wait_history(api_url, client.queue_prompt(graph))
+                images += sum(len(o.get("images", [])) for o in item["outputs"].values())
+            return time.perf_counter() - start, images
+
+        # 预热：让替身服务器先加载一次模型，三种方式都从模型已驻留开始计时
+        run([handler.create_workflow_copy()])
+
+        serial = []
+        for i in range(count):
+            graph = handler.create_workflow_copy()
+            graph[handler.prompt_node_id]["inputs"]["text"] = f"prompt {i}"
+            graph[handler.seed_id]["inputs"]["seed"] = generate_random_seed()
+            serial.append(graph)
+
+        fan_out, mappings = fan_out_workflow(handler.create_workflow_copy(), roots, count)
+        for i, mapping in enumerate(mappings):
+            fan_out[mapping[handler.prompt_node_id]]["inputs"]["text"] = f"prompt {i}"
+            fan_out[mapping[handler.seed_id]]["inputs"]["seed"] = generate_random_seed()
+
+        latent = handler.create_workflow_copy()
+        for node_id in find_nodes_by_class(latent, LATENT_CLASS_TYPES):
+            latent[node_id]["inputs"]["batch_size"] = count
+
+        for name, graphs in (("serial", serial), ("fan_out", [fan_out]), ("latent_batch", [latent])):
+            seconds, images = run(graphs)
+            results[f"{name}_seconds"] = seconds
+            results[f"{name}_images_per_second"] = images / seconds if seconds else 0.0
+    finally:
+        stop_fake_server(server)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ComfyUI 本地替身服务器")
+    parser.add_argument("--port", type=int, default=8189)
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--per-image", type=float, default=FakeCostModel.per_image)
+    parser.add_argument("--model-load", type=float, default=FakeCostModel.model_load)
+    parser.add_argument("--bench-batch", type=int, default=0, metavar="N",
+                        help="测量 N 张图片串行提交与批量提交的吞吐后退出")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.bench_batch:
+        bench_cost = FakeCostModel(per_image=args.per_image, model_load=args.model_load)
+        for key, value in measure_batch_throughput(args.bench_batch, bench_cost).items():
+            print(f"{key}: {value:.3f}")
+        raise SystemExit(0)
+    srv, api_url = start_fake_server(args.port, FakeCostModel(per_image=args.per_image,
+                                                              model_load=args.model_load),
+                                     args.output_dir)
+    print(f"[FakeComfyUI] 已启动: {api_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stop_fake_server(srv)
@@ -5,57 +5,100 @@
 import json
 import time
 import os
-import tempfile
-from typing import Optional, Dict
-from dotenv import load_dotenv
+import uuid
+import threading
+from concurrent.futures import Future
+from typing import Callable, Optional, Dict, List, Tuple
 
-load_dotenv()
+import resilience
+from resilience import endpoint_of, retry_status
+from startup import load_env
+from image_buffer import (ImageBuffer, ImageSource, disk_io, open_source,
+                          source_digest, source_name, source_size)
+
+load_env()
 
 # ============================================================================
-# 飞书客户端 - 统一管理类
+# tenant_access_token 管理 - 进程内共享
 # ============================================================================
 
-class FeishuClient:
+class TenantTokenManager:
     """
-    飞书客户端 - 统一管理所有飞书相关功能
-    包含：消息收发、图片上传下载、长连接管理
+    tenant_access_token 管理器
+    - 同一应用在进程内只有一个实例（get_token_manager），SDK 调用与所有 REST 请求共用同一个 token
+    - 过期时间按接口返回的 expire 计算；后台线程在过期前 refresh_ahead 秒主动刷新
+    - 刷新为 single-flight：同一时刻只有一个线程请求接口，其余线程等待该结果
     """
     
-    def __init__(self, app_id: str, app_secret: str, api_base: str = "https://open.feishu.cn/open-apis"):
+    def __init__(self, app_id: str, app_secret: str, api_base: str,
+                 refresh_ahead: float = 300.0, min_valid: float = 60.0, timeout: float = 10.0):
         self.app_id = app_id
         self.app_secret = app_secret
         self.api_base = api_base
-        self._client = None
-        self._ws_client = None
-        self._token_cache = {"token": None, "expires_at": 0}
-    
-    # ==================== 客户端设置 ====================
+        self.refresh_ahead = refresh_ahead
+        self.min_valid = min_valid
+        self.timeout = timeout
+        self._token = None
+        self._expires_at = 0.0
+        self._refreshing = False
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._refresher = None
+        self.stats = {"fetches": 0, "failures": 0, "waits": 0}
     
-    def set_client(self, client):
-        """设置飞书SDK客户端"""
-        self._client = client
+    def _valid_for(self, seconds: float) -> bool:
+        """token 在 seconds 秒后仍有效（调用方持有锁）"""
+        return bool(self._token) and self._expires_at - time.time() > seconds
     
-    def set_ws_client(self, ws_client):
-        """设置WebSocket客户端"""
-        self._ws_client = ws_client
-    
-    # ==================== Token管理 ====================
+    def get(self) -> Optional[str]:
+        """返回有效 token；缓存不可用时同步刷新"""
+        with self._cond:
+            if self._refresher is None:
+                self._start_refresher()
+            if self._valid_for(self.min_valid):
+                return self._token
+        return self.refresh()
     
-    def _get_tenant_access_token(self) -> Optional[str]:
-        """获取tenant_access_token（带缓存）"""
-        current_time = time.time()
+    def refresh(self, force: bool = False) -> Optional[str]:
+        """
+        刷新 token（single-flight）
         
-        # 检查缓存是否有效
-        if (self._token_cache["token"] and 
-            self._token_cache["expires_at"] > current_time + 60):
-            return self._token_cache["token"]
+        Args:
+            force: 即使缓存仍在 refresh_ahead 之外有效也重新获取
+        """
+        with self._cond:
+            if self._refreshing:
+                self.stats["waits"] += 1
+                self._cond.wait_for(lambda: not self._refreshing, timeout=self.timeout + 5)
+                return self._token if self._valid_for(0) else None
+            if not force and self._valid_for(self.refresh_ahead):
+                return self._token
+            self._refreshing = True
         
+        token, expire = None, 0
         try:
-            import requests
-        except ImportError:
-            print("[FeishuClient] requests库未安装")
-            return None
+            token, expire = self._fetch()
+        finally:
+            with self._cond:
+                self.stats["fetches"] += 1
+                if token:
+                    self._token = token
+                    self._expires_at = time.time() + expire
+                else:
+                    self.stats["failures"] += 1
+                self._refreshing = False
+                self._cond.notify_all()
+        # 获取失败但旧 token 仍未过期时继续使用旧 token
+        with self._cond:
+            return self._token if self._valid_for(0) else None
+    
+    def _fetch(self):
+        """请求 tenant_access_token 接口，返回 (token, expire秒数)"""
+        if not self.app_id or not self.app_secret:
+            print("[FeishuClient] 未配置 app_id/app_secret，无法获取token")
+            return None, 0
         
+        from urllib import request
         token_url = f"{self.api_base}/auth/v3/tenant_access_token/internal"
         token_data = json.dumps({
             "app_id": self.app_id,
@@ -63,36 +106,199 @@ class FeishuClient:
         }).encode('utf-8')
         
         try:
-            from urllib import request
             token_req = request.Request(
                 token_url,
                 data=token_data,
                 headers={'Content-Type': 'application/json'}
             )
             
-            with request.urlopen(token_req, timeout=10) as response:
-                token_response = json.loads(response.read().decode('utf-8'))
+            def fetch():
+                with request.urlopen(token_req, timeout=self.timeout) as response:
+                    return json.loads(response.read().decode('utf-8'))
+            
+            token_response = resilience.call(fetch, "feishu", endpoint_of(self.api_base))
             
             if token_response.get('code') != 0:
                 print(f"[FeishuClient] 获取token失败: {token_response.get('msg')}")
-                return None
+                return None, 0
             
-            # 缓存token
-            self._token_cache["token"] = token_response.get('tenant_access_token')
-            # 飞书token有效期2小时
-            self._token_cache["expires_at"] = current_time + 7200
-            
-            return self._token_cache["token"]
+            # 剩余有效期不足 30 分钟时接口会签发新 token，否则返回原 token 及其剩余时间
+            return token_response.get('tenant_access_token'), token_response.get('expire', 7200)
             
         except Exception as e:
             print(f"[FeishuClient] 获取token异常: {e}")
+            return None, 0
+    
+    def _start_refresher(self):
+        """启动后台刷新线程（调用方持有锁）"""
+        self._refresher = threading.Thread(target=self._refresh_loop, name="feishu-token-refresh", daemon=True)
+        self._refresher.start()
+    
+    def _refresh_loop(self):
+        """在过期前 refresh_ahead 秒刷新；失败时指数退避重试"""
+        backoff = 1.0
+        while not self._stop.is_set():
+            with self._cond:
+                delay = self._expires_at - self.refresh_ahead - time.time() if self._token else 0
+            if delay > 0:
+                self._stop.wait(delay)
+                continue
+            try:
+                self.refresh(force=True)
+            except Exception as e:
+                print(f"[FeishuClient] 后台刷新token异常: {e}")
+            with self._cond:
+                refreshed = self._valid_for(self.refresh_ahead)
+            if refreshed:
+                backoff = 1.0
+            else:
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+    
+    def stop(self):
+        """停止后台刷新"""
+        self._stop.set()
+
+
+_token_managers: Dict[tuple, TenantTokenManager] = {}
+_token_managers_lock = threading.Lock()
+
+
+def get_token_manager(app_id: str, app_secret: str,
+                      api_base: str = "https://open.feishu.cn/open-apis") -> TenantTokenManager:
+    """获取 (app_id, api_base) 对应的进程级 token 管理器"""
+    with _token_managers_lock:
+        key = (app_id, api_base)
+        manager = _token_managers.get(key)
+        if manager is None or manager.app_secret != app_secret:
+            if manager is not None:
+                manager.stop()
+            manager = TenantTokenManager(app_id, app_secret, api_base)
+            _token_managers[key] = manager
+        return manager
+
+
+# ============================================================================
+# 上传去重缓存
+# ============================================================================
+
+# 与消息去重共用的状态库（不同表），重启后仍能复用已上传的 image_key / file_key
+UPLOAD_CACHE_DB = os.getenv("BOT_STATE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         "data", "bot_state.sqlite3"))
+
+
+class UploadCache:
+    """
+    内容哈希（SHA-256）→ image_key / file_key
+    基于 TTLCache（TTL + LRU，SQLite 持久化），重复发送相同内容时跳过 multipart 上传
+    """
+    
+    def __init__(self, persist_path: Optional[str] = None, ttl: float = 30 * 86400, max_size: int = 5000):
+        from ttl_cache import TTLCache
+        self._cache = TTLCache(max_size=max_size, ttl=ttl, persist_path=persist_path,
+                               touch_on_get=True, namespace="upload_keys")
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_uploaded": 0}
+    
+    def lookup(self, cache_key: str, size: int) -> Optional[str]:
+        """命中时返回之前上传得到的 key，并计入节省的上传字节数"""
+        key = self._cache.get(cache_key)
+        with self._lock:
+            if key:
+                self._stats["hits"] += 1
+                self._stats["bytes_saved"] += size
+            else:
+                self._stats["misses"] += 1
+        return key
+    
+    def store(self, cache_key: str, key: str, size: int):
+        self._cache.set(cache_key, key)
+        with self._lock:
+            self._stats["bytes_uploaded"] += size
+    
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            s = dict(self._stats)
+        total = s["hits"] + s["misses"]
+        s["hit_rate"] = s["hits"] / total if total else 0.0
+        s["entries"] = len(self._cache)
+        return s
+
+
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+
+
+def get_upload_cache() -> UploadCache:
+    """进程内共享的上传去重缓存"""
+    global _upload_cache
+    with _upload_cache_lock:
+        if _upload_cache is None:
+            _upload_cache = UploadCache(persist_path=UPLOAD_CACHE_DB)
+        return _upload_cache
+
+
+# 经由出站发送器发送时等待结果的最长秒数
+SEND_TIMEOUT = 60
+
+
+# ============================================================================
+# 飞书客户端 - 统一管理类
+# ============================================================================
+
+class FeishuClient:
+    """
+    飞书客户端 - 统一管理所有飞书相关功能
+    包含：消息收发、图片上传下载、长连接管理
+    """
+    
+    def __init__(self, app_id: str, app_secret: str, api_base: str = "https://open.feishu.cn/open-apis"):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.api_base = api_base
+        self._client = None
+        self._ws_client = None
+        self._sender = None
+        self._tokens = get_token_manager(app_id, app_secret, api_base)
+        self.upload_cache = get_upload_cache()
+    
+    # ==================== 客户端设置 ====================
+    
+    def set_client(self, client):
+        """设置飞书SDK客户端"""
+        self._client = client
+    
+    def set_ws_client(self, ws_client):
+        """设置WebSocket客户端"""
+        self._ws_client = ws_client
+    
+    def set_sender(self, sender):
+        """设置出站发送器（outbound_sender.OutboundSender），之后的消息经由其队列限流发送"""
+        self._sender = sender
+    
+    # ==================== Token管理 ====================
+    
+    def _get_tenant_access_token(self) -> Optional[str]:
+        """获取tenant_access_token（进程内共享，见 TenantTokenManager）"""
+        return self._tokens.get()
+    
+    def _request_option(self):
+        """
+        携带共享 token 的 SDK 请求选项，每次 SDK 调用都必须传入：
+        SDK 客户端以 enable_set_token(True) 构建，不再自行获取与缓存 token；获取失败时返回 None，请求将以鉴权失败返回
+        """
+        token = self._get_tenant_access_token()
+        if not token:
             return None
+        import lark_oapi as lark
+        return lark.RequestOption.builder().tenant_access_token(token).build()
     
     # ==================== 消息发送 ====================
     
     def send_text(self, chat_id: str, text: str) -> bool:
         """
-        发送文本消息
+        发送文本消息并等待结果
+        设置了出站发送器时经由其队列发送（相邻文本可能合并为一条 post），发送完成后返回
         
         Args:
             chat_id: 聊天ID
@@ -101,12 +307,30 @@ class FeishuClient:
         Returns:
             bool: 发送是否成功
         """
+        if self._sender:
+            return self._wait_queued(self._sender.send_text(chat_id, text)) is not None
         content = json.dumps({"text": text})
         return self.send_message(chat_id, content, "text")
     
+    def post_text(self, chat_id: str, text: str) -> Future:
+        """
+        发送文本消息但不等待结果（提示、分段回复等不检查结果的场景）
+        设置了出站发送器时只入队，相邻文本可能合并为一条 post；未设置时同步发送
+        
+        Returns:
+            Future: 结果为 message_id，发送失败为 None；需要确认结果的调用方可等待它
+        """
+        if self._sender:
+            return self._sender.send_text(chat_id, text)
+        future = Future()
+        _, message_id = self.create_message(chat_id, json.dumps({"text": text}), "text")
+        future.set_result(message_id)
+        return future
+    
     def send_message(self, chat_id: str, content: str, msg_type: str = "text") -> bool:
         """
         发送消息到飞书
+        设置了出站发送器时经由其队列发送（与之前入队的文本保持顺序）并等待结果
         
         Args:
             chat_id: 聊天ID
@@ -116,16 +340,38 @@ class FeishuClient:
         Returns:
             bool: 发送是否成功
         """
+        if self._sender:
+            return self._wait_queued(self._sender.send(chat_id, content, msg_type)) is not None
+        code, _ = self.create_message(chat_id, content, msg_type)
+        return code == 0
+    
+    def _wait_queued(self, future: Future) -> Optional[str]:
+        """等待出站发送器发送完成，返回 message_id（失败或超时为 None）"""
+        try:
+            return future.result(timeout=SEND_TIMEOUT)
+        except Exception as e:
+            print(f"[FeishuClient] 等待消息发送超时: {e}")
+            return None
+    
+    def create_message(self, chat_id: str, content: str, msg_type: str) -> Tuple[int, Optional[str]]:
+        """
+        直接调用发送消息接口（不经过出站发送器）
+        
+        Returns:
+            (错误码, message_id)：成功时错误码为 0，客户端未初始化或异常时为 -1
+        """
         if not self._client:
             print("[FeishuClient] 客户端未初始化")
-            return False
+            return -1, None
         
         try:
             import lark_oapi as lark
+            # 飞书按 uuid 对一小时内的重复请求去重，传输失败后重试不会发出两条消息
             request_body = lark.im.v1.CreateMessageRequestBody.builder() \
                 .receive_id(chat_id) \
                 .content(content) \
                 .msg_type(msg_type) \
+                .uuid(str(uuid.uuid4())) \
                 .build()
             
             request = lark.im.v1.CreateMessageRequest.builder() \
@@ -133,18 +379,19 @@ class FeishuClient:
                 .request_body(request_body) \
                 .build()
             
-            response = self._client.im.v1.message.create(request)
+            response = resilience.call(lambda: self._client.im.v1.message.create(request, self._request_option()),
+                                       "feishu", endpoint_of(self.api_base))
             
             if response.code == 0:
                 print(f"[FeishuClient] 消息发送成功")
-                return True
+                return 0, response.data.message_id
             else:
-                print(f"[FeishuClient] 消息发送失败: {response}")
-                return False
+                print(f"[FeishuClient] 消息发送失败: {response.code} - {response.msg}")
+                return response.code, None
                 
         except Exception as e:
             print(f"[FeishuClient] 发送消息异常: {e}")
-            return False
+            return -1, None
     
     def send_image(self, chat_id: str, image_key: str) -> bool:
         """
@@ -160,28 +407,87 @@ class FeishuClient:
         content = json.dumps({"image_key": image_key})
         return self.send_message(chat_id, content, "image")
     
+    # ==================== 卡片消息 ====================
+    
+    def send_card(self, chat_id: str, card: Dict) -> Optional[str]:
+        """
+        发送交互式卡片
+        
+        Args:
+            chat_id: 聊天ID
+            card: 卡片 JSON（需包含 config.update_multi=True 才能被后续更新）
+        
+        Returns:
+            str: 消息ID（用于 update_card），失败返回 None
+        """
+        content = json.dumps(card, ensure_ascii=False)
+        if self._sender:
+            return self._wait_queued(self._sender.send(chat_id, content, "interactive"))
+        _, message_id = self.create_message(chat_id, content, "interactive")
+        return message_id
+    
+    def update_card(self, message_id: str, card: Dict) -> bool:
+        """
+        原地更新已发送的卡片（PATCH /im/v1/messages/:message_id）
+        
+        Args:
+            message_id: send_card 返回的消息ID
+            card: 新的卡片 JSON
+        
+        Returns:
+            bool: 更新是否成功
+        """
+        if not self._client:
+            print("[FeishuClient] 客户端未初始化")
+            return False
+        
+        try:
+            import lark_oapi as lark
+            request = lark.im.v1.PatchMessageRequest.builder() \
+                .message_id(message_id) \
+                .request_body(lark.im.v1.PatchMessageRequestBody.builder()
+                              .content(json.dumps(card, ensure_ascii=False))
+                              .build()) \
+                .build()
+            
+            # 卡片更新写入完整内容，重复执行结果相同
+            response = resilience.call(lambda: self._client.im.v1.message.patch(request, self._request_option()),
+                                       "feishu", endpoint_of(self.api_base))
+            
+            if response.code == 0:
+                return True
+            print(f"[FeishuClient] 卡片更新失败: {response.code} - {response.msg}")
+            return False
+            
+        except Exception as e:
+            print(f"[FeishuClient] 更新卡片异常: {e}")
+            return False
+    
     # ==================== 图片上传下载 ====================
 
     @staticmethod
-    def _compress_image(image_path: str, max_size_mb: float = 5.0, max_dimension: int = 4096) -> str:
+    def _compress_image(image: ImageSource, max_size_mb: float = 5.0, max_dimension: int = 4096) -> Future:
         """
         压缩图片以符合飞书图片上传限制（默认5MB）。
-        如果图片不超过限制则返回原路径，否则压缩后返回临时文件路径。
+        只在当前线程读取文件头判断是否需要压缩；需要时解码/编码提交到图片线程池，不等待结果，
+        调用方在上传需要这些字节时再等待返回的 Future（期间可继续原图上传等工作）。
 
         Args:
-            image_path: 原始图片路径
+            image: 原始图片（路径或 ImageBuffer）
             max_size_mb: 最大文件大小（MB），默认5MB
             max_dimension: 最大宽/高像素，默认4096
 
         Returns:
-            str: 可用的图片路径（原路径或压缩后的临时路径）
+            Future: 结果为可用的图片（原图或压缩后的 ImageBuffer）；不需要或无法压缩时为已完成的 Future
         """
+        done = Future()
         try:
-            file_size_mb = os.path.getsize(image_path) / (1024 * 1024)
+            file_size_mb = source_size(image) / (1024 * 1024)
 
             from PIL import Image
-            img = Image.open(image_path)
-            width, height = img.size
+            # 只读取文件头获取尺寸，不解码像素
+            with open_source(image) as f:
+                width, height = Image.open(f).size
 
             # 检查是否需要压缩
             need_compress = False
@@ -191,68 +497,63 @@ class FeishuClient:
                 need_compress = True
 
             if not need_compress:
-                return image_path
+                done.set_result(image)
+                return done
 
             print(f"[FeishuClient] 图片过大({file_size_mb:.1f}MB, {width}x{height})，正在压缩...")
 
-            # 缩小尺寸
-            if width > max_dimension or height > max_dimension:
-                ratio = min(max_dimension / width, max_dimension / height)
-                new_width = int(width * ratio)
-                new_height = int(height * ratio)
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-
-            # 保存为临时文件
-            ext = os.path.splitext(image_path)[1].lower()
-            if ext not in ('.png', '.jpg', '.jpeg', '.webp'):
-                ext = '.png'
-
-            tmp_dir = tempfile.gettempdir()
-            tmp_path = os.path.join(tmp_dir, f"compressed_{int(time.time())}{ext}")
-
-            # PNG 保存，逐步降低质量
-            if ext == '.png':
-                for quality in range(6, 10):
-                    img.save(tmp_path, 'PNG', optimize=True, compress_level=quality)
-                    if os.path.getsize(tmp_path) / (1024 * 1024) <= max_size_mb:
-                        break
-                # 如果 PNG 还是太大，转为 JPEG
-                if os.path.getsize(tmp_path) / (1024 * 1024) > max_size_mb:
-                    tmp_path = os.path.join(tmp_dir, f"compressed_{int(time.time())}.jpg")
-                    if img.mode in ('RGBA', 'P'):
-                        img = img.convert('RGB')
-                    img.save(tmp_path, 'JPEG', quality=85)
-            else:
-                if img.mode in ('RGBA', 'P'):
-                    img = img.convert('RGB')
-                for q in [85, 75, 65, 55, 45]:
-                    img.save(tmp_path, 'JPEG', quality=q)
-                    if os.path.getsize(tmp_path) / (1024 * 1024) <= max_size_mb:
-                        break
-
-            new_size_mb = os.path.getsize(tmp_path) / (1024 * 1024)
-            print(f"[FeishuClient] 压缩完成: {file_size_mb:.1f}MB → {new_size_mb:.1f}MB")
-            return tmp_path
+            from image_pool import get_image_pool
+            encoding = get_image_pool().compress(image, int(max_size_mb * 1024 * 1024), max_dimension)
 
         except ImportError:
             print("[FeishuClient] Pillow未安装，无法压缩图片，将尝试原尺寸上传")
-            return image_path
+            done.set_result(image)
+            return done
         except Exception as e:
             print(f"[FeishuClient] 压缩图片异常: {e}，将尝试原尺寸上传")
-            return image_path
+            done.set_result(image)
+            return done
+
+        def finish(future: Future):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"[FeishuClient] 压缩图片异常: {e}，将尝试原尺寸上传")
+                done.set_result(image)
+                return
+            if result is None:
+                print("[FeishuClient] 压缩后仍超过大小限制，将尝试原尺寸上传")
+                done.set_result(image)
+                return
+            stem = os.path.splitext(source_name(image))[0]
+            compressed = ImageBuffer.from_bytes(result.data, f"compressed_{stem}{result.extension}")
+            print(f"[FeishuClient] 压缩完成: {file_size_mb:.1f}MB → {compressed.size / (1024 * 1024):.1f}MB "
+                  f"({result.format} q={result.quality}, {result.size[0]}x{result.size[1]}, "
+                  f"{result.encodes} 次编码, CPU {result.cpu_seconds:.2f}s)")
+            done.set_result(compressed)
+
+        encoding.add_done_callback(finish)
+        return done
 
-    def upload_file(self, file_path: str, file_type: str = "stream") -> Optional[str]:
+    def upload_file(self, file_path: ImageSource, file_type: str = "stream",
+                    use_cache: bool = True) -> Optional[str]:
         """
         上传文件到飞书，返回file_key。
-        用于发送大文件（如图片过大无法以图片形式发送时）。
+        用于发送大文件（如图片过大无法以图片形式发送时）。内容与文件名相同的文件复用之前的 file_key。
 
         Args:
-            file_path: 文件路径
+            file_path: 文件路径或 ImageBuffer
             file_type: 文件类型，stream表示二进制流文件
+            use_cache: 是否查询上传去重缓存
 
         Returns:
             str: file_key，失败返回None
         """
+        kind = f"file:{file_type}:{source_name(file_path)}"
+        return self._upload_with_cache(kind, file_path, lambda f: self._post_file(f, file_type), use_cache)[0]
+
+    def _post_file(self, file_path: ImageSource, file_type: str) -> Optional[str]:
+        """multipart 上传文件"""
         try:
             import requests
             from requests_toolbelt import MultipartEncoder
@@ -266,12 +567,13 @@ class FeishuClient:
 
         upload_url = f"{self.api_base}/im/v1/files"
 
-        try:
-            with open(file_path, 'rb') as f:
+        def post():
+            # 每次重试重新打开数据源，multipart 流不能重复读取
+            with open_source(file_path) as f:
                 form = {
                     'file_type': file_type,
-                    'file_name': os.path.basename(file_path),
-                    'file': f
+                    'file_name': source_name(file_path),
+                    'file': (source_name(file_path), f, 'application/octet-stream')
                 }
                 multi_form = MultipartEncoder(form)
 
@@ -280,7 +582,10 @@ class FeishuClient:
                 }
                 headers['Content-Type'] = multi_form.content_type
 
-                response = requests.post(upload_url, headers=headers, data=multi_form, timeout=60)
+                return requests.post(upload_url, headers=headers, data=multi_form, timeout=60)
+
+        try:
+            response = resilience.call(post, "feishu", endpoint_of(self.api_base), retry_result=retry_status)
 
             if response.status_code != 200:
                 print(f"[FeishuClient] 上传文件失败: HTTP {response.status_code}")
@@ -317,16 +622,46 @@ class FeishuClient:
         content = json.dumps({"file_key": file_key})
         return self.send_message(chat_id, content, "file")
 
-    def upload_image(self, image_path: str) -> Optional[str]:
+    def upload_image(self, image_path: ImageSource, use_cache: bool = True) -> Optional[str]:
         """
-        上传图片到飞书，返回image_key
+        上传图片到飞书，返回image_key；内容相同的图片复用之前的 image_key
         
         Args:
-            image_path: 图片文件路径
+            image_path: 图片文件路径或 ImageBuffer
+            use_cache: 是否查询上传去重缓存
         
         Returns:
             str: image_key，失败返回None
         """
+        return self._upload_with_cache("image", image_path, self._post_image, use_cache)[0]
+    
+    def _upload_with_cache(self, kind: str, source: ImageSource, upload,
+                           use_cache: bool = True) -> Tuple[Optional[str], bool]:
+        """
+        按内容哈希查询/写入上传去重缓存
+        
+        Returns:
+            (key, 是否来自缓存)
+        """
+        cache_key = None
+        size = source_size(source)
+        if self.upload_cache is not None:
+            try:
+                cache_key = f"{self.app_id}:{kind}:{source_digest(source)}"
+            except Exception as e:
+                print(f"[FeishuClient] 计算图片哈希失败: {e}")
+        if cache_key and use_cache:
+            cached = self.upload_cache.lookup(cache_key, size)
+            if cached:
+                print(f"[FeishuClient] 内容已上传过，复用 {cached}")
+                return cached, True
+        key = upload(source)
+        if key and cache_key:
+            self.upload_cache.store(cache_key, key, size)
+        return key, False
+    
+    def _post_image(self, image_path: ImageSource) -> Optional[str]:
+        """multipart 上传图片"""
         try:
             import requests
             from requests_toolbelt import MultipartEncoder
@@ -340,11 +675,12 @@ class FeishuClient:
         
         upload_url = f"{self.api_base}/im/v1/images"
         
-        try:
-            with open(image_path, 'rb') as image_file:
+        def post():
+            # 每次重试重新打开数据源，multipart 流不能重复读取
+            with open_source(image_path) as image_file:
                 form = {
                     'image_type': 'message',
-                    'image': image_file
+                    'image': (source_name(image_path), image_file, 'application/octet-stream')
                 }
                 multi_form = MultipartEncoder(form)
                 
@@ -353,7 +689,10 @@ class FeishuClient:
                 }
                 headers['Content-Type'] = multi_form.content_type
                 
-                response = requests.post(upload_url, headers=headers, data=multi_form, timeout=30)
+                return requests.post(upload_url, headers=headers, data=multi_form, timeout=30)
+        
+        try:
+            response = resilience.call(post, "feishu", endpoint_of(self.api_base), retry_result=retry_status)
             
             if response.status_code != 200:
                 print(f"[FeishuClient] 上传图片失败: HTTP {response.status_code}")
@@ -403,11 +742,9 @@ class FeishuClient:
         print(f"[FeishuClient] 正在下载图片: {image_key}")
         
         try:
-            response = requests.get(
-                resource_url,
-                headers={'Authorization': f'Bearer {token}'},
-                timeout=30
-            )
+            response = resilience.call(
+                lambda: requests.get(resource_url, headers={'Authorization': f'Bearer {token}'}, timeout=30),
+                "feishu", endpoint_of(self.api_base), retry_result=retry_status)
             
             if response.status_code != 200:
                 print(f"[FeishuClient] 下载图片失败: HTTP {response.status_code}")
@@ -422,6 +759,7 @@ class FeishuClient:
             
             with open(temp_path, 'wb') as f:
                 f.write(image_data)
+            disk_io.record_write(len(image_data))
             
             print(f"[FeishuClient] 图片已下载: {temp_path} ({len(image_data)} bytes)")
             return temp_path
@@ -430,13 +768,59 @@ class FeishuClient:
             print(f"[FeishuClient] 下载图片异常: {e}")
             return None
     
-    def send_image_with_caption(self, chat_id: str, image_path: str, caption: str = "") -> bool:
+    def download_image_buffer(self, image_key: str, message_id: str) -> Optional[ImageBuffer]:
+        """
+        从飞书下载图片到内存（超过溢出阈值时才写临时文件）
+        
+        Args:
+            image_key: 飞书图片key
+            message_id: 消息ID
+        
+        Returns:
+            ImageBuffer，失败返回None
+        """
+        try:
+            import requests
+        except ImportError:
+            print("[FeishuClient] requests库未安装")
+            return None
+        
+        token = self._get_tenant_access_token()
+        if not token:
+            return None
+        
+        resource_url = f"{self.api_base}/im/v1/messages/{message_id}/resources/{image_key}?type=image"
+        
+        print(f"[FeishuClient] 正在下载图片: {image_key}")
+        
+        try:
+            response = resilience.call(
+                lambda: requests.get(resource_url, headers={'Authorization': f'Bearer {token}'},
+                                     timeout=30, stream=True),
+                "feishu", endpoint_of(self.api_base), retry_result=retry_status)
+            
+            if response.status_code != 200:
+                print(f"[FeishuClient] 下载图片失败: HTTP {response.status_code}")
+                return None
+            
+            buffer = ImageBuffer(f"feishu_{int(time.time())}_{image_key[:8]}.jpg")
+            for chunk in response.iter_content(chunk_size=256 * 1024):
+                buffer.write(chunk)
+            
+            print(f"[FeishuClient] 图片已下载到内存: {buffer.size} bytes")
+            return buffer
+            
+        except Exception as e:
+            print(f"[FeishuClient] 下载图片异常: {e}")
+            return None
+    
+    def send_image_with_caption(self, chat_id: str, image_path: ImageSource, caption: str = "") -> bool:
         """
         上传并发送图片（带文字说明）
         
         Args:
             chat_id: 聊天ID
-            image_path: 图片路径
+            image_path: 图片路径或 ImageBuffer
             caption: 图片说明文字
         
         Returns:
@@ -445,35 +829,42 @@ class FeishuClient:
         try:
             # 先发送文字说明(如果有)
             if caption:
-                self.send_text(chat_id, caption)
+                self.post_text(chat_id, caption)
             
-            file_size_mb = os.path.getsize(image_path) / (1024 * 1024)
+            file_size_mb = source_size(image_path) / (1024 * 1024)
             
             # 图片大于5MB时，以文件形式发送（保留原始质量）
             if file_size_mb > 5.0:
                 print(f"[FeishuClient] 图片过大({file_size_mb:.1f}MB)，将以文件形式发送...")
-                self.send_text(chat_id, f"📎 图片较大({file_size_mb:.1f}MB)，以文件形式发送：")
+                self.post_text(chat_id, f"📎 图片较大({file_size_mb:.1f}MB)，以文件形式发送：")
                 file_key = self.upload_file(image_path)
                 if file_key:
                     return self.send_file(chat_id, file_key)
                 return False
             
             # 图片在5MB以内，以图片形式发送
-            image_key = self.upload_image(image_path)
-            if image_key:
-                return self.send_image(chat_id, image_key)
-            
-            # 图片上传失败，尝试压缩后重试
-            print("[FeishuClient] 原图上传失败，尝试压缩后发送...")
-            compressed_path = self._compress_image(image_path)
-            image_key = self.upload_image(compressed_path)
-            
-            # 清理临时压缩文件
-            if compressed_path != image_path and os.path.exists(compressed_path):
-                try:
-                    os.remove(compressed_path)
-                except Exception:
-                    pass
+            # 尺寸超出限制时原图上传大概率失败，先在图片线程池中开始压缩，与原图上传并行
+            compressing = self._compress_image(image_path)
+            try:
+                image_key, cached = self._upload_with_cache("image", image_path, self._post_image)
+                if image_key and not cached:
+                    return self.send_image(chat_id, image_key)
+                if image_key:
+                    if self.send_image(chat_id, image_key):
+                        return True
+                    # 缓存的 image_key 已失效，重新上传
+                    image_key = self.upload_image(image_path, use_cache=False)
+                    if image_key:
+                        return self.send_image(chat_id, image_key)
+                
+                # 图片上传失败，等待压缩结果后重试
+                print("[FeishuClient] 原图上传失败，尝试压缩后发送...")
+                compressed = compressing.result()
+                image_key = self.upload_image(compressed)
+            finally:
+                # 压缩结果不再需要（或已上传）时释放
+                compressing.add_done_callback(
+                    lambda f: f.result() is not image_path and f.result().close())
             
             if image_key:
                 return self.send_image(chat_id, image_key)
@@ -489,6 +880,44 @@ class FeishuClient:
             print(f"[FeishuClient] 发送图片异常: {e}")
             return False
     
+    def send_images_post(self, chat_id: str, image_paths: List[ImageSource], title: str = "") -> bool:
+        """
+        将多张图片合并为一条富文本（post）消息发送
+        
+        Args:
+            chat_id: 聊天ID
+            image_paths: 图片路径或 ImageBuffer 列表（按顺序排列）
+            title: 消息标题
+        
+        Returns:
+            bool: 是否全部发送成功
+        """
+        image_keys = []
+        fallback = []
+        for path in image_paths:
+            image_key = None
+            if source_size(path) <= 5 * 1024 * 1024:
+                image_key = self.upload_image(path)
+            if image_key:
+                image_keys.append(image_key)
+            else:
+                fallback.append(path)
+        
+        success = True
+        if image_keys:
+            content = json.dumps({
+                "zh_cn": {
+                    "title": title,
+                    "content": [[{"tag": "img", "image_key": key}] for key in image_keys],
+                }
+            }, ensure_ascii=False)
+            success = self.send_message(chat_id, content, "post")
+        
+        # 过大或上传失败的图片逐张走原有的压缩/文件发送逻辑
+        for path in fallback:
+            success = self.send_image_with_caption(chat_id, path) and success
+        return success
+    
     # ==================== 消息解析 ====================
     
     @staticmethod
@@ -570,6 +999,247 @@ class FeishuClient:
         except:
             return None
 
+# ============================================================================
+# 进度卡片
+# ============================================================================
+
+def format_duration(seconds: float) -> str:
+    """格式化时长，如 45秒 / 2分05秒"""
+    seconds = int(round(max(0.0, seconds)))
+    if seconds < 60:
+        return f"{seconds}秒"
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes}分{seconds:02d}秒"
+
+
+class ProgressCard:
+    """
+    单张可原地更新的进度卡片。
+    首次调用 start() 发送卡片，之后的 update() 通过 PATCH 修改同一条消息；
+    两次更新之间至少间隔 min_interval 秒且进度变化需达到 min_delta（阶段变化除外），
+    因此单个任务的消息 API 调用次数约为 耗时 / min_interval 的上限。
+    """
+
+    BAR_WIDTH = 20
+
+    def __init__(self, client: FeishuClient, chat_id: str, title: str,
+                 min_interval: float = 3.0, min_delta: float = 5.0):
+        self.client = client
+        self.chat_id = chat_id
+        self.title = title
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.message_id: Optional[str] = None
+        self.api_calls = 0
+        self._last_sent = 0.0
+        self._last_percent = -1.0
+        self._last_stage = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _build(self, percent: float, lines: List[str], template: str) -> Dict:
+        filled = int(self.BAR_WIDTH * max(0.0, min(100.0, percent)) / 100)
+        bar = "▓" * filled + "░" * (self.BAR_WIDTH - filled)
+        body = f"`{bar}` **{int(percent)}%**"
+        if lines:
+            body += "\n" + "\n".join(lines)
+        return {
+            "config": {"update_multi": True, "wide_screen_mode": True},
+            "header": {"template": template, "title": {"tag": "plain_text", "content": self.title}},
+            "elements": [{"tag": "div", "text": {"tag": "lark_md", "content": body}}],
+        }
+
+    def start(self, text: str = "⏳ 已提交，等待执行...") -> bool:
+        """发送初始卡片"""
+        with self._lock:
+            self.message_id = self.client.send_card(self.chat_id, self._build(0, [text], "blue"))
+            self.api_calls += 1
+            self._last_sent = time.time()
+            self._last_percent = 0.0
+            return self.message_id is not None
+
+    def update(self, percent: float, lines: List[str], stage: str = None) -> bool:
+        """更新进度（受节流限制），返回是否实际发出了更新请求"""
+        with self._lock:
+            if self._closed or not self.message_id:
+                return False
+            now = time.time()
+            stage_changed = stage is not None and stage != self._last_stage
+            if not stage_changed:
+                if now - self._last_sent < self.min_interval:
+                    return False
+                if abs(percent - self._last_percent) < self.min_delta:
+                    return False
+            self._last_sent = now
+            self._last_percent = percent
+            self._last_stage = stage
+            self.api_calls += 1
+            return self.client.update_card(self.message_id, self._build(percent, lines, "blue"))
+
+    def finish(self, success: bool, text: str = "") -> bool:
+        """写入最终状态（不受节流限制），之后的 update() 将被忽略"""
+        with self._lock:
+            if self._closed or not self.message_id:
+                return False
+            self._closed = True
+            self.api_calls += 1
+            default = "✅ 已完成" if success else "❌ 处理失败"
+            return self.client.update_card(
+                self.message_id,
+                self._build(100 if success else self._last_percent, [text or default],
+                            "green" if success else "red"))
+
+
+class StreamingReply:
+    """
+    流式回复卡片。
+    收到消息后立即发送占位卡片，之后把 Agent 当前步骤与最终答案的流式文本原地写入同一张卡片。
+    Agent 线程只修改内存中的内容，后台线程合并最新内容后 PATCH，更新间隔自适应：
+    - 间隔取 max(min_interval, 最近一次 PATCH 耗时 × latency_factor)，接口变慢时自动放缓
+    - 更新失败（多为频控）时间隔翻倍，直到 max_interval；成功后逐步回落
+    单条消息的更新频率不超过 1 / min_interval（默认 2 次/秒）。
+    """
+
+    # 卡片正文上限，超出部分在 finish() 时以文本消息补发
+    CARD_TEXT_LIMIT = 8000
+    CURSOR = " ▌"
+
+    def __init__(self, client: FeishuClient, chat_id: str, title: str = "🤖 回答",
+                 min_interval: float = 0.5, max_interval: float = 5.0, latency_factor: float = 2.0,
+                 render: Optional[Callable[[str], str]] = None, started_at: Optional[float] = None):
+        self.client = client
+        self.chat_id = chat_id
+        self.title = title
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.latency_factor = latency_factor
+        self.render = render
+        self.started_at = started_at or time.time()
+        self.message_id: Optional[str] = None
+        self.interval = min_interval
+        self._step = "🤔 正在思考…"
+        self._answer: List[str] = []
+        self._dirty = False
+        self._closed = False
+        self._next_patch = 0.0
+        self._cond = threading.Condition()
+        self._flusher: Optional[threading.Thread] = None
+        self._stats = {"patches": 0, "patch_failures": 0, "first_visible": None, "first_answer_visible": None}
+
+    def _build(self, step: str, answer: str, streaming: bool, template: str = "blue") -> Dict:
+        if self.render and answer:
+            answer = self.render(answer)
+        if len(answer) > self.CARD_TEXT_LIMIT:
+            answer = answer[:self.CARD_TEXT_LIMIT] + ("…" if streaming else "")
+        elements = [{"tag": "div", "text": {"tag": "lark_md", "content": (answer + self.CURSOR) if streaming and answer
+                                            else (answer or step)}}]
+        if streaming and answer:
+            elements.append({"tag": "note", "elements": [{"tag": "plain_text", "content": step}]})
+        return {
+            "config": {"update_multi": True, "wide_screen_mode": True},
+            "header": {"template": template, "title": {"tag": "plain_text", "content": self.title}},
+            "elements": elements,
+        }
+
+    def start(self) -> bool:
+        """发送占位卡片并启动后台更新线程"""
+        self.message_id = self.client.send_card(self.chat_id, self._build(self._step, "", True))
+        if not self.message_id:
+            return False
+        self._stats["first_visible"] = time.time()
+        self._next_patch = time.time() + self.min_interval
+        self._flusher = threading.Thread(target=self._flush_loop, name="stream-reply", daemon=True)
+        self._flusher.start()
+        return True
+
+    def step(self, text: str):
+        """更新当前步骤提示（如"正在搜索…"）"""
+        with self._cond:
+            self._step = text
+            self._dirty = True
+            self._cond.notify()
+
+    def append(self, delta: str):
+        """追加最终答案的流式文本"""
+        with self._cond:
+            if not self._answer:
+                self._step = "✍️ 正在输出…"
+            self._answer.append(delta)
+            self._dirty = True
+            self._cond.notify()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._dirty:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                wait = self._next_patch - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                answer = "".join(self._answer)
+                card = self._build(self._step, answer, True)
+                self._dirty = False
+
+            started = time.time()
+            ok = self.client.update_card(self.message_id, card)
+            latency = time.time() - started
+
+            with self._cond:
+                self._stats["patches"] += 1
+                if ok:
+                    target = min(self.max_interval, max(self.min_interval, latency * self.latency_factor))
+                    self.interval = max(target, self.interval * 0.7)
+                    if answer and self._stats["first_answer_visible"] is None:
+                        self._stats["first_answer_visible"] = time.time()
+                else:
+                    self._stats["patch_failures"] += 1
+                    self.interval = min(self.max_interval, self.interval * 2)
+                    self._dirty = True
+                self._next_patch = time.time() + self.interval
+
+    def finish(self, text: str, success: bool = True) -> bool:
+        """停止流式更新并写入最终内容（不受间隔限制），超出卡片上限的部分以文本消息补发"""
+        with self._cond:
+            if self._closed or not self.message_id:
+                return False
+            self._closed = True
+            self._cond.notify()
+        self._flusher.join(timeout=self.max_interval + 30)
+
+        rendered = self.render(text) if self.render else text
+        ok = self.client.update_card(
+            self.message_id, self._build("", text, False, "blue" if success else "red"))
+        self._stats["patches"] += 1
+        if not ok:
+            # 卡片无法更新时改发文本，保证用户拿到完整答案
+            self._stats["patch_failures"] += 1
+            ok = self._send_segments(rendered)
+        elif len(rendered) > self.CARD_TEXT_LIMIT:
+            self._send_segments(rendered[self.CARD_TEXT_LIMIT:])
+        if ok and self._stats["first_answer_visible"] is None:
+            self._stats["first_answer_visible"] = time.time()
+        self._stats["finished"] = time.time()
+        return ok
+
+    def _send_segments(self, text: str, max_length: int = 4000) -> bool:
+        # 先全部入队（相邻分段可合并发送），再逐个等待结果
+        futures = [self.client.post_text(self.chat_id, text[i:i + max_length])
+                   for i in range(0, len(text), max_length)]
+        return all([self.client._wait_queued(f) is not None for f in futures])
+
+    def stats(self) -> Dict[str, float]:
+        """耗时均相对 started_at：首个可见内容（占位卡片）、首个答案字符、完成"""
+        with self._cond:
+            s = dict(self._stats)
+        for key in ("first_visible", "first_answer_visible", "finished"):
+            s[key] = s[key] - self.started_at if s.get(key) else None
+        s["interval"] = self.interval
+        return s
+
+
 # ============================================================================
 # 飞书消息发送模块（保留向后兼容）
 # ============================================================================
@@ -610,17 +1280,30 @@ class FeishuMessenger:
 # 飞书API交互模块（保留向后兼容，内部使用FeishuClient）
 # ============================================================================
 
+_env_client = None
+_env_client_lock = threading.Lock()
+
+
+def _get_env_client() -> FeishuClient:
+    """从 .env 配置创建的共享 FeishuClient（供兼容接口使用）"""
+    global _env_client
+    with _env_client_lock:
+        if _env_client is None:
+            _env_client = FeishuClient(
+                os.getenv("FEISHU_APP_ID", ""),
+                os.getenv("FEISHU_APP_SECRET", ""),
+                os.getenv("FEISHU_API_BASE", "https://open.feishu.cn/open-apis")
+            )
+        return _env_client
+
+
 class FeishuAPI:
     """飞书API交互类（兼容旧代码）"""
 
     @staticmethod
     def get_tenant_access_token() -> Optional[str]:
         """获取tenant_access_token"""
-        client = FeishuClient(
-            os.getenv("FEISHU_APP_ID", ""),
-            os.getenv("FEISHU_APP_SECRET", ""),
-            os.getenv("FEISHU_API_BASE", "https://open.feishu.cn/open-apis")
-        )
+        client = _get_env_client()
         return client._get_tenant_access_token()
 
     @staticmethod
@@ -628,19 +1311,11 @@ class FeishuAPI:
         """从飞书下载图片并返回保存路径"""
         if save_folder is None:
             save_folder = os.getenv("COMFYUI_INPUT_FOLDER", "/tmp")
-        client = FeishuClient(
-            os.getenv("FEISHU_APP_ID", ""),
-            os.getenv("FEISHU_APP_SECRET", ""),
-            os.getenv("FEISHU_API_BASE", "https://open.feishu.cn/open-apis")
-        )
+        client = _get_env_client()
         return client.download_image(image_key, message_id, save_folder)
 
     @staticmethod
     def upload_image(image_path: str) -> Optional[str]:
         """上传单张图片到飞书,返回image_key"""
-        client = FeishuClient(
-            os.getenv("FEISHU_APP_ID", ""),
-            os.getenv("FEISHU_APP_SECRET", ""),
-            os.getenv("FEISHU_API_BASE", "https://open.feishu.cn/open-apis")
-        )
+        client = _get_env_client()
         return client.upload_image(image_path)
@@ -0,0 +1,222 @@
+"""
+内存图片缓冲模块
+图片在 飞书下载 → ComfyUI 上传 → 结果下载 → 压缩 → 飞书上传 各阶段之间以 ImageBuffer 传递，
+不再每一步都落盘再读回：
+- 不超过 spill_threshold 的图片只保存在内存中（getbuffer() 返回 memoryview，不复制）
+- 超过阈值时溢出到临时文件，内存占用有上限
+- 各阶段同时接受文件路径与 ImageBuffer（open_source / source_size 等兼容两种来源）
+
+disk_io 统计图片管线在本进程中的磁盘读写次数与字节数，可对比路径模式与内存模式的差异。
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Dict, Union
+
+# 超过该大小的图片溢出到临时文件（默认 16MB，可通过 IMAGE_SPILL_MB 调整）
+DEFAULT_SPILL_BYTES = int(float(os.getenv("IMAGE_SPILL_MB", "16")) * 1024 * 1024)
+
+
+# ============================================================================
+# 磁盘读写统计
+# ============================================================================
+
+class DiskIOStats:
+    """图片管线的磁盘读写计数（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"reads": 0, "read_bytes": 0, "writes": 0, "write_bytes": 0}
+
+    def record_read(self, nbytes: int):
+        with self._lock:
+            self._stats["reads"] += 1
+            self._stats["read_bytes"] += nbytes
+
+    def record_write(self, nbytes: int):
+        with self._lock:
+            self._stats["writes"] += 1
+            self._stats["write_bytes"] += nbytes
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    @staticmethod
+    def delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+        """两次 snapshot 之间的增量"""
+        return {key: after[key] - before.get(key, 0) for key in after}
+
+
+disk_io = DiskIOStats()
+
+
+# ============================================================================
+# 图片缓冲
+# ============================================================================
+
+class ImageBuffer:
+    """
+    图片字节缓冲，小图驻留内存，大图溢出到临时文件
+
+    Args:
+        name: 文件名（上传 ComfyUI / 飞书时使用）
+        spill_threshold: 溢出阈值（字节）
+    """
+
+    def __init__(self, name: str, spill_threshold: int = DEFAULT_SPILL_BYTES):
+        self.name = name
+        self.spill_threshold = spill_threshold
+        self._memory = io.BytesIO()
+        self._spill_path = None
+        self._size = 0
+
+    @classmethod
+    def from_bytes(cls, data: bytes, name: str, spill_threshold: int = DEFAULT_SPILL_BYTES) -> "ImageBuffer":
+        buffer = cls(name, spill_threshold)
+        buffer.write(data)
+        return buffer
+
+    @classmethod
+    def from_path(cls, path: str, spill_threshold: int = DEFAULT_SPILL_BYTES) -> "ImageBuffer":
+        with open(path, 'rb') as f:
+            data = f.read()
+        disk_io.record_read(len(data))
+        return cls.from_bytes(data, os.path.basename(path), spill_threshold)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def spilled(self) -> bool:
+        """是否已溢出到磁盘"""
+        return self._spill_path is not None
+
+    def write(self, data: Union[bytes, memoryview]):
+        """追加数据，超过阈值时把已有内容连同本次数据一起转存到临时文件"""
+        if not self.spilled and self._size + len(data) > self.spill_threshold:
+            fd, self._spill_path = tempfile.mkstemp(prefix="img_spill_", suffix=os.path.splitext(self.name)[1])
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._memory.getbuffer())
+                f.write(data)
+            disk_io.record_write(self._size + len(data))
+            self._memory = io.BytesIO()
+        elif self.spilled:
+            with open(self._spill_path, 'ab') as f:
+                f.write(data)
+            disk_io.record_write(len(data))
+        else:
+            self._memory.write(data)
+        self._size += len(data)
+
+    def getbuffer(self) -> memoryview:
+        """内存中的图片数据（不复制）；已溢出时读回磁盘内容"""
+        if self.spilled:
+            return memoryview(self.read_bytes())
+        return self._memory.getbuffer()
+
+    def read_bytes(self) -> bytes:
+        if self.spilled:
+            with open(self._spill_path, 'rb') as f:
+                data = f.read()
+            disk_io.record_read(len(data))
+            return data
+        return self._memory.getvalue()
+
+    def open(self) -> BinaryIO:
+        """返回从头读取的文件对象（调用方负责关闭）"""
+        if self.spilled:
+            disk_io.record_read(self._size)
+            return open(self._spill_path, 'rb')
+        return io.BytesIO(self._memory.getbuffer())
+
+    def save(self, path: str) -> str:
+        """写入指定路径（需要交给只能读文件的程序时使用）"""
+        with open(path, 'wb') as f:
+            f.write(self.getbuffer())
+        disk_io.record_write(self._size)
+        return path
+
+    def close(self):
+        """释放内存并删除溢出文件"""
+        self._memory = io.BytesIO()
+        if self._spill_path:
+            try:
+                os.remove(self._spill_path)
+            except OSError:
+                pass
+            self._spill_path = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __str__(self) -> str:
+        if self.spilled:
+            return f"{self.name}（已溢出到 {self._spill_path}，{self._size} 字节）"
+        return f"{self.name}（内存，{self._size} 字节）"
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+# 各处理阶段接受的图片来源：文件路径或内存缓冲
+ImageSource = Union[str, ImageBuffer]
+
+
+def open_source(source: ImageSource) -> BinaryIO:
+    """以二进制只读方式打开图片来源（调用方负责关闭）"""
+    if isinstance(source, ImageBuffer):
+        return source.open()
+    disk_io.record_read(os.path.getsize(source))
+    return open(source, 'rb')
+
+
+def source_size(source: ImageSource) -> int:
+    """图片字节数"""
+    if isinstance(source, ImageBuffer):
+        return source.size
+    return os.path.getsize(source)
+
+
+def source_name(source: ImageSource) -> str:
+    """图片文件名"""
+    if isinstance(source, ImageBuffer):
+        return source.name
+    return os.path.basename(source)
+
+
+def source_digest(source: ImageSource) -> str:
+    """图片内容的 SHA-256（与文件名无关，同一张图片重新下载后不变）"""
+    h = hashlib.sha256()
+    if isinstance(source, ImageBuffer):
+        h.update(source.getbuffer())
+    else:
+        with open_source(source) as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def image_available(source) -> bool:
+    """图片来源是否可用（路径存在或缓冲非空）"""
+    if isinstance(source, ImageBuffer):
+        return source.size > 0
+    return bool(source) and os.path.exists(source)
+
+
+def discard_image(source):
+    """释放不再需要的图片（删除临时文件或清空缓冲）"""
+    if isinstance(source, ImageBuffer):
+        source.close()
+    elif source:
+        try:
+            os.remove(source)
+        except OSError:
+            pass
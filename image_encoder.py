@@ -0,0 +1,318 @@
+"""
+目标大小图片编码模块
+飞书图片上传限制为 5MB。旧的压缩逻辑逐档降低 JPEG 质量（最多 5 次完整编码）或遍历 PNG 压缩级别，
+每次都写临时文件再读取大小，缩放也是对原图做完整的 LANCZOS。这里改为在内存中按目标大小编码：
+- JPEG 源图用 draft() 直接按 1/2、1/4、1/8 比例解码，其余缩放使用 reducing_gap（先整数倍 reduce 再精修）
+- 按内容选择格式：带透明通道或颜色较少（截图、插画）用 WebP，照片用 JPEG
+- 先以默认质量编码一次，按体积比例预测满足上限的质量，再在剩余区间二分，保留不超限的最大质量；
+  体积达到上限的 90% 即返回，不会停在远小于上限的第一个候选上
+- 质量降到下限仍超限时，按体积比例二分缩放比例，同样保留不超限的最大比例
+
+python image_encoder.py --bench 对比旧逻辑与新编码器处理大图的 CPU 时间。
+"""
+import io
+import os
+import math
+import time
+import argparse
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from image_buffer import ImageSource, open_source
+
+DEFAULT_QUALITY = 85
+MIN_QUALITY = 40
+MAX_ENCODES = 10
+# 预测质量/比例时预留的体积余量
+SIZE_SAFETY = 0.95
+# 体积达到上限的该比例即视为足够接近，停止搜索
+FILL_RATIO = 0.9
+# 质量 → 相对默认质量的体积比例（照片的经验值，仅用于预测首个候选质量）
+SIZE_CURVE = ((85, 1.0), (75, 0.68), (65, 0.55), (55, 0.47), (45, 0.40), (40, 0.37))
+# 缩略图颜色数不超过该值时视为截图/插画
+FEW_COLORS = 1024
+
+
+@dataclass
+class EncodeResult:
+    """编码结果"""
+    data: bytes
+    format: str          # "JPEG" / "WEBP"
+    quality: int
+    size: Tuple[int, int]
+    encodes: int         # 完整编码次数
+    cpu_seconds: float   # 当前线程的 CPU 时间
+
+    @property
+    def extension(self) -> str:
+        return ".jpg" if self.format == "JPEG" else ".webp"
+
+
+def _fit(size: Tuple[int, int], max_dimension: int) -> Tuple[int, int]:
+    width, height = size
+    ratio = min(1.0, max_dimension / max(width, height))
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def _relative_size(quality: int) -> float:
+    """按 SIZE_CURVE 线性插值，quality 下的体积相对默认质量的比例"""
+    for (q_hi, r_hi), (q_lo, r_lo) in zip(SIZE_CURVE, SIZE_CURVE[1:]):
+        if q_lo <= quality <= q_hi:
+            return r_lo + (r_hi - r_lo) * (quality - q_lo) / (q_hi - q_lo)
+    return SIZE_CURVE[0][1] if quality > SIZE_CURVE[0][0] else SIZE_CURVE[-1][1]
+
+
+def _predict_quality(ratio: float) -> Optional[int]:
+    """体积需要降到默认质量的 ratio 倍时对应的质量；低于曲线下限返回 None"""
+    if ratio >= 1.0:
+        return DEFAULT_QUALITY
+    for (q_hi, r_hi), (q_lo, r_lo) in zip(SIZE_CURVE, SIZE_CURVE[1:]):
+        if r_lo <= ratio <= r_hi:
+            return int(q_lo + (q_hi - q_lo) * (ratio - r_lo) / (r_hi - r_lo))
+    return None
+
+
+def load_image(source: ImageSource, max_dimension: int):
+    """解码并缩放到 max_dimension 以内；JPEG 利用 draft() 在解码阶段直接降采样"""
+    from PIL import Image
+    with open_source(source) as f:
+        img = Image.open(f)
+        if img.format == "JPEG" and max(img.size) > max_dimension:
+            img.draft("RGB", _fit(img.size, max_dimension))
+        img.load()
+    if max(img.size) > max_dimension:
+        img = img.resize(_fit(img.size, max_dimension), Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def choose_format(img) -> str:
+    """带透明通道或颜色较少的图片用 WebP，照片用 JPEG（不支持 WebP 时一律 JPEG）"""
+    from PIL import Image, features
+    if not features.check("webp"):
+        return "JPEG"
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        return "WEBP"
+    sample = img.resize((64, 64), Image.NEAREST).convert("RGB")
+    return "WEBP" if sample.getcolors(maxcolors=FEW_COLORS) is not None else "JPEG"
+
+
+def _prepare(img, fmt: str):
+    """转换为目标格式支持的色彩模式（JPEG 的透明部分铺白底）"""
+    from PIL import Image
+    if fmt == "WEBP":
+        return img if img.mode in ("RGB", "RGBA") else img.convert("RGBA" if "A" in img.getbands() or
+                                                                      "transparency" in img.info else "RGB")
+    if img.mode == "RGB":
+        return img
+    if img.mode == "P":
+        img = img.convert("RGBA")
+    if "A" in img.getbands():
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def _encode(img, fmt: str, quality: int) -> io.BytesIO:
+    out = io.BytesIO()
+    img.save(out, fmt, quality=quality)
+    return out
+
+
+def encode_to_limit(source: ImageSource, max_bytes: int, max_dimension: int = 4096,
+                    min_quality: int = MIN_QUALITY) -> Optional[EncodeResult]:
+    """
+    把图片编码到 max_bytes 以内
+
+    Args:
+        source: 图片路径或 ImageBuffer
+        max_bytes: 体积上限
+        max_dimension: 最大宽/高像素
+        min_quality: 质量下限，低于此值改为缩小尺寸
+
+    Returns:
+        EncodeResult，MAX_ENCODES 次编码内仍未满足上限时返回 None
+    """
+    started = time.thread_time()
+    result = encode_image(load_image(source, max_dimension), max_bytes, min_quality)
+    if result:
+        result.cpu_seconds = time.thread_time() - started
+    return result
+
+
+def encode_image(img, max_bytes: int, min_quality: int = MIN_QUALITY) -> Optional[EncodeResult]:
+    """
+    把已解码的图片编码到 max_bytes 以内（不修改 img，便于同一次解码复用于多个输出）
+    先二分质量，下限质量仍超限时再二分缩放比例；始终保留不超限的最大质量/比例，
+    体积达到上限的 FILL_RATIO 即停止，编码次数用完时返回已找到的最好结果
+
+    Returns:
+        EncodeResult，MAX_ENCODES 次编码内没有任何结果满足上限时返回 None
+    """
+    from PIL import Image
+    started = time.thread_time()
+    fmt = choose_format(img)
+    img = _prepare(img, fmt)
+    encodes = 0
+    best = None
+
+    def attempt(candidate, quality: int):
+        """编码一次，满足上限时更新 best；返回 (体积, 是否已足够接近上限)"""
+        nonlocal encodes, best
+        encodes += 1
+        out = _encode(candidate, fmt, quality)
+        size = out.tell()
+        if size <= max_bytes and (best is None or size > len(best.data)):
+            best = EncodeResult(out.getvalue(), fmt, quality, candidate.size, encodes, 0.0)
+        return size, max_bytes * FILL_RATIO <= size <= max_bytes
+
+    def finish() -> Optional[EncodeResult]:
+        if best is not None:
+            best.encodes = encodes
+            best.cpu_seconds = time.thread_time() - started
+        return best
+
+    # 默认质量即满足上限时不再提高质量
+    size, _ = attempt(img, DEFAULT_QUALITY)
+    if size <= max_bytes:
+        return finish()
+
+    # 质量二分：lo 以下已知满足（或为下限），hi 以上已知超限；首个候选按体积比例预测
+    base = size / _relative_size(DEFAULT_QUALITY)
+    lo, hi = min_quality, DEFAULT_QUALITY - 1
+    target = _predict_quality(max_bytes * SIZE_SAFETY / base)
+    quality = max(lo, min(hi, target if target is not None else lo))
+    low_size = None
+    while lo <= hi and encodes < MAX_ENCODES:
+        size, close = attempt(img, quality)
+        if quality == min_quality:
+            low_size = size
+        if close:
+            return finish()
+        if size <= max_bytes:
+            lo = quality + 1
+        else:
+            hi = quality - 1
+        quality = (lo + hi) // 2
+    if best is not None or encodes >= MAX_ENCODES:
+        return finish()
+
+    # 下限质量仍超限：按下限质量的体积二分缩放比例（体积约与比例的平方成正比）
+    fits, too_big = 0.0, 1.0
+    scale = math.sqrt(max_bytes * SIZE_SAFETY / low_size) if low_size else 0.5
+    while encodes < MAX_ENCODES:
+        scale = min(max(scale, fits + (too_big - fits) * 0.1), too_big - (too_big - fits) * 0.1)
+        candidate = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))),
+                               Image.LANCZOS, reducing_gap=3.0)
+        size, close = attempt(candidate, min_quality)
+        if close:
+            break
+        if size <= max_bytes:
+            fits = scale
+        else:
+            too_big = scale
+        if best is not None and too_big - fits < 0.01:
+            break
+        # 按本次体积预测满足上限的比例，夹在已知区间内
+        scale = scale * math.sqrt(max_bytes * SIZE_SAFETY / size)
+    return finish()
+
+
+def encode_thumbnail(img, max_side: int, quality: int = 80) -> EncodeResult:
+    """由已解码的图片生成缩略图（不修改 img）"""
+    from PIL import Image
+    started = time.thread_time()
+    thumb = img if max(img.size) <= max_side else \
+        img.resize(_fit(img.size, max_side), Image.LANCZOS, reducing_gap=2.0)
+    fmt = choose_format(thumb)
+    thumb = _prepare(thumb, fmt)
+    out = _encode(thumb, fmt, quality)
+    return EncodeResult(out.getvalue(), fmt, quality, thumb.size, 1, time.thread_time() - started)
+
+
+# ============================================================================
+# 基准测试
+# ============================================================================
+
+def _legacy_compress(path: str, max_size_mb: float = 5.0, max_dimension: int = 4096) -> int:
+    """旧 _compress_image 的编码流程（临时文件 + 逐档降质量），返回编码次数"""
+    from PIL import Image
+    img = Image.open(path)
+    width, height = img.size
+    if width > max_dimension or height > max_dimension:
+        ratio = min(max_dimension / width, max_dimension / height)
+        img = img.resize((int(width * ratio), int(height * ratio)), Image.LANCZOS)
+    ext = os.path.splitext(path)[1].lower()
+    fd, tmp_path = tempfile.mkstemp(suffix=ext)
+    os.close(fd)
+    encodes = 0
+    try:
+        if ext == ".png":
+            for level in range(6, 10):
+                img.save(tmp_path, "PNG", optimize=True, compress_level=level)
+                encodes += 1
+                if os.path.getsize(tmp_path) / (1024 * 1024) <= max_size_mb:
+                    break
+            if os.path.getsize(tmp_path) / (1024 * 1024) > max_size_mb:
+                img.convert("RGB").save(tmp_path, "JPEG", quality=85)
+                encodes += 1
+        else:
+            img = img.convert("RGB")
+            for q in [85, 75, 65, 55, 45]:
+                img.save(tmp_path, "JPEG", quality=q)
+                encodes += 1
+                if os.path.getsize(tmp_path) / (1024 * 1024) <= max_size_mb:
+                    break
+    finally:
+        os.remove(tmp_path)
+    return encodes
+
+
+def _synthetic_photo(width: int, height: int):
+    """带渐变与噪声的合成照片（压缩难度接近真实照片）"""
+    from PIL import Image
+    gradient = Image.linear_gradient("L").resize((width, height))
+    channels = [Image.blend(gradient, Image.effect_noise((width, height), sigma), 0.5)
+                for sigma in (40, 60, 80)]
+    return Image.merge("RGB", channels)
+
+
+def benchmark(width: int = 6000, height: int = 4000, max_size_mb: float = 5.0) -> Dict[str, Dict]:
+    """对合成大图分别以 JPEG、PNG 源文件比较旧逻辑与新编码器的 CPU 时间"""
+    photo = _synthetic_photo(width, height)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext, params in ((".jpg", {"quality": 97}), (".png", {"compress_level": 1})):
+            path = os.path.join(tmp, f"source{ext}")
+            photo.save(path, **params)
+
+            started = time.thread_time()
+            legacy_encodes = _legacy_compress(path, max_size_mb)
+            legacy_cpu = time.thread_time() - started
+
+            result = encode_to_limit(path, int(max_size_mb * 1024 * 1024))
+            results[ext] = {
+                "source_mb": os.path.getsize(path) / (1024 * 1024),
+                "legacy_cpu_s": legacy_cpu,
+                "legacy_encodes": legacy_encodes,
+                "new_cpu_s": result.cpu_seconds if result else None,
+                "new_encodes": result.encodes if result else None,
+                "new_mb": len(result.data) / (1024 * 1024) if result else None,
+                "new_format": result.format if result else None,
+                "new_quality": result.quality if result else None,
+            }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="目标大小图片编码")
+    parser.add_argument("--bench", action="store_true", help="对比旧压缩逻辑与新编码器的 CPU 时间")
+    parser.add_argument("--size", default="6000x4000", help="基准测试图片尺寸，如 6000x4000")
+    args = parser.parse_args()
+    if args.bench:
+        w, h = (int(v) for v in args.size.lower().split("x"))
+        for ext, row in benchmark(w, h).items():
+            print(f"{ext}: 源文件 {row['source_mb']:.1f}MB | 旧: {row['legacy_cpu_s']:.2f}s CPU, "
+                  f"{row['legacy_encodes']} 次编码 | 新: {row['new_cpu_s']:.2f}s CPU, {row['new_encodes']} 次编码, "
+                  f"{row['new_format']} q={row['new_quality']}, {row['new_mb']:.2f}MB")
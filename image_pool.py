@@ -0,0 +1,208 @@
+"""
+图片处理线程池模块
+解码、缩放、编码等 CPU 密集的图片操作统一提交到专用线程池执行（Pillow 在这些操作中释放 GIL，
+线程即可并行利用多核），调用方拿到 Future 后等待结果：
+- 有界队列：执行中 + 排队的任务数超过上限时 submit 阻塞等待，超时抛出 RuntimeError，避免突发上传堆积内存
+- transcode() 对一张图片只解码一次，压缩输出与各尺寸缩略图复用同一份解码结果
+- 线程数默认等于 CPU 核数（IMAGE_WORKERS 可调），同时限制了所有会话并发压缩时的 CPU 占用
+
+python image_pool.py --bench 8 测量 8 张大图并发上传时的处理吞吐。
+"""
+import os
+import time
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Tuple
+
+from image_buffer import ImageSource
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+
+
+@dataclass
+class TranscodeResult:
+    """一次解码产生的全部输出"""
+    compressed: Optional[object] = None                       # image_encoder.EncodeResult
+    thumbnails: Dict[int, object] = field(default_factory=dict)  # 最长边 -> EncodeResult
+    decode_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+
+
+class ImageWorkerPool:
+    """
+    图片处理线程池
+
+    Args:
+        max_workers: 工作线程数
+        max_pending: 执行中 + 排队的任务上限（默认为线程数的 4 倍）
+        submit_timeout: 队列已满时 submit 的最长等待秒数
+    """
+
+    def __init__(self, max_workers: int = IMAGE_WORKERS, max_pending: int = None,
+                 submit_timeout: float = 30.0):
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max_pending or self.max_workers * 4
+        self.submit_timeout = submit_timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="image-worker")
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0,
+                       "queue_wait_seconds": 0.0, "cpu_seconds": 0.0}
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """提交图片操作；队列已满时阻塞，超过 submit_timeout 抛出 RuntimeError"""
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise RuntimeError("图片处理队列已满")
+        enqueued = time.time()
+
+        def run():
+            with self._lock:
+                self._stats["queue_wait_seconds"] += time.time() - enqueued
+            started = time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._stats["cpu_seconds"] += time.thread_time() - started
+
+        try:
+            future = self._executor.submit(run)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats["submitted"] += 1
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future):
+        self._slots.release()
+        with self._lock:
+            self._stats["failed" if future.exception() else "completed"] += 1
+
+    # ==================== 常用操作 ====================
+
+    def compress(self, source: ImageSource, max_bytes: int, max_dimension: int = 4096) -> Future:
+        """按目标大小编码，Future 结果为 EncodeResult 或 None"""
+        from image_encoder import encode_to_limit
+        return self.submit(encode_to_limit, source, max_bytes, max_dimension)
+
+    def transcode(self, source: ImageSource, max_bytes: Optional[int] = None, max_dimension: int = 4096,
+                  thumbnails: Tuple[int, ...] = ()) -> Future:
+        """
+        解码一次，生成压缩图（max_bytes 不为空时）与各尺寸缩略图
+
+        Returns:
+            Future[TranscodeResult]
+        """
+        return self.submit(_transcode, source, max_bytes, max_dimension, thumbnails)
+
+    # ==================== 统计与关闭 ====================
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            s = dict(self._stats)
+        done = s["completed"] + s["failed"]
+        s["pending"] = s["submitted"] - done
+        s["avg_queue_wait_ms"] = s["queue_wait_seconds"] / s["submitted"] * 1000 if s["submitted"] else 0.0
+        return s
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+def _transcode(source: ImageSource, max_bytes: Optional[int], max_dimension: int,
+               thumbnails: Tuple[int, ...]) -> TranscodeResult:
+    from image_encoder import encode_image, encode_thumbnail, load_image
+    started = time.thread_time()
+    img = load_image(source, max_dimension)
+    result = TranscodeResult(decode_seconds=time.thread_time() - started)
+    if max_bytes:
+        result.compressed = encode_image(img, max_bytes)
+    for side in thumbnails:
+        result.thumbnails[side] = encode_thumbnail(img, side)
+    result.cpu_seconds = time.thread_time() - started
+    return result
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_image_pool() -> ImageWorkerPool:
+    """进程内共享的图片处理线程池"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ImageWorkerPool()
+        return _pool
+
+
+# ============================================================================
+# 吞吐测试
+# ============================================================================
+
+def measure_throughput(count: int = 8, width: int = 6000, height: int = 4000,
+                       max_bytes: int = 5 * 1024 * 1024, workers: int = IMAGE_WORKERS) -> Dict[str, float]:
+    """
+    模拟 count 张大图同时上传，每张压缩到 max_bytes 并生成 256px 缩略图：
+    - separate: 压缩与缩略图各自解码
+    - serial: 共享一次解码，逐张在调用线程中处理
+    - pool: 共享一次解码，并发提交到线程池
+    """
+    import io
+    from image_buffer import ImageBuffer
+    from image_encoder import _synthetic_photo, encode_thumbnail, encode_to_limit, load_image
+
+    buffer = io.BytesIO()
+    _synthetic_photo(width, height).save(buffer, "JPEG", quality=97)
+    sources = [ImageBuffer.from_bytes(buffer.getvalue(), f"upload_{i}.jpg") for i in range(count)]
+
+    started = time.time()
+    for source in sources:
+        encode_to_limit(source, max_bytes)
+        encode_thumbnail(load_image(source, 4096), 256)
+    separate = time.time() - started
+
+    started = time.time()
+    for source in sources:
+        _transcode(source, max_bytes, 4096, (256,))
+    serial = time.time() - started
+
+    pool = ImageWorkerPool(max_workers=workers)
+    started = time.time()
+    futures = [pool.transcode(source, max_bytes, thumbnails=(256,)) for source in sources]
+    results = [future.result() for future in futures]
+    pooled = time.time() - started
+    pool.shutdown()
+
+    return {
+        "images": count,
+        "workers": workers,
+        "separate_seconds": separate,
+        "serial_seconds": serial,
+        "pool_seconds": pooled,
+        "serial_images_per_s": count / serial,
+        "pool_images_per_s": count / pooled,
+        "speedup": serial / pooled,
+        "avg_decode_seconds": sum(r.decode_seconds for r in results) / count,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="图片处理线程池")
+    parser.add_argument("--bench", type=int, metavar="N", help="测量 N 张大图并发处理的吞吐")
+    parser.add_argument("--workers", type=int, default=IMAGE_WORKERS, help="线程数")
+    args = parser.parse_args()
+    if args.bench:
+        result = measure_throughput(args.bench, workers=args.workers)
+        print(f"{result['images']} 张 6000x4000 JPEG（压缩到 5MB + 256px 缩略图），{result['workers']} 线程")
+        print(f"  分别解码: {result['separate_seconds']:.2f}s")
+        print(f"  逐张处理: {result['serial_seconds']:.2f}s, {result['serial_images_per_s']:.2f} 张/s")
+        print(f"  线程池:   {result['pool_seconds']:.2f}s, {result['pool_images_per_s']:.2f} 张/s "
+              f"(x{result['speedup']:.2f})")
+        print(f"  平均解码耗时: {result['avg_decode_seconds']:.2f}s（每张只解码一次）")
@@ -3,18 +3,29 @@
 使用 ReAct Agent 作为智能问答助手
 """
 import os
-import re
 import sys
+
+# 启动报告需要在其余模块导入之前开始统计（STARTUP_REPORT=1 或 --startup-report）；
+# 先读取 .env，其中设置的 STARTUP_REPORT 同样生效
+from startup import ImportProfiler, format_report, load_env, timeline
+load_env()
+STARTUP_REPORT = os.getenv("STARTUP_REPORT") == "1" or "--startup-report" in sys.argv
+_import_profiler = ImportProfiler().install() if STARTUP_REPORT else None
+
+import re
 import time
 import json
 import logging
 import threading
 import signal
-from dataclasses import dataclass
-from typing import Optional
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
 
-load_dotenv()
+from bot_logging import setup_logging, request_context
+from ttl_cache import TTLCache
+from image_buffer import disk_io, discard_image
 
 
 # ============================================================================
@@ -22,19 +33,31 @@ load_dotenv()
 # ============================================================================
 
 LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
-LOG_FILE = os.path.join(LOG_DIR, f"bot_{time.strftime('%Y%m%d')}.log")
+LOG_LEVEL = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+
+setup_logging(LOG_DIR, level=LOG_LEVEL)
+
+# 运行状态持久化（消息去重等），重启后仍可识别飞书重复推送
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+STATE_DB = os.getenv("BOT_STATE_DB", os.path.join(DATA_DIR, "bot_state.sqlite3"))
+
+# 并发处理消息的线程数（同一会话内的消息仍按顺序处理）
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", "4"))
+
+# 图片在下载/处理/上传各阶段之间以内存缓冲传递（设为 0 时沿用临时文件）
+IMAGE_IN_MEMORY = os.getenv("IMAGE_IN_MEMORY", "1") != "0"
 
-os.makedirs(LOG_DIR, exist_ok=True)
+# 快速启动：WebSocket 先行连接，ComfyUI/ngrok 探测与 LLM 客户端预热在后台进行（设为 0 时按顺序阻塞初始化）
+FAST_START = os.getenv("FAST_START", "1") != "0"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# 普通问答以流式卡片回复：先发占位卡片，再原地写入当前步骤与答案（设为 0 时等回答完成后一次发送）
+STREAM_REPLY = os.getenv("STREAM_REPLY", "1") != "0"
+
+# config.json5 热更新的检查间隔（秒，设为 0 时不检查）
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "2"))
+
+# ComfyUI 候选端点的探测间隔（秒，当前端点异常时改为每秒探测）
+ENDPOINT_PROBE_INTERVAL = float(os.getenv("COMFYUI_PROBE_INTERVAL", "15"))
 
 logger = logging.getLogger(__name__)
 
@@ -68,22 +91,27 @@ def strip_markdown(text: str) -> str:
 # ============================================================================
 
 class MessageDeduplicator:
-    """消息去重器，防止同一消息被并发处理或重复处理"""
-
-    def __init__(self, max_processed: int = 1000):
+    """
+    消息去重器，防止同一消息被并发处理或重复处理。
+    已处理的消息ID保存在 TTLCache 中（按处理时间淘汰最旧记录），
+    配置 persist_path 后重启也能识别飞书的重复推送。
+    """
+
+    def __init__(self, max_processed: int = 5000, ttl: float = 6 * 3600,
+                 persist_path: Optional[str] = None):
         self._processing = set()
-        self._processed = set()
-        self._max_processed = max_processed
+        self._processed = TTLCache(max_size=max_processed, ttl=ttl,
+                                   persist_path=persist_path, namespace="processed_messages")
         self._lock = threading.Lock()
 
     def try_acquire(self, message_id: str) -> bool:
         """尝试获取消息处理权，返回是否成功"""
         with self._lock:
             if message_id in self._processing:
-                logger.info(f"[跳过] 消息正在处理中: {message_id}")
+                logger.info("[跳过] 消息正在处理中: %s", message_id)
                 return False
             if message_id in self._processed:
-                logger.info(f"[跳过] 消息已处理过: {message_id}")
+                logger.info("[跳过] 消息已处理过: %s", message_id)
                 return False
             self._processing.add(message_id)
             return True
@@ -92,11 +120,7 @@ class MessageDeduplicator:
         """标记消息处理完成"""
         with self._lock:
             self._processing.discard(message_id)
-            self._processed.add(message_id)
-            if len(self._processed) > self._max_processed:
-                excess = len(self._processed) - self._max_processed // 2
-                for _ in range(excess):
-                    self._processed.pop()
+            self._processed.set(message_id, time.time())
 
     def discard(self, message_id: str):
         """移除处理中标记（不标记为已处理，用于跳过的消息）"""
@@ -117,6 +141,7 @@ class ParsedMessage:
     message_type: str
     sender_id: str
     sender_type: str
+    received_at: float = field(default_factory=time.time)
 
 
 def parse_message_event(data) -> Optional[ParsedMessage]:
@@ -127,10 +152,10 @@ def parse_message_event(data) -> Optional[ParsedMessage]:
     elif isinstance(data, dict):
         message = data.get("message", {})
     else:
-        logger.warning(f"无法解析消息数据类型: {type(data)}")
+        logger.warning("无法解析消息数据类型: %s", type(data))
         return None
 
-    logger.info(f"解析后的消息: {message}")
+    logger.debug("解析后的消息: %s", message)
 
     # 提取基本字段
     chat_id = getattr(message, 'chat_id', '')
@@ -138,7 +163,8 @@ def parse_message_event(data) -> Optional[ParsedMessage]:
     message_id = getattr(message, 'message_id', '')
     message_type = getattr(message, 'msg_type', '') or getattr(message, 'message_type', '')
 
-    logger.info(f"chat_id={chat_id}, content={content}, message_id={message_id}, message_type={message_type}")
+    logger.debug("chat_id=%s, content=%s, message_id=%s, message_type=%s",
+                 chat_id, content, message_id, message_type)
 
     # 提取发送者信息（sender 在 data 对象上，不在 message 上）
     sender = getattr(data, 'sender', None) or getattr(message, 'sender', None)
@@ -158,7 +184,7 @@ def parse_message_event(data) -> Optional[ParsedMessage]:
                 message_type = 'text'
             elif 'image_key' in content_json:
                 message_type = 'image'
-            logger.info(f"推断的消息类型: {message_type}")
+            logger.debug("推断的消息类型: %s", message_type)
         except Exception:
             pass
 
@@ -179,24 +205,44 @@ def parse_message_event(data) -> Optional[ParsedMessage]:
 class FeishuBot:
     """飞书 Agent 机器人，整合初始化、消息处理和启动逻辑"""
 
-    CANCEL_KEYWORDS = {"不需要", "不用", "不要", "否", "no", "No", "NO", "取消"}
+    CANCEL_KEYWORDS = {"不需要", "不用", "不要", "否", "no", "No", "NO", "取消", "/cancel"}
 
     def __init__(self):
-        self.deduplicator = MessageDeduplicator()
+        self.deduplicator = MessageDeduplicator(persist_path=STATE_DB)
         self.feishu_client = None
         self.agent = None
         self.comfyui_client = None
         self.image_processor = None
+        self.scheduler = None
+        self.sender = None
+        self.endpoint_resolver = None
         self.ws_client = None
+        # 事件回调线程只负责解析和投递，消息在工作线程中处理
+        self._workers = ThreadPoolExecutor(max_workers=MESSAGE_WORKERS, thread_name_prefix="msg-worker")
+        self._chat_locks: Dict[str, list] = {}  # chat_id -> [锁, 等待或持有该锁的消息数]
+        self._chat_locks_guard = threading.Lock()
+        self._active_requests: Dict[str, str] = {}  # chat_id -> 正在处理的 message_id
+        self._agent_local = threading.local()
+        self._agent_factory = None
+        self._edit_count = 0  # 多个工作线程并发编辑，经 _edit_count_lock 累加
+        self._edit_count_lock = threading.Lock()
+        self._stream_stats = {"replies": 0, "first_visible_total": 0.0, "first_visible_max": 0.0,
+                              "first_answer_total": 0.0, "patches": 0, "patch_failures": 0}
+        self._stream_stats_lock = threading.Lock()
 
     # ---- 初始化 ----
 
     def init_all(self):
-        """执行所有初始化步骤"""
+        """执行所有初始化步骤（快速启动时后端探测推迟到 WebSocket 启动之后在后台进行）"""
+        timeline.mark("模块导入完成")
         self._init_sdk()
+        timeline.mark("飞书 SDK 已加载")
         self._init_agent()
         self._init_feishu_client()
         self._init_comfyui()
+        if not FAST_START:
+            self._probe_comfyui()
+        timeline.mark("初始化完成")
 
     def _init_sdk(self):
         """加载飞书 SDK"""
@@ -207,7 +253,7 @@ class FeishuBot:
             from lark_oapi.event.dispatcher_handler import EventDispatcherHandlerBuilder
             logger.info("[OK] 飞书SDK已加载")
         except ImportError as e:
-            logger.error(f"[ERROR] 未安装 lark-oapi SDK: {e}")
+            logger.error("[ERROR] 未安装 lark-oapi SDK: %s", e)
             sys.exit(1)
 
     def _init_agent(self):
@@ -215,7 +261,7 @@ class FeishuBot:
         from Agent import (
             ReActAgent, HelloAgentsLLM, ToolExecutor,
             search, calculate, get_current_time,
-            comfyui_text_to_image, comfyui_check_server, comfyui_edit_image,
+            comfyui_text_to_image, comfyui_text_to_image_batch, comfyui_check_server, comfyui_edit_image,
             comfyui_remove_background,
             feishu_create_doc, feishu_write_doc, comfyui_context,
         )
@@ -226,9 +272,9 @@ class FeishuBot:
         # LLM
         try:
             llm_client = HelloAgentsLLM()
-            logger.info(f"[OK] LLM 客户端初始化成功: {llm_client.model}")
+            logger.info("[OK] LLM 客户端初始化成功: %s", llm_client.model)
         except ValueError as e:
-            logger.error(f"[ERROR] LLM 配置缺失: {e}")
+            logger.error("[ERROR] LLM 配置缺失: %s", e)
             sys.exit(1)
 
         # 工具
@@ -238,6 +284,7 @@ class FeishuBot:
             ("Calculator", "一个数学计算器。用于执行复杂的数学计算，支持加减乘除(+、-、*、/)、乘方(^)、括号等运算。输入格式应为数学表达式。", calculate),
             ("GetCurrentTime", "获取当前日期和时间。当需要知道当前时间、日期，或需要判断信息的时效性（如\"今天\"、\"最新\"、\"最近\"等）时，应先调用此工具获取当前时间。输入可选时区偏移，如'+8'表示东八区，默认为东八区(北京时间)。", get_current_time),
             ("TextToImage", "使用ComfyUI进行文生图（文字生成图片）。当用户要求生成图片、画图、创作图像时使用此工具。输入应为图像的详细描述/提示词，如\"一只可爱的猫咪\"、\"夕阳下的海滩\"等。生成的图片将自动发送到聊天中。", comfyui_text_to_image),
+            ("BatchTextToImage", "使用ComfyUI一次生成多张图片。当用户要求画多张图（如\"画4张不同的猫\"）或同时给出多个描述时使用此工具，比多次调用TextToImage快得多。输入格式为：数量|提示词（同一描述生成多张，如\"4|一只可爱的猫咪\"），或 提示词1|提示词2|...（多个不同描述各一张）。最多8张，图片会合并为一条消息发送。", comfyui_text_to_image_batch),
             ("CheckComfyUI", "检查ComfyUI服务器是否正在运行。当需要确认图像生成服务是否可用时，应先调用此工具。无需输入参数。", comfyui_check_server),
             ("EditImage", "使用ComfyUI对用户发送的图片进行编辑。当用户发送了图片并要求对图片进行修改/编辑时使用此工具。输入应为编辑提示词，如\"给人物加上墨镜\"、\"把背景换成海滩\"等。注意：只有当用户已发送图片且需要编辑时才调用此工具。", comfyui_edit_image),
             ("RemoveBackground", "使用ComfyUI去除人像图片的背景杂物。当用户发送了人像图片并要求去除背景、移除背景杂物、抠图时使用此工具。此工具专门用于人像背景移除，效果比EditImage更好。输入为用户的描述文字即可。注意：只有当用户已发送图片且要求去除背景时才调用此工具，其他编辑需求应使用EditImage。", comfyui_remove_background),
@@ -247,13 +294,14 @@ class FeishuBot:
         for name, desc, func in tools:
             tool_executor.registerTool(name, desc, func)
 
-        # Agent
-        self.agent = ReActAgent(
+        # Agent（ReActAgent 的 history 是单次运行的状态，每个工作线程各用一个实例）
+        self._agent_factory = lambda: ReActAgent(
             llm_client=llm_client,
             tool_executor=tool_executor,
             max_steps=8,
             max_consecutive_failures=3,
         )
+        self.agent = self._get_agent()
         logger.info("[OK] Agent 初始化完成")
         logger.info("\n--- 可用工具 ---")
         logger.info(tool_executor.getAvailableTools())
@@ -284,9 +332,15 @@ class FeishuBot:
         sdk_client = lark.Client.builder() \
             .app_id(app_id) \
             .app_secret(app_secret) \
+            .enable_set_token(True) \
             .build()
         self.feishu_client.set_client(sdk_client)
 
+        # 出站消息统一经由后台队列限流发送
+        from outbound_sender import OutboundSender
+        self.sender = OutboundSender(self.feishu_client)
+        self.feishu_client.set_sender(self.sender)
+
         logger.info("[OK] 飞书客户端初始化完成")
 
     def _init_comfyui(self):
@@ -294,102 +348,243 @@ class FeishuBot:
         logger.info("\n--- 初始化 ComfyUI 客户端 ---")
 
         try:
-            from Comfyui import ComfyUIClient, ImageProcessor
+            from Comfyui import ComfyUIClient, ImageProcessor, config as comfyui_config
+            from batch_scheduler import MicroBatchScheduler
+            from backend_planner import CacheAffinityPlanner
+            from endpoint_resolver import EndpointResolver
             self.comfyui_client = ComfyUIClient()
-            self.image_processor = ImageProcessor(self.comfyui_client)
+            self.image_processor = ImageProcessor(self.comfyui_client, in_memory=IMAGE_IN_MEMORY)
+
+            batching = comfyui_config.get("batching", {}) or {}
+            if batching.get("enabled", True):
+                # 额外的 ComfyUI 后端按模型驻留情况分配（默认只有一个后端，仅统计模型切换）
+                extra_backends = (comfyui_config.get("comfyUI", {}) or {}).get("backends", []) or []
+                planner = CacheAffinityPlanner.from_urls(
+                    extra_backends, default_processor=self.image_processor,
+                    reload_seconds=batching.get("reload_seconds", 20),
+                )
+                self.scheduler = MicroBatchScheduler(
+                    self.image_processor,
+                    window=batching.get("window_ms", 300) / 1000,
+                    max_batch=batching.get("max_batch", 4),
+                    max_workers=max(2, 2 * len(planner.backends)),
+                    planner=planner,
+                )
+                logger.info("[OK] 微批调度已启用: 窗口 %sms, 单批最多 %s 个请求",
+                            batching.get("window_ms", 300), batching.get("max_batch", 4))
 
             self._comfyui_context.set(
                 feishu_client=self.feishu_client,
                 comfyui_client=self.comfyui_client,
                 image_processor=self.image_processor,
+                scheduler=self.scheduler,
             )
 
-            if self.comfyui_client.check_server(max_attempts=1, check_delay=0):
-                logger.info("[OK] ComfyUI 服务器已运行")
-            else:
-                # 内网不通，尝试公网地址
-                logger.info("内网地址不可达，尝试通过 ngrok 公网地址连接...")
-                public_url = self._get_ngrok_url()
-                if public_url:
-                    self.comfyui_client.api_url = public_url
-                    # ImageProcessor 通过 self.client 引用 ComfyUIClient，无需额外设置
-                    if self.comfyui_client.check_server(max_attempts=2, check_delay=2):
-                        logger.info(f"[OK] 通过公网地址连接 ComfyUI: {public_url}")
-                    else:
-                        logger.warning("[警告] 公网地址也不可达，文生图功能暂不可用")
-                else:
-                    logger.warning("[警告] ComfyUI 服务器未运行且无法获取公网地址，文生图功能暂不可用")
+            # 端点解析：配置地址、ngrok 隧道与默认公网地址按优先级探测，切换时更新客户端地址
+            self.endpoint_resolver = EndpointResolver(
+                self._configured_endpoints(comfyui_config.snapshot), interval=ENDPOINT_PROBE_INTERVAL)
+            self.endpoint_resolver.subscribe(self._on_endpoint_switched)
+            self.comfyui_client.on_unreachable = self.endpoint_resolver.report_failure
+            self._comfyui_context.resolver = self.endpoint_resolver
+
+            # comfyUI.url 变化（如 start_comfyui.py 写入新的 ngrok 地址）时更新端点候选
+            comfyui_config.store.subscribe(self._on_comfyui_config_changed, "api_url")
+            if CONFIG_RELOAD_INTERVAL > 0:
+                comfyui_config.store.start_watching(CONFIG_RELOAD_INTERVAL)
         except Exception as e:
-            logger.warning(f"[警告] ComfyUI 初始化失败（文生图功能不可用）: {e}")
+            logger.warning("[警告] ComfyUI 初始化失败（文生图功能不可用）: %s", e)
             self.comfyui_client = None
             self.image_processor = None
 
-    # 默认 ngrok 公网地址（当本地 API 不可用时使用）
-    DEFAULT_NGROK_URL = "https://candi-sporogonial-eliz.ngrok-free.dev"
+    @staticmethod
+    def _configured_endpoints(snapshot) -> List[str]:
+        """配置中的 ComfyUI 候选地址：comfyUI.url（或 host:port），再加 comfyUI.endpoints"""
+        extra = (snapshot.get("comfyUI", {}) or {}).get("endpoints", []) or []
+        return [snapshot.api_url] + [url for url in extra if url]
+
+    def _on_comfyui_config_changed(self, old, new):
+        """配置中的 ComfyUI 地址变化：更新端点候选并立即重新探测"""
+        if not self.endpoint_resolver:
+            return
+        logger.info("[配置] ComfyUI 地址变更: %s -> %s", old.api_url, new.api_url)
+        self.endpoint_resolver.set_configured(self._configured_endpoints(new))
+        # 本地/远程切换时输入输出目录随之变化
+        from Comfyui import config as comfyui_config
+        comfyui_config.ensure_folders()
+
+    def _on_endpoint_switched(self, old_url, new_url):
+        """活动端点切换：之后开始的任务使用新地址（已开始的任务固定在原端点上）"""
+        if self.comfyui_client:
+            self.comfyui_client.api_url = new_url
 
-    @classmethod
-    def _get_ngrok_url(cls) -> str:
-        """通过 ngrok 本地 API 获取公网地址，失败时返回默认地址"""
+    def _probe_comfyui(self):
+        """探测全部候选端点，选出可用的 ComfyUI 地址，随后在后台持续探测"""
+        if not self.endpoint_resolver:
+            return
         try:
-            import urllib.request
-            with urllib.request.urlopen("http://127.0.0.1:4040/api/tunnels", timeout=3) as resp:
-                data = json.loads(resp.read().decode())
-                for tunnel in data.get("tunnels", []):
-                    url = tunnel.get("public_url", "")
-                    if url.startswith("https://"):
-                        return url
-        except Exception:
-            pass
-        return cls.DEFAULT_NGROK_URL
+            active = self.endpoint_resolver.refresh()
+            if active:
+                logger.info("[OK] ComfyUI 服务器已运行: %s", active)
+            else:
+                logger.warning("[警告] 所有 ComfyUI 地址均不可达，文生图功能暂不可用（后台持续探测）")
+        except Exception as e:
+            logger.warning("[警告] ComfyUI 服务器探测失败: %s", e)
+        finally:
+            self.endpoint_resolver.start()
+            timeline.mark("ComfyUI 探测完成")
+
+    def _background_startup(self):
+        """WebSocket 启动后在后台执行：后端探测、LLM 客户端预热，最后输出启动报告"""
+        self._probe_comfyui()
+        try:
+            # 预先导入 openai 并创建客户端，避免第一条消息承担导入耗时
+            self.agent.llm_client.client
+            import requests  # noqa: F401
+            timeline.mark("LLM 客户端预热完成")
+        except Exception as e:
+            logger.warning("[警告] LLM 客户端预热失败: %s", e)
+        self._log_startup_report()
+
+    def _log_startup_report(self):
+        if not STARTUP_REPORT:
+            return
+        if _import_profiler:
+            _import_profiler.uninstall()
+        logger.info("\n%s", format_report(_import_profiler))
 
     # ---- 消息处理 ----
 
     def handle_message_event(self, data):
-        """处理接收到的消息事件"""
+        """处理接收到的消息事件：解析后投递到工作线程，不阻塞事件回调"""
         try:
             msg = parse_message_event(data)
             if not msg:
                 return
+            self._workers.submit(self._process_in_worker, msg)
+        except Exception as e:
+            logger.exception("[ERROR] 处理消息异常: %s", e)
 
-            # 消息去重
-            if not self.deduplicator.try_acquire(msg.message_id):
-                return
+    def _process_in_worker(self, msg: ParsedMessage):
+        """工作线程入口：同一会话的消息串行处理，不同会话并发处理"""
+        # 以 message_id 作为本次处理的 request_id，贯穿所有日志
+        with request_context(msg.message_id):
+            try:
+                # 取消关键词不排在会话锁之后，会话中正在处理的请求立即取消
+                if self._try_cancel_active(msg):
+                    return
+                with self._chat_lock(msg.chat_id):
+                    self._set_active_request(msg.chat_id, msg.message_id)
+                    try:
+                        self._process_message(msg)
+                    finally:
+                        self._set_active_request(msg.chat_id, None)
+            except Exception as e:
+                logger.exception("[ERROR] 处理消息异常: %s", e)
 
-            # 过滤机器人自身消息
-            if msg.sender_type and msg.sender_type.lower() == 'bot':
-                logger.info(f"[跳过] 机器人自身消息: {msg.message_id}")
-                self.deduplicator.discard(msg.message_id)
-                return
+    def _set_active_request(self, chat_id: str, message_id: Optional[str]):
+        with self._chat_locks_guard:
+            if message_id:
+                self._active_requests[chat_id] = message_id
+            else:
+                self._active_requests.pop(chat_id, None)
+
+    def _try_cancel_active(self, msg: ParsedMessage) -> bool:
+        """
+        会话中有正在处理的请求时，取消关键词立即取消该请求：
+        已提交到 ComfyUI 的任务排队中的从队列删除、正在执行的中断，微批调度中等待的请求随即返回，
+        之后该请求不再提交新任务。返回是否已作为取消处理
+        """
+        if msg.message_type != 'text':
+            return False
+        with self._chat_locks_guard:
+            request_id = self._active_requests.get(msg.chat_id)
+        if not request_id:
+            return False
+        try:
+            user_text = json.loads(msg.content).get("text", "").strip()
+        except Exception:
+            return False
+        if user_text not in self.CANCEL_KEYWORDS:
+            return False
+        if not self.deduplicator.try_acquire(msg.message_id):
+            return True
 
-            try:
-                # 设置上下文
-                self._comfyui_context.chat_id = msg.chat_id
-                self._comfyui_context.sender_id = msg.sender_id
-
-                logger.info(f"========== 收到新消息 ==========")
-                logger.info(f"消息ID: {msg.message_id}")
-                logger.info(f"聊天ID: {msg.chat_id}")
-                logger.info(f"发送者: {msg.sender_id}")
-                logger.info(f"消息类型: {msg.message_type}")
-                logger.info(f"原始内容: {msg.content}")
-
-                # 分发处理
-                if msg.message_type == 'image':
-                    self._handle_image_message(msg)
-                elif msg.message_type == 'text':
-                    self._handle_text_message(msg)
-                else:
-                    logger.info(f"[跳过] 不支持的消息类型: {msg.message_type}")
-
-            finally:
-                self.deduplicator.release(msg.message_id)
-                self._comfyui_context.chat_id = None
-                self._comfyui_context.sender_id = None
+        try:
+            logger.info("[取消] 取消正在处理的请求: %s", request_id)
+            from Comfyui import active_jobs
+            from feishu_client import format_duration
+            report = active_jobs.cancel(request_id)
+            released = self.scheduler.cancel(request_id) if self.scheduler else 0
+            logger.info("[取消] 撤下任务 %d 个（删除排队 %d 个，中断执行 %d 个，合并批次中保留 %d 个），"
+                        "释放等待 %d 个，释放 GPU 时间约 %.0f 秒", report["jobs"], report["deleted"],
+                        report["interrupted"], report["shared"], released, report["reclaimed_seconds"])
+            if report["jobs"]:
+                text = (f"🛑 已取消当前任务：删除排队 {report['deleted']} 个、中断执行 {report['interrupted']} 个，"
+                        f"释放约 {format_duration(report['reclaimed_seconds'])} 的 GPU 排队时间。")
+            else:
+                text = "🛑 已取消当前任务。"
+            self.feishu_client.post_text(msg.chat_id, text)
+        finally:
+            self.deduplicator.release(msg.message_id)
+        return True
+
+    @contextmanager
+    def _chat_lock(self, chat_id: str):
+        """持有会话锁（同一会话的消息串行处理）；会话没有等待或处理中的消息时移除其锁，字典不随会话数增长"""
+        with self._chat_locks_guard:
+            entry = self._chat_locks.get(chat_id)
+            if entry is None:
+                entry = self._chat_locks[chat_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._chat_locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chat_locks[chat_id]
+
+    def _get_agent(self):
+        """获取当前线程的 ReActAgent（LLM 客户端与工具集共享）"""
+        agent = getattr(self._agent_local, "agent", None)
+        if agent is None:
+            agent = self._agent_local.agent = self._agent_factory()
+        return agent
+
+    def _process_message(self, msg: ParsedMessage):
+        """去重、过滤后分发消息"""
+        # 消息去重
+        if not self.deduplicator.try_acquire(msg.message_id):
+            return
 
-        except Exception as e:
-            logger.error(f"[ERROR] 处理消息异常: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+        # 过滤机器人自身消息
+        if msg.sender_type and msg.sender_type.lower() == 'bot':
+            logger.info("[跳过] 机器人自身消息: %s", msg.message_id)
+            self.deduplicator.discard(msg.message_id)
+            return
+
+        try:
+            # 设置上下文
+            self._comfyui_context.chat_id = msg.chat_id
+            self._comfyui_context.sender_id = msg.sender_id
+
+            logger.info("收到新消息: chat_id=%s, sender=%s, type=%s",
+                        msg.chat_id, msg.sender_id, msg.message_type)
+            logger.debug("原始内容: %s", msg.content)
+
+            # 分发处理
+            if msg.message_type == 'image':
+                self._handle_image_message(msg)
+            elif msg.message_type == 'text':
+                self._handle_text_message(msg)
+            else:
+                logger.info("[跳过] 不支持的消息类型: %s", msg.message_type)
+
+        finally:
+            self.deduplicator.release(msg.message_id)
+            self._comfyui_context.chat_id = None
+            self._comfyui_context.sender_id = None
 
     def _handle_image_message(self, msg: ParsedMessage):
         """处理图片消息"""
@@ -403,11 +598,11 @@ class FeishuBot:
             logger.info("[跳过] 无法提取 image_key")
             return
 
-        logger.info(f"收到图片消息, image_key: {image_key}")
+        logger.info("收到图片消息, image_key: %s", image_key)
 
         # 如果已有待编辑图片，提示用户
         if self._comfyui_context.pending_image_path:
-            self.feishu_client.send_text(
+            self.feishu_client.post_text(
                 msg.chat_id,
                 "⚠️ 您已发送了一张图片，正在等待您输入编辑提示词。\n\n"
                 "请输入提示词（如：给人物加上墨镜）来描述您想要的修改。\n\n"
@@ -415,23 +610,26 @@ class FeishuBot:
             )
             return
 
-        # 下载图片
-        from Comfyui import config as comfyui_config
-        temp_image_path = self.feishu_client.download_image(
-            image_key, msg.message_id, comfyui_config.input_folder
-        )
+        # 下载图片（内存模式下不落盘）
+        if IMAGE_IN_MEMORY:
+            temp_image_path = self.feishu_client.download_image_buffer(image_key, msg.message_id)
+        else:
+            from Comfyui import config as comfyui_config
+            temp_image_path = self.feishu_client.download_image(
+                image_key, msg.message_id, comfyui_config.input_folder
+            )
 
         if temp_image_path:
-            logger.info(f"图片已下载: {temp_image_path}")
+            logger.info("图片已下载: %s", temp_image_path)
             self._comfyui_context.pending_image_path = temp_image_path
-            self.feishu_client.send_text(
+            self.feishu_client.post_text(
                 msg.chat_id,
                 "📸 已收到图片！\n\n请问您是否要对这张图片进行编辑？\n"
                 "如果需要编辑，请告诉我您想要进行的修改（如：给人物加上墨镜、把背景换成海滩等）。\n"
                 "如果不需要编辑，请回复\"不需要\"。"
             )
         else:
-            self.feishu_client.send_text(msg.chat_id, "❌ 下载图片失败，请重新发送。")
+            self.feishu_client.post_text(msg.chat_id, "❌ 下载图片失败，请重新发送。")
 
     def _handle_text_message(self, msg: ParsedMessage):
         """处理文本消息"""
@@ -440,20 +638,20 @@ class FeishuBot:
             content_json = json.loads(msg.content)
             user_text = content_json.get("text", "").strip()
         except Exception as e:
-            logger.error(f"[跳过] 无法解析消息内容: {e}, content={msg.content}")
+            logger.error("[跳过] 无法解析消息内容: %s, content=%s", e, msg.content)
             return
 
         if not user_text:
             logger.info("[跳过] 消息内容为空")
             return
 
-        logger.info(f"用户消息: {user_text}")
+        logger.info("用户消息: %.200s", user_text)
 
         # 检查是否有待编辑的图片
         if self._comfyui_context.pending_image_path:
             self._handle_edit_request(msg.chat_id, user_text)
         else:
-            self._handle_normal_message(msg.chat_id, user_text)
+            self._handle_normal_message(msg.chat_id, user_text, msg.received_at)
 
     def _handle_edit_request(self, chat_id: str, user_text: str):
         """处理图像编辑请求"""
@@ -461,16 +659,13 @@ class FeishuBot:
         if user_text in self.CANCEL_KEYWORDS:
             old_path = self._comfyui_context.pending_image_path
             self._comfyui_context.pending_image_path = None
-            try:
-                os.remove(old_path)
-            except Exception:
-                pass
-            self.feishu_client.send_text(chat_id, "好的，已取消图片编辑。如果需要其他帮助，请随时告诉我！")
+            discard_image(old_path)
+            self.feishu_client.post_text(chat_id, "好的，已取消图片编辑。如果需要其他帮助，请随时告诉我！")
             return
 
         # 执行编辑
         logger.info("--- Agent 正在处理图像编辑请求 ---")
-        self.feishu_client.send_text(chat_id, f"🖌️ 收到！正在根据您的需求「{user_text}」编辑图片，请稍候...")
+        self.feishu_client.post_text(chat_id, f"🖌️ 收到！正在根据您的需求「{user_text}」编辑图片，进度将在稍后的卡片中实时更新。")
 
         # 根据用户意图判断使用哪个工具
         remove_bg_keywords = ["去除背景", "移除背景", "去背景", "抠图", "去掉背景", "删除背景", "背景杂物", "去除杂物", "去掉杂物"]
@@ -483,60 +678,94 @@ class FeishuBot:
             tool_hint = "EditImage"
             tool_desc = "编辑"
 
+        io_before = disk_io.snapshot()
         answer = self._run_agent(
             f"用户已发送了一张图片，图片已保存在服务器上。请直接使用{tool_hint}工具对这张图片进行{tool_desc}，"
             f"用户的原始需求为：{user_text}。注意：图片已经存在，无需请求用户发送图片。"
         )
 
+        # 进程级计数，并发编辑时包含其他任务的读写
+        io_delta = disk_io.delta(io_before, disk_io.snapshot())
+        with self._edit_count_lock:
+            self._edit_count += 1
+        logger.info("本次编辑图片磁盘读写: 读 %d 次/%d 字节, 写 %d 次/%d 字节",
+                    io_delta["reads"], io_delta["read_bytes"], io_delta["writes"], io_delta["write_bytes"])
+
         # 发送回复（编辑成功时只发图片，不发文字）
         if answer and answer.strip() == "__EDIT_IMAGE_SUCCESS__":
             logger.info("--- 图像编辑成功，图片已发送 ---")
         elif answer:
             self._send_reply(chat_id, answer)
         else:
-            self.feishu_client.send_text(chat_id, "抱歉，图像编辑失败。")
+            self.feishu_client.post_text(chat_id, "抱歉，图像编辑失败。")
 
         # 清除待编辑图片状态
         self._comfyui_context.pending_image_path = None
 
-    def _handle_normal_message(self, chat_id: str, user_text: str):
+    def _handle_normal_message(self, chat_id: str, user_text: str, received_at: float = None):
         """处理普通文本消息"""
+        if STREAM_REPLY and self._stream_reply(chat_id, user_text, received_at):
+            return
         logger.info("--- Agent 正在思考... ---")
         answer = self._run_agent(user_text)
-        logger.info(f"--- Agent 回答完成, answer={answer[:50] if answer else 'None'}... ---")
+        logger.info("--- Agent 回答完成, answer=%.50s... ---", answer)
         self._send_reply(chat_id, answer)
 
-    def _run_agent(self, prompt: str) -> Optional[str]:
-        """运行 Agent 并返回结果"""
+    def _stream_reply(self, chat_id: str, user_text: str, received_at: float = None) -> bool:
+        """以流式卡片回复，占位卡片发送失败时返回 False（由调用方改用普通回复）"""
+        from feishu_client import StreamingReply
+
+        reply = StreamingReply(self.feishu_client, chat_id, render=strip_markdown, started_at=received_at)
+        if not reply.start():
+            logger.warning("[流式回复] 占位卡片发送失败，改为普通回复")
+            return False
+
+        logger.info("--- Agent 正在思考（流式回复）... ---")
+        answer = self._run_agent(user_text, on_step=reply.step, on_token=reply.append)
+        logger.info("--- Agent 回答完成, answer=%.50s... ---", answer)
+        if answer:
+            reply.finish(answer)
+        else:
+            logger.warning("[发送] Agent 返回空，发送默认回复")
+            reply.finish("抱歉，我无法回答这个问题。", success=False)
+
+        s = reply.stats()
+        logger.info("[流式回复] 首个可见内容 %.2fs, 首个答案字符 %.2fs, 完成 %.2fs, 卡片更新 %d 次（失败 %d 次）",
+                    s["first_visible"], s["first_answer_visible"] or 0.0, s["finished"] or 0.0,
+                    s["patches"], s["patch_failures"])
+        with self._stream_stats_lock:
+            total = self._stream_stats
+            total["replies"] += 1
+            total["first_visible_total"] += s["first_visible"]
+            total["first_visible_max"] = max(total["first_visible_max"], s["first_visible"])
+            total["first_answer_total"] += s["first_answer_visible"] or 0.0
+            total["patches"] += s["patches"]
+            total["patch_failures"] += s["patch_failures"]
+        return True
+
+    def _run_agent(self, prompt: str, **callbacks) -> Optional[str]:
+        """运行 Agent 并返回结果（callbacks 为 on_step / on_token，透传给 ReActAgent.run）"""
         try:
-            return self.agent.run(prompt)
+            return self._get_agent().run(prompt, **callbacks)
         except Exception as e:
-            logger.error(f"Agent 执行异常: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.exception("Agent 执行异常: %s", e)
             return None
 
     def _send_reply(self, chat_id: str, answer: Optional[str]):
         """发送 Agent 回复给用户"""
         if not answer:
             logger.warning("[发送] Agent 返回空，发送默认回复")
-            self.feishu_client.send_text(chat_id, "抱歉，我无法回答这个问题。")
+            self.feishu_client.post_text(chat_id, "抱歉，我无法回答这个问题。")
             return
 
         answer = strip_markdown(answer)
 
-        # 飞书消息有长度限制，分段发送
+        # 飞书消息有长度限制，分段入队不等待结果，发送节奏由出站发送器控制
         max_length = 4000
-        if len(answer) > max_length:
-            for i in range(0, len(answer), max_length):
-                segment = answer[i:i + max_length]
-                self.feishu_client.send_text(chat_id, segment)
-                if i + max_length < len(answer):
-                    time.sleep(0.5)
-        else:
-            self.feishu_client.send_text(chat_id, answer)
+        for i in range(0, len(answer), max_length):
+            self.feishu_client.post_text(chat_id, answer[i:i + max_length])
 
-        logger.info(f"[发送] 回复已发送: {answer[:100]}...")
+        logger.info("[发送] 回复已发送: %.100s...", answer)
 
     # ---- 启动 ----
 
@@ -569,10 +798,10 @@ class FeishuBot:
         self.feishu_client.set_ws_client(self.ws_client)
         logger.info("[OK] 长连接客户端创建成功")
 
-        logger.info(f"\n{'=' * 50}")
+        logger.info("\n%s", '=' * 50)
         logger.info("飞书 Agent 机器人已启动！")
         logger.info("等待接收消息...")
-        logger.info(f"{'=' * 50}\n")
+        logger.info("%s\n", '=' * 50)
 
         # 在子线程中启动长连接
         stop_event = threading.Event()
@@ -581,10 +810,16 @@ class FeishuBot:
             try:
                 self.ws_client.start()
             except Exception as e:
-                logger.error(f"WebSocket 客户端异常: {e}")
+                logger.error("WebSocket 客户端异常: %s", e)
 
         ws_thread = threading.Thread(target=run_ws, daemon=True)
         ws_thread.start()
+        timeline.mark("WebSocket 已启动，开始接收事件")
+
+        if FAST_START:
+            threading.Thread(target=self._background_startup, name="startup", daemon=True).start()
+        else:
+            self._log_startup_report()
 
         # 主线程等待停止信号
         def signal_handler(sig, frame):
@@ -609,6 +844,37 @@ class FeishuBot:
                 self.ws_client.stop()
         except Exception:
             pass
+        if "Comfyui" in sys.modules:
+            sys.modules["Comfyui"].config.store.stop_watching()
+            logger.info("ComfyUI 提交去重统计: %s", sys.modules["Comfyui"].submissions.stats())
+            logger.info("ComfyUI 任务取消统计: %s", sys.modules["Comfyui"].active_jobs.stats())
+            logger.info("ComfyUI 状态轮询统计: %s", sys.modules["Comfyui"].polling_stats())
+        if self.endpoint_resolver:
+            self.endpoint_resolver.stop()
+            logger.info("ComfyUI 端点统计: %s", self.endpoint_resolver.stats())
+        if self.scheduler:
+            logger.info("微批调度统计: %s", self.scheduler.stats())
+            self.scheduler.shutdown(wait=False)
+        if self.sender:
+            self.sender.shutdown()
+            logger.info("出站消息统计: %s", self.sender.stats())
+        from image_pool import get_image_pool
+        logger.info("图片线程池统计: %s", get_image_pool().stats())
+        import resilience
+        logger.info("后端调用容错统计: %s", resilience.stats())
+        if self.feishu_client and self.feishu_client.upload_cache:
+            logger.info("上传去重统计: %s", self.feishu_client.upload_cache.stats())
+        if self._stream_stats["replies"]:
+            total = self._stream_stats
+            logger.info("流式回复统计: %d 次, 首个可见内容平均 %.2fs/最大 %.2fs, 首个答案字符平均 %.2fs, "
+                        "卡片更新 %d 次（失败 %d 次）", total["replies"],
+                        total["first_visible_total"] / total["replies"], total["first_visible_max"],
+                        total["first_answer_total"] / total["replies"], total["patches"], total["patch_failures"])
+        if self._edit_count:
+            io_total = disk_io.snapshot()
+            logger.info("图片磁盘读写累计（%s模式，%d 次编辑）: 读 %d 次/%d 字节, 写 %d 次/%d 字节",
+                        "内存" if IMAGE_IN_MEMORY else "文件", self._edit_count,
+                        io_total["reads"], io_total["read_bytes"], io_total["writes"], io_total["write_bytes"])
 
 
 # ============================================================================
@@ -625,7 +891,7 @@ if __name__ == "__main__":
         bot._stop_ws()
         logger.info("机器人已停止")
     except Exception as e:
-        logger.error(f"[ERROR] 启动失败: {e}")
+        logger.error("[ERROR] 启动失败: %s", e)
         import traceback
         logger.error(traceback.format_exc())
         sys.exit(1)
@@ -0,0 +1,230 @@
+"""
+出站消息发送模块
+发往飞书的消息经由 OutboundSender 的后台队列发送，处理线程只负责入队，不再 sleep 控制节奏：
+- 令牌桶限流：应用级（默认 50 条/秒）与单会话级（默认 5 条/秒），对应飞书发送消息接口的频控
+- 每个会话一个 FIFO 队列，同一会话按入队顺序发送，不同会话由发送线程并行处理
+- 同一会话中排队的相邻文本合并为一条富文本（post）消息
+- 遇到频控错误码时按指数退避（带抖动）重试，消息仍留在队首，顺序不变
+"""
+import json
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 飞书频控错误码：应用/接口调用频率超限、消息发送频率超限
+RATE_LIMIT_CODES = {99991400, 230020}
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，capacity 为突发上限"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """距离下一个可用令牌的秒数（0 表示当前可用）"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class _Outgoing:
+    """排队中的单条消息"""
+    msg_type: str
+    content: str                # 文本消息为原始文本，其余为 JSON 字符串
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+class OutboundSender:
+    """
+    飞书出站消息发送器
+
+    Args:
+        client: FeishuClient（使用其 create_message 直接调用接口）
+        app_rate: 应用级每秒消息数
+        chat_rate: 单会话每秒消息数
+        linger: 会话队列首条消息入队后等待的秒数，便于合并紧随其后的文本
+        max_workers: 并行发送的线程数
+        max_retries: 频控重试次数
+        max_merge_chars: 合并后的文本总长度上限
+    """
+
+    def __init__(self, client, app_rate: float = 50.0, chat_rate: float = 5.0, linger: float = 0.05,
+                 max_workers: int = 4, max_retries: int = 5, max_merge_chars: int = 4000):
+        self.client = client
+        self.chat_rate = chat_rate
+        self.linger = linger
+        self.max_retries = max_retries
+        self.max_merge_chars = max_merge_chars
+        self._app_bucket = TokenBucket(app_rate)
+        self._chat_buckets: Dict[str, TokenBucket] = {}
+        self._queues: Dict[str, Deque[_Outgoing]] = {}
+        self._retry_at: Dict[str, float] = {}
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="feishu-send")
+        self._stats = {"enqueued": 0, "messages": 0, "merged_texts": 0, "rate_limited": 0,
+                       "failed": 0, "queue_delay_max": 0.0}
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="feishu-send-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    # ==================== 入队接口 ====================
+
+    def send_text(self, chat_id: str, text: str) -> Future:
+        """文本消息入队，Future 结果为 message_id（失败为 None）"""
+        return self._enqueue(chat_id, _Outgoing("text", text))
+
+    def send(self, chat_id: str, content: str, msg_type: str) -> Future:
+        """任意类型消息入队（content 为 JSON 字符串），Future 结果为 message_id（失败为 None）"""
+        return self._enqueue(chat_id, _Outgoing(msg_type, content))
+
+    def _enqueue(self, chat_id: str, item: _Outgoing) -> Future:
+        with self._cond:
+            if self._stopped:
+                item.future.set_result(None)
+                return item.future
+            self._queues.setdefault(chat_id, deque()).append(item)
+            self._stats["enqueued"] += 1
+            self._cond.notify_all()
+        return item.future
+
+    # ==================== 调度 ====================
+
+    def _dispatch_loop(self):
+        with self._cond:
+            while not self._stopped:
+                timeout = self._dispatch_ready(time.monotonic())
+                self._cond.wait(timeout)
+
+    def _dispatch_ready(self, now: float) -> Optional[float]:
+        """提交所有可发送的会话，返回下一次需要检查的等待秒数（调用方持有锁）"""
+        next_wait = None
+        for chat_id in list(self._queues):
+            queue = self._queues[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+                bucket = self._chat_buckets.get(chat_id)
+                if bucket and bucket.full(now):
+                    del self._chat_buckets[chat_id]
+                continue
+            if chat_id in self._busy:
+                continue
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate))
+            wait = max(self._retry_at.get(chat_id, 0.0) - now,
+                       queue[0].enqueued_at + self.linger - now,
+                       bucket.delay(now), self._app_bucket.delay(now))
+            if wait > 0:
+                next_wait = wait if next_wait is None else min(next_wait, wait)
+                continue
+            bucket.take(now)
+            self._app_bucket.take(now)
+            self._retry_at.pop(chat_id, None)
+            batch = self._take_batch(queue)
+            self._busy.add(chat_id)
+            self._stats["queue_delay_max"] = max(self._stats["queue_delay_max"], now - batch[0].enqueued_at)
+            self._executor.submit(self._deliver, chat_id, batch)
+        return next_wait
+
+    def _take_batch(self, queue: Deque[_Outgoing]) -> List[_Outgoing]:
+        """取出队首消息；队首为文本时连同紧随其后的文本一起取出（不超过 max_merge_chars）"""
+        batch = [queue.popleft()]
+        if batch[0].msg_type != "text":
+            return batch
+        total = len(batch[0].content)
+        while queue and queue[0].msg_type == "text" and total + len(queue[0].content) <= self.max_merge_chars:
+            total += len(queue[0].content)
+            batch.append(queue.popleft())
+        return batch
+
+    @staticmethod
+    def _build(batch: List[_Outgoing]):
+        """单条消息原样发送，多条文本合并为 post（每段文字之间空一行）"""
+        if len(batch) == 1:
+            item = batch[0]
+            if item.msg_type == "text":
+                return json.dumps({"text": item.content}, ensure_ascii=False), "text"
+            return item.content, item.msg_type
+        paragraphs = []
+        for index, item in enumerate(batch):
+            if index:
+                paragraphs.append([{"tag": "text", "text": ""}])
+            paragraphs.extend([{"tag": "text", "text": line}] for line in item.content.split("\n"))
+        return json.dumps({"zh_cn": {"title": "", "content": paragraphs}}, ensure_ascii=False), "post"
+
+    def _deliver(self, chat_id: str, batch: List[_Outgoing]):
+        content, msg_type = self._build(batch)
+        try:
+            code, message_id = self.client.create_message(chat_id, content, msg_type)
+        except Exception as e:
+            logger.warning("[发送] 调用发送接口异常: %s", e)
+            code, message_id = -1, None
+
+        with self._cond:
+            self._busy.discard(chat_id)
+            if code in RATE_LIMIT_CODES and batch[0].attempts < self.max_retries:
+                # 放回队首，按指数退避重试
+                for item in batch:
+                    item.attempts += 1
+                self._queues.setdefault(chat_id, deque()).extendleft(reversed(batch))
+                delay = min(8.0, 0.5 * 2 ** (batch[0].attempts - 1)) * random.uniform(0.8, 1.2)
+                self._retry_at[chat_id] = time.monotonic() + delay
+                self._stats["rate_limited"] += 1
+                logger.warning("[发送] 会话 %s 触发频控(code=%s)，%.1f 秒后重试", chat_id, code, delay)
+                self._cond.notify_all()
+                return
+            if code == 0:
+                self._stats["messages"] += 1
+                if len(batch) > 1:
+                    self._stats["merged_texts"] += len(batch)
+            else:
+                self._stats["failed"] += len(batch)
+            self._cond.notify_all()
+        for item in batch:
+            item.future.set_result(message_id if code == 0 else None)
+
+    # ==================== 统计与关闭 ====================
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            s = dict(self._stats)
+            s["pending"] = sum(len(queue) for queue in self._queues.values())
+        return s
+
+    def shutdown(self, timeout: float = 10.0):
+        """等待队列发送完毕（最多 timeout 秒）后停止"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (any(self._queues.values()) or self._busy) and time.monotonic() < deadline:
+                self._cond.wait(min(0.1, max(0.0, deadline - time.monotonic())))
+            self._stopped = True
+            pending = [item for queue in self._queues.values() for item in queue]
+            self._queues.clear()
+            self._cond.notify_all()
+        for item in pending:
+            item.future.set_result(None)
+        self._executor.shutdown(wait=False)
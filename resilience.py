@@ -0,0 +1,331 @@
+"""
+后端调用容错模块
+ComfyUI、飞书、博查搜索与 LLM 调用统一经由 call() 重试：
+- 指数退避 + 全抖动（full jitter）：第 n 次重试前等待 uniform(0, min(max_delay, base_delay * 2^n)) 秒，
+  多个线程同时失败时不会在同一时刻一起重试
+- 熔断器（按 服务 + 端点）：连续失败达到阈值后打开，冷却期内的调用直接抛出 CircuitOpenError，不再逐个等待超时；
+  冷却结束后半开，只放行一个探测调用，成功则关闭、失败则重新打开
+- 重试预算（按服务）：重试次数不超过首次调用次数的一定比例（外加少量保底），后端整体故障时不会被重试放大流量
+- 幂等感知：idempotent=False 的调用只在请求确定没有发出时重试（连接被拒绝、DNS 失败、熔断），
+  超时等无法确定服务端是否已处理的错误不重试；before_retry 钩子可在重试前向服务端确认
+  （如按客户端生成的 prompt_id 查询 ComfyUI 队列与历史），已处理则直接返回结果
+"""
+import time
+import random
+import socket
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# 视为临时故障的 HTTP 状态码
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+# 按异常类名识别第三方库的临时故障（不导入 requests / openai）
+_TRANSIENT_NAMES = {
+    "ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout", "ChunkedEncodingError",  # requests
+    "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError",       # openai
+}
+# 请求确定没有发出的异常
+_NOT_SENT_NAMES = {"ConnectTimeout", "ConnectionRefusedError", "gaierror", "CircuitOpenError"}
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器打开，调用未执行"""
+
+
+class TransientError(RuntimeError):
+    """调用方判定的临时故障（如返回了频控错误码），可重试"""
+
+
+def _names(exc: BaseException):
+    return {cls.__name__ for cls in type(exc).__mro__}
+
+
+def _root(exc: BaseException) -> BaseException:
+    """urllib 的 URLError 把底层异常放在 reason 中"""
+    reason = getattr(exc, "reason", None)
+    return reason if isinstance(reason, BaseException) else exc
+
+
+def is_transient(exc: BaseException) -> bool:
+    """是否为值得重试的临时故障"""
+    status = getattr(exc, "code", None) if "HTTPError" in _names(exc) else getattr(exc, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRY_STATUS
+    exc = _root(exc)
+    if isinstance(exc, (TransientError, ConnectionError, TimeoutError, socket.timeout, socket.gaierror)):
+        return True
+    names = _names(exc)
+    return bool(names & _TRANSIENT_NAMES) or "URLError" in names
+
+
+def is_not_sent(exc: BaseException) -> bool:
+    """请求是否确定没有到达服务端（非幂等调用只在这种情况下重试）"""
+    return bool(_names(_root(exc)) & _NOT_SENT_NAMES) or bool(_names(exc) & _NOT_SENT_NAMES)
+
+
+def endpoint_of(url: str) -> str:
+    """URL 的 scheme://host[:port]，作为熔断器的端点键"""
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}" if parsed.netloc else url
+
+
+# ============================================================================
+# 熔断器与重试预算
+# ============================================================================
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    Args:
+        failure_threshold: 连续失败多少次后打开
+        reset_timeout: 打开后多少秒进入半开状态
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.short_circuited = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("[容错] %s 已恢复，熔断器关闭", self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    logger.warning("[容错] %s 连续失败 %d 次，熔断 %g 秒", self.name, self.failures, self.reset_timeout)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class RetryBudget:
+    """
+    重试预算：每次首次调用存入 ratio 个令牌，每次重试消耗 1 个；另按 min_per_second 持续补充保底令牌
+
+    Args:
+        ratio: 重试次数占首次调用次数的比例上限
+        min_per_second: 保底的每秒重试次数（低流量时也能重试）
+        cap: 令牌上限
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 0.5, cap: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.cap = cap
+        self.balance = cap
+        self.updated = time.monotonic()
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self.balance < 1:
+                self.exhausted += 1
+                return False
+            self.balance -= 1
+            return True
+
+    def _refill(self):
+        now = time.monotonic()
+        self.balance = min(self.cap, self.balance + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """单个服务的重试参数"""
+    attempts: int = 3             # 总尝试次数（含首次）
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    failure_threshold: int = 5    # 熔断阈值
+    reset_timeout: float = 30.0   # 熔断冷却秒数
+
+    def delay(self, retry: int) -> float:
+        """第 retry 次重试（从 0 计）前的等待秒数（全抖动）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+
+# 各服务的默认策略
+POLICIES: Dict[str, RetryPolicy] = {
+    "comfyui": RetryPolicy(attempts=3, base_delay=0.5, max_delay=4.0, failure_threshold=3, reset_timeout=15.0),
+    "feishu": RetryPolicy(attempts=3, base_delay=0.3, max_delay=4.0),
+    "search": RetryPolicy(attempts=3, base_delay=0.5, max_delay=4.0),
+    "llm": RetryPolicy(attempts=3, base_delay=1.0, max_delay=8.0, reset_timeout=20.0),
+}
+
+_breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+_budgets: Dict[str, RetryBudget] = {}
+_counters: Dict[str, Dict[str, int]] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(service: str, endpoint: str = "", policy: RetryPolicy = None) -> CircuitBreaker:
+    key = (service, endpoint)
+    with _registry_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            policy = policy or POLICIES.get(service, RetryPolicy())
+            name = f"{service}({endpoint})" if endpoint else service
+            breaker = _breakers[key] = CircuitBreaker(name, policy.failure_threshold, policy.reset_timeout)
+        return breaker
+
+
+def get_budget(service: str) -> RetryBudget:
+    with _registry_lock:
+        budget = _budgets.get(service)
+        if budget is None:
+            budget = _budgets[service] = RetryBudget()
+        return budget
+
+
+def _count(service: str, key: str):
+    with _registry_lock:
+        counters = _counters.setdefault(service, {"calls": 0, "retries": 0, "failures": 0,
+                                                  "short_circuited": 0, "recovered": 0})
+        counters[key] += 1
+
+
+# ============================================================================
+# 调用入口
+# ============================================================================
+
+def call(fn: Callable[[], Any], service: str, endpoint: str = "", *, idempotent: bool = True,
+         retry_result: Callable[[Any], bool] = None, before_retry: Callable[[Any], Any] = None,
+         policy: RetryPolicy = None, sleep: Callable[[float], None] = time.sleep) -> Any:
+    """
+    按服务策略执行 fn()，临时故障时退避重试
+
+    Args:
+        fn: 实际调用（无参数）
+        service: 服务名（POLICIES 的键），决定重试参数与重试预算
+        endpoint: 端点（如 scheme://host:port），熔断器按 服务 + 端点 区分
+        idempotent: 重复执行是否安全；False 时只在请求确定未发出时重试
+        retry_result: 以返回值判断是否需要重试（如 HTTP 429/5xx、频控错误码），重试耗尽时返回最后一次结果
+        before_retry: 重试前以上一次的异常（或结果）调用，返回非 None 时视为服务端已处理，直接作为结果返回；
+            抛出异常则放弃重试
+        policy: 覆盖服务的默认策略
+
+    Raises:
+        CircuitOpenError: 熔断器打开；其余为 fn 最后一次抛出的异常
+    """
+    policy = policy or POLICIES.get(service, RetryPolicy())
+    breaker = get_breaker(service, endpoint, policy)
+    budget = get_budget(service)
+    budget.deposit()
+    _count(service, "calls")
+
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            _count(service, "short_circuited")
+            raise CircuitOpenError(f"{breaker.name} 熔断中")
+        try:
+            result = fn()
+        except Exception as e:
+            transient = is_transient(e)
+            if transient:
+                breaker.record_failure()
+            else:
+                breaker.record_success()  # 服务端正常响应了（如 4xx），不计入熔断
+            retryable = transient and (idempotent or is_not_sent(e))
+            if not retryable or not _next_attempt(service, policy, budget, attempt):
+                _count(service, "failures")
+                raise
+            error = e
+        else:
+            if retry_result is None or not retry_result(result):
+                breaker.record_success()
+                if attempt:
+                    _count(service, "recovered")
+                return result
+            breaker.record_failure()
+            if not _next_attempt(service, policy, budget, attempt):
+                _count(service, "failures")
+                return result
+            error = result
+
+        delay = policy.delay(attempt)
+        attempt += 1
+        logger.info("[容错] %s 第 %d 次重试（%.2fs 后）: %s", breaker.name, attempt, delay, _describe(error))
+        sleep(delay)
+        if before_retry is not None:
+            existing = before_retry(error)
+            if existing is not None:
+                breaker.record_success()
+                _count(service, "recovered")
+                return existing
+
+
+def _next_attempt(service: str, policy: RetryPolicy, budget: RetryBudget, attempt: int) -> bool:
+    if attempt + 1 >= policy.attempts:
+        return False
+    if not budget.withdraw():
+        logger.warning("[容错] %s 重试预算已用完，不再重试", service)
+        return False
+    _count(service, "retries")
+    return True
+
+
+def _describe(error: Any) -> str:
+    if isinstance(error, BaseException):
+        return f"{type(error).__name__}: {error}"
+    status = getattr(error, "status_code", None)
+    return f"HTTP {status}" if status is not None else repr(error)[:100]
+
+
+def retry_status(response) -> bool:
+    """requests 响应的状态码是否为临时故障（供 retry_result 使用）"""
+    return getattr(response, "status_code", None) in RETRY_STATUS
+
+
+def stats() -> Dict[str, Any]:
+    """各服务的调用/重试/熔断统计与非关闭状态的熔断器"""
+    with _registry_lock:
+        result = {service: dict(counters) for service, counters in _counters.items()}
+        for service, budget in _budgets.items():
+            result.setdefault(service, {})["budget_exhausted"] = budget.exhausted
+        open_breakers = {breaker.name: breaker.state for breaker in _breakers.values()
+                         if breaker.state != CircuitBreaker.CLOSED}
+    if open_breakers:
+        result["breakers"] = open_breakers
+    return result
@@ -11,6 +11,8 @@ import urllib.request
 import json
 import re
 
+from config_store import write_atomic
+
 # ============================================================================
 # 配置
 # ============================================================================
@@ -46,7 +48,7 @@ def update_config_url(public_url: str):
         print(f"[WARNING] 配置文件不存在: {CONFIG_FILE}")
         return
 
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+    with open(CONFIG_FILE, 'r', encoding='utf-8', newline='') as f:  # 保留 CRLF 换行
         content = f.read()
 
     # 查找 "url": "..." 并替换
@@ -57,8 +59,8 @@ def update_config_url(public_url: str):
     new_content, count = re.subn(pattern, replacement, content)
 
     if count > 0:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            f.write(new_content)
+        # 原子替换：运行中的机器人会热加载 config.json5，不能让它读到写了一半的文件
+        write_atomic(CONFIG_FILE, new_content)
         print(f"  ✅ 已将公网地址写入 config.json5: url = \"{public_url}\"")
     else:
         print(f"  [WARNING] 未在 config.json5 中找到 \"url\" 字段，请手动添加:")
@@ -70,14 +72,12 @@ def clear_config_url():
     if not os.path.exists(CONFIG_FILE):
         return
 
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+    with open(CONFIG_FILE, 'r', encoding='utf-8', newline='') as f:
         content = f.read()
 
     pattern = r'("url"\s*:\s*)"[^"]*"'
     new_content = re.sub(pattern, r'\1""', content)
-
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        f.write(new_content)
+    write_atomic(CONFIG_FILE, new_content)
     print("  ✅ 已清除 config.json5 中的公网地址")
 
 
@@ -0,0 +1,252 @@
+"""
+启动加速与启动耗时分析模块
+- load_env(): 进程内只读取一次 .env（各模块不再各自调用 load_dotenv）
+- ImportProfiler: 类似 python -X importtime 的导入耗时统计（每个模块的自身耗时与累计耗时），
+  STARTUP_REPORT=1 时 main.py 在最开始安装，启动完成后输出报告
+- StartupTimeline: 记录启动各阶段相对进程启动的时间点（导入完成、WebSocket 连接、Agent 就绪、后端探测完成）
+
+python startup.py --bench 多次冷启动测量 import main 的耗时，与保存的基线比较，超过容忍度时以非 0 退出，
+可放在 CI 中作为启动耗时回归检查；--update-baseline 保存当前结果为新基线。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+# 进程启动时间点（本模块应最先被导入）
+PROCESS_START = time.perf_counter()
+
+_env_loaded = False
+_env_lock = threading.Lock()
+
+
+def load_env():
+    """读取 .env 到环境变量（进程内只执行一次）"""
+    global _env_loaded
+    with _env_lock:
+        if _env_loaded:
+            return
+        from dotenv import load_dotenv
+        load_dotenv()
+        _env_loaded = True
+
+
+# ============================================================================
+# 导入耗时统计
+# ============================================================================
+
+class ImportProfiler:
+    """
+    导入耗时统计：在 sys.meta_path 最前面插入一个查找器，为每个新导入模块的 exec_module 计时。
+    嵌套导入按调用栈拆分为自身耗时（self）与累计耗时（cumulative），口径与 -X importtime 一致；
+    内置/冻结模块的导入耗时可以忽略，不做统计。
+    """
+
+    def __init__(self):
+        self.records: Dict[str, List[float]] = {}   # 模块名 -> [self 秒, cumulative 秒]
+        self._stack: List[List[float]] = []
+        self._installed = False
+        self._owner = None
+
+    # ---- meta_path 查找器接口 ----
+
+    def find_spec(self, fullname, path=None, target=None):
+        if not self._installed:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                loader = spec.loader
+                # 只包装实例级加载器（SourceFileLoader 等），BuiltinImporter 等以类作为加载器的跳过
+                if loader is not None and not isinstance(loader, type) and hasattr(loader, "exec_module"):
+                    self._wrap(fullname, loader)
+                return spec
+        return None
+
+    def _wrap(self, fullname: str, loader):
+        exec_module = loader.exec_module
+        if getattr(exec_module, "_import_profiler", False):
+            return
+        profiler = self
+
+        def timed_exec_module(module):
+            # 仅在持有导入锁的线程中记录，其他线程的并发导入按各自的栈统计会相互干扰，直接执行
+            if threading.current_thread() is not profiler._owner:
+                return exec_module(module)
+            frame = [0.0]  # 子模块累计耗时
+            profiler._stack.append(frame)
+            started = time.perf_counter()
+            try:
+                return exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - started
+                profiler._stack.pop()
+                if profiler._stack:
+                    profiler._stack[-1][0] += elapsed
+                profiler.records[fullname] = [elapsed - frame[0], elapsed]
+
+        timed_exec_module._import_profiler = True
+        try:
+            loader.exec_module = timed_exec_module
+        except (AttributeError, TypeError):
+            pass
+
+    def install(self):
+        """开始统计（只统计调用线程中的导入）"""
+        if not self._installed:
+            self._owner = threading.current_thread()
+            self._installed = True
+            sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        self._installed = False
+        try:
+            sys.meta_path.remove(self)
+        except ValueError:
+            pass
+
+    def top(self, limit: int = 15, key: str = "cumulative") -> List[Tuple[str, float, float]]:
+        """按累计（或自身）耗时排序的 (模块, self 秒, cumulative 秒)"""
+        index = 1 if key == "cumulative" else 0
+        rows = sorted(self.records.items(), key=lambda item: item[1][index], reverse=True)
+        return [(name, values[0], values[1]) for name, values in rows[:limit]]
+
+    def total(self) -> float:
+        """顶层导入的累计耗时之和（不重复计算嵌套导入）"""
+        return sum(values[0] for values in self.records.values())
+
+
+# ============================================================================
+# 启动阶段
+# ============================================================================
+
+class StartupTimeline:
+    """启动阶段时间点（相对 PROCESS_START，线程安全）"""
+
+    def __init__(self):
+        self._marks: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    def mark(self, name: str) -> float:
+        elapsed = time.perf_counter() - PROCESS_START
+        with self._lock:
+            self._marks.append((name, elapsed))
+        return elapsed
+
+    def marks(self) -> List[Tuple[str, float]]:
+        with self._lock:
+            return list(self._marks)
+
+    def get(self, name: str) -> Optional[float]:
+        for mark, elapsed in self.marks():
+            if mark == name:
+                return elapsed
+        return None
+
+
+timeline = StartupTimeline()
+
+
+def format_report(profiler: Optional[ImportProfiler], limit: int = 15) -> str:
+    """启动报告：各阶段时间点 + 导入耗时排行"""
+    lines = ["启动耗时报告", "  阶段（相对进程启动）:"]
+    for name, elapsed in timeline.marks():
+        lines.append(f"    {elapsed * 1000:8.1f} ms  {name}")
+    if profiler and profiler.records:
+        lines.append(f"  导入耗时 Top {limit}（共 {len(profiler.records)} 个模块，合计 {profiler.total() * 1000:.1f} ms）:")
+        lines.append(f"    {'self(ms)':>9} | {'cumulative(ms)':>14} | 模块")
+        for name, self_seconds, cumulative in profiler.top(limit):
+            lines.append(f"    {self_seconds * 1000:9.1f} | {cumulative * 1000:14.1f} | {name}")
+    return "\n".join(lines)
+
+
+# ============================================================================
+# 启动耗时回归测试
+# ============================================================================
+
+# 基线随仓库提交（data/ 为运行时数据目录，不纳入版本管理）
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baseline.json")
+
+# 冷启动测量脚本：导入 main 并创建 FeishuBot（不连接飞书），eager 模式额外导入全部重量级依赖（旧的启动方式）
+_BENCH_SNIPPET = """
+import time, sys
+started = time.perf_counter()
+import main
+bot = main.FeishuBot()
+if {eager!r}:
+    import Agent, Comfyui, openai, lark_oapi, requests
+elapsed = time.perf_counter() - started
+with open(sys.argv[1], "w") as f:
+    f.write(repr(elapsed))
+"""
+
+
+def _run_once(eager: bool) -> float:
+    import tempfile
+    env = dict(os.environ, STARTUP_REPORT="0")
+    fd, result_path = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        # 结果写入文件：子进程的日志也会输出到 stdout
+        out = subprocess.run(
+            [sys.executable, "-c", _BENCH_SNIPPET.format(eager=eager), result_path],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            capture_output=True, text=True, timeout=120,
+        )
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else "启动失败")
+        with open(result_path, "r") as f:
+            return float(f.read())
+    finally:
+        os.remove(result_path)
+
+
+def measure_cold_start(runs: int = 5) -> Dict[str, float]:
+    """各运行 runs 次冷启动，返回延迟导入与全部预先导入两种方式的中位数（秒）"""
+    lazy = sorted(_run_once(False) for _ in range(runs))
+    eager = sorted(_run_once(True) for _ in range(runs))
+    return {"runs": runs, "lazy_median": lazy[runs // 2], "eager_median": eager[runs // 2],
+            "lazy_min": lazy[0], "eager_min": eager[0]}
+
+
+def check_regression(result: Dict[str, float], tolerance: float = 0.2,
+                     path: str = BASELINE_PATH) -> Tuple[bool, Optional[float]]:
+    """与基线比较延迟导入中位数，超过 (1 + tolerance) 倍视为回归；无基线时视为通过"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["lazy_median"]
+    except (OSError, ValueError, KeyError):
+        return True, None
+    return result["lazy_median"] <= baseline * (1 + tolerance), baseline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="启动耗时测量")
+    parser.add_argument("--bench", action="store_true", help="测量冷启动耗时并与基线比较")
+    parser.add_argument("--runs", type=int, default=5, help="每种方式的运行次数")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许超出基线的比例")
+    parser.add_argument("--update-baseline", action="store_true", help="保存本次结果为基线")
+    args = parser.parse_args()
+    if args.bench:
+        result = measure_cold_start(args.runs)
+        print(f"冷启动（import main + FeishuBot()，{result['runs']} 次中位数）:")
+        print(f"  延迟导入: {result['lazy_median'] * 1000:.0f} ms（最快 {result['lazy_min'] * 1000:.0f} ms）")
+        print(f"  全部预先导入: {result['eager_median'] * 1000:.0f} ms（最快 {result['eager_min'] * 1000:.0f} ms）")
+        if args.update_baseline:
+            with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+            print(f"  已保存基线: {BASELINE_PATH}")
+        else:
+            ok, baseline = check_regression(result, args.tolerance)
+            if baseline is None:
+                print("  无基线，使用 --update-baseline 保存")
+            else:
+                print(f"  基线 {baseline * 1000:.0f} ms，{'通过' if ok else '回归'}（容忍 +{args.tolerance:.0%}）")
+                sys.exit(0 if ok else 1)
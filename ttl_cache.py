@@ -0,0 +1,183 @@
+"""
+TTL + LRU 缓存模块
+基于 OrderedDict 的有序存储，条目按最近写入（或访问）时间排列：
+- 插入、查找、删除均为 O(1)
+- 过期清理只检查队首，均摊 O(1)
+- 超出容量时淘汰最旧条目（时间序淘汰，而非任意淘汰）
+- 可选 SQLite 持久化，进程重启后仍能识别之前记录的键
+
+用于消息去重（重启后识别飞书重复推送）以及后续的上传结果缓存等场景。
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    线程安全的 TTL + LRU 缓存
+
+    Args:
+        max_size: 最大条目数，超出时淘汰最旧条目
+        ttl: 过期时间（秒），None 表示不过期
+        persist_path: SQLite 文件路径，为 None 时仅保存在内存中
+        touch_on_get: 命中时是否刷新时间戳并移到队尾（LRU 语义）
+        namespace: SQLite 表名，多个缓存可共用同一个数据库文件
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: Optional[float] = None,
+                 persist_path: Optional[str] = None, touch_on_get: bool = False,
+                 namespace: str = "cache"):
+        if max_size <= 0:
+            raise ValueError("max_size 必须大于 0")
+        if not namespace.isidentifier():
+            raise ValueError(f"无效的 namespace: {namespace}")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.touch_on_get = touch_on_get
+        self.namespace = namespace
+        self._data: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._db: Optional[sqlite3.Connection] = None
+        if persist_path:
+            self._open_db(persist_path)
+
+    # ==================== 持久化 ====================
+
+    def _open_db(self, path: str):
+        """打开 SQLite 并加载未过期的条目"""
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.namespace} "
+                f"(key TEXT PRIMARY KEY, value TEXT, ts REAL NOT NULL)"
+            )
+            now = time.time()
+            if self.ttl is not None:
+                self._db.execute(f"DELETE FROM {self.namespace} WHERE ts < ?", (now - self.ttl,))
+            rows = self._db.execute(
+                f"SELECT key, value, ts FROM {self.namespace} ORDER BY ts DESC LIMIT ?",
+                (self.max_size,)
+            ).fetchall()
+            for key, value, ts in reversed(rows):
+                self._data[key] = (json.loads(value) if value is not None else None, ts)
+            logger.info("[TTLCache] 已从 %s 加载 %d 条记录 (%s)", path, len(rows), self.namespace)
+        except Exception as e:
+            logger.warning("[TTLCache] 打开持久化存储失败，退化为内存缓存: %s", e)
+            self._db = None
+
+    def _db_upsert(self, key: str, value: Any, ts: float):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.namespace} (key, value, ts) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), ts)
+            )
+        except Exception as e:
+            logger.warning("[TTLCache] 写入持久化存储失败: %s", e)
+
+    def _db_delete(self, key: str):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(f"DELETE FROM {self.namespace} WHERE key = ?", (key,))
+        except Exception as e:
+            logger.warning("[TTLCache] 删除持久化记录失败: %s", e)
+
+    # ==================== 内部操作 ====================
+
+    def _expire(self, now: float):
+        """从队首开始移除过期条目"""
+        if self.ttl is None:
+            return
+        deadline = now - self.ttl
+        while self._data:
+            key, (_, ts) = next(iter(self._data.items()))
+            if ts >= deadline:
+                break
+            self._data.popitem(last=False)
+            self._db_delete(key)
+
+    def _evict(self):
+        """超出容量时淘汰最旧条目"""
+        while len(self._data) > self.max_size:
+            key, _ = self._data.popitem(last=False)
+            self._db_delete(key)
+
+    # ==================== 公共接口 ====================
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """获取值，不存在或已过期时返回 default"""
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, _ = item
+            if self.touch_on_get:
+                self._data[key] = (value, now)
+                self._data.move_to_end(key)
+                self._db_upsert(key, value, now)
+            return value
+
+    def set(self, key: str, value: Any = None):
+        """写入值并移到队尾"""
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            self._data[key] = (value, now)
+            self._data.move_to_end(key)
+            self._db_upsert(key, value, now)
+            self._evict()
+
+    def add(self, key: str, value: Any = None) -> bool:
+        """仅当键不存在时写入，返回是否写入成功（原子的“检查并标记”）"""
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            if key in self._data:
+                return False
+            self._data[key] = (value, now)
+            self._db_upsert(key, value, now)
+            self._evict()
+            return True
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        """删除并返回值"""
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+            if item is _MISSING:
+                return default
+            self._db_delete(key)
+            return item[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            self._expire(time.time())
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire(time.time())
+            return len(self._data)
+
+    def close(self):
+        """关闭持久化连接"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None